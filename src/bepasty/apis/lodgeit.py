@@ -3,11 +3,11 @@ import urllib
 
 from flask import request
 from flask.views import MethodView
-from pygments.lexers import get_all_lexers
 from werkzeug.exceptions import Forbidden
 
 from ..constants import FOREVER
 from ..utils.http import redirect_next
+from ..utils.lexers import lexer_registry
 from ..utils.permissions import CREATE, may
 from ..utils.upload import create_item
 
@@ -16,33 +16,13 @@ class LodgeitUpload(MethodView):
     """
     LodgeIt paste form.
     """
-    # Most functionality LodgeIt supports comes directly from Pygments;
-    # for all other cases, we fall back to text/plain.
-    TRANS = {}
-    for lexer in get_all_lexers():
-        # (name, aliases, filetypes, mimetypes)
-        # e.g. ('Diff', ('diff',), ('*.diff', '*.patch'), ('text/x-diff', 'text/x-patch'))
-        if len(lexer[1]) == 0:
-            continue
-        name = lexer[1][0]
-        cts = lexer[3]
-        # Find a content type, preferably one with text/*
-        for ct in cts:
-            if ct.startswith("text/"):
-                break
-        else:
-            if cts:
-                ct = cts[0]
-            else:
-                ct = None
-        if ct:
-            TRANS[name] = ct
-
     def post(self):
         if not may(CREATE):
             raise Forbidden()
         lang = request.form.get('language')
-        content_type = self.TRANS.get(lang)
+        # Most functionality LodgeIt supports comes directly from Pygments;
+        # for all other cases, we fall back to text/plain.
+        content_type = lexer_registry.contenttype_for_alias(lang)
         content_type_hint = 'text/plain'
         filename = None
         t = request.form['code']
@@ -3,16 +3,17 @@ import base64
 import time
 from io import BytesIO
 
-from flask import Response, make_response, url_for, jsonify, stream_with_context, request, current_app
+from flask import Response, make_response, url_for, jsonify, request, current_app
 from flask.views import MethodView
 from werkzeug.exceptions import HTTPException, BadRequest, Conflict, Forbidden, InternalServerError, MethodNotAllowed
 
 from ..constants import FILENAME, ID, SIZE, TYPE, TRANSACTION_ID
 from ..utils.date_funcs import get_maxlife
+from ..utils.hashing import hash_states
 from ..utils.http import ContentRange, DownloadRange
 from ..utils.name import ItemName
-from ..utils.permissions import CREATE, LIST, may
-from ..utils.upload import Upload, filter_internal, background_compute_hash
+from ..utils.permissions import ADMIN, CREATE, LIST, may
+from ..utils.upload import Upload, filter_internal
 from ..views.filelist import file_infos
 from ..views.delete import DeleteView
 from ..views.download import DownloadView
@@ -35,7 +36,12 @@ def rest_errorhandler(func):
         try:
             return func(*args, **kwargs)
         except HTTPException as exc:
-            return error_message(exc.description, exc.code)
+            response, code = error_message(exc.description, exc.code)
+            # keep headers the error needs (e.g. Content-Range of 416)
+            for key, value in exc.get_headers():
+                if key != 'Content-Type':
+                    response.headers[key] = value
+            return response, code
         except Exception:
             if current_app.propagate_exceptions:
                 # if testing/debug mode, re-raise
@@ -58,7 +64,7 @@ class RestBase(MethodView):
 
 
 class ItemUploadView(RestBase):
-    def update_item(self, item, name):
+    def update_item(self, item, name, new_item):
         # Check the actual size of the file on the server against limit
         # Either 0 if new file or n bytes of already uploaded file
         Upload.filter_size(item.data.size)
@@ -67,20 +73,33 @@ class ItemUploadView(RestBase):
         if not request.headers.get("Content-Range"):
             raise BadRequest(description='Content-Range not specified')
 
-        # Get Content-Range and check if Range is consistent with server state
+        # Get Content-Range and check if Range is consistent with server state.
+        # Chunks may come in any order and in parallel.
         file_range = ContentRange.from_request()
-        if not item.data.size == file_range.begin:
-            raise Conflict(description='Content-Range inconsistent. Last byte on Server: %d' % item.data.size)
 
-        # Decode Base64 encoded request data
-        try:
-            raw_data = base64.b64decode(request.data)
-            file_data = BytesIO(raw_data)
-        except (base64.binascii.Error, TypeError):
-            raise BadRequest(description='Could not decode data body')
+        # The total size is given in Content-Range, check it against limit
+        Upload.filter_size(file_range.complete)
+        if new_item:
+            # the first chunk announces the total size, the others must match it
+            item.meta[SIZE] = file_range.complete
+        Upload.check_range(item, file_range)
+
+        if request.headers.get('Content-Transfer-Encoding', '').lower() == 'binary':
+            # The body is the raw chunk, copy it from the input stream to the item
+            file_data, size = request.stream, request.content_length
+        else:
+            # Decode Base64 encoded request data
+            try:
+                raw_data = base64.b64decode(request.data)
+            except (base64.binascii.Error, TypeError):
+                raise BadRequest(description='Could not decode data body')
+            file_data, size = BytesIO(raw_data), len(raw_data)
+        if size != file_range.size:
+            raise BadRequest(description='Size of the data does not match Content-Range')
 
-        # Write data chunk to item
-        Upload.data(item, file_data, len(raw_data), file_range.begin)
+        # Write data chunk to item, continue hashing if we hashed the previous chunks (see HashStates)
+        hasher = hash_states.resume(name, file_range.begin)
+        size_written, _ = Upload.data(item, file_data, size, file_range.begin, hasher=hasher)
 
         # Make a Response and create Transaction-ID from ItemName
         response = make_response()
@@ -91,17 +110,15 @@ class ItemUploadView(RestBase):
         trans_id_s = trans_id_b if isinstance(trans_id_b, str) else trans_id_b.decode()
         response.headers[TRANSACTION_ID] = trans_id_s
 
-        # Check if file is completely uploaded and set meta
-        if file_range.is_complete:
-            Upload.meta_complete(item, '')
-            item.meta[SIZE] = item.data.size
-            item.close()
-            background_compute_hash(current_app.storage, name)
+        # Record the received range, this also completes the item when all data is there
+        hash_states.suspend(name, file_range.begin + size_written, hasher)
+        item.close()
+        if Upload.receive_range(current_app.storage, name, file_range.begin, file_range.end + 1,
+                                file_range.complete):
             # Set status 'successful' and return the new URL for the uploaded file
             response.status = '201'
             response.headers["Content-Location"] = url_for('bepasty_apis.items_detail', name=name)
         else:
-            item.close()
             response.status = '200'
 
         return response
@@ -121,10 +138,15 @@ class ItemUploadView(RestBase):
         * Transaction-ID: The transaction ID for chunked uploads,
             which needs to be provided when uploading in chunks (after the first chunk).
 
+        * Content-Transfer-Encoding: "binary" if the body is the raw chunk data
+            (otherwise, it must be Base64-encoded).
+
         To start an upload, the HTTP headers need to be provided.
         The body of the request must be the Base64-encoded file contents.
         Content-Length is the original file size before Base64 encoding.
         Content-Range follows the same logic.
+        With "Content-Transfer-Encoding: binary", the body is the raw chunk data
+        instead and Content-Length must be the chunk size.
         After the first chunk is uploaded, bepasty will return the Transaction-ID to continue the upload.
         Provide the Transaction-ID and the correct Content-Range to continue the upload.
         After the file is completely uploaded, it will be marked as complete and
@@ -178,7 +200,7 @@ class ItemUploadView(RestBase):
 
         response = None
         try:
-            response = self.update_item(item, name)
+            response = self.update_item(item, name, new_item)
             return response
         finally:
             # If error response or exception on a new item path, remove item
@@ -209,6 +231,9 @@ class ItemUploadView(RestBase):
 
 
 class ItemDetailView(DownloadView, RestBase):
+    conditional = False  # the metadata may change
+    precompressed = False
+
     def err_incomplete(self, item, error):
         raise Conflict(description=error)
 
@@ -222,25 +247,24 @@ class ItemDetailView(DownloadView, RestBase):
 
 
 class ItemDownloadView(ItemDetailView):
-    def response(self, item, name):
-        request_range = DownloadRange.from_request()
-        if not request_range:
-            range_end = item.data.size - 1
-            range_begin = 0
-        else:
-            if request_range.end == -1:
-                range_end = item.data.size - 1
-            else:
-                range_end = min(request_range.end, item.data.size - 1)
-            range_begin = request_range.begin
+    conditional = True
+    precompressed = True
 
-        ret = Response(stream_with_context(self.stream(item, range_begin, range_end + 1)))
+    def response(self, item, name):
+        ret = self.offload_response(item, name)
+        if ret is not None:
+            ret.headers['Content-Disposition'] = '{}; filename="{}"'.format(
+                self.content_disposition, item.meta[FILENAME])
+            ret.headers['Content-Type'] = item.meta[TYPE]
+            return ret
+
+        size = item.data.size
+        ret = self.data_response(item, name, item.meta[TYPE])
         ret.headers['Content-Disposition'] = '{}; filename="{}"'.format(
             self.content_disposition, item.meta[FILENAME])
-        ret.headers['Content-Length'] = (range_end - range_begin) + 1
-        ret.headers['Content-Type'] = item.meta[TYPE]  # 'application/octet-stream'
-        ret.status = '200'
-        ret.headers['Content-Range'] = ('bytes %d-%d/%d' % (range_begin, range_end, item.data.size))
+        if ret.status_code == 200 and 'Content-Encoding' not in ret.headers:
+            # clients may rely on getting the size like with ranges
+            ret.headers['Content-Range'] = DownloadRange(0, size - 1).content_range(size)
         return ret
 
     @rest_errorhandler
@@ -309,5 +333,10 @@ class ItemUnlockView(UnlockView, RestBase):
 class InfoView(RestBase):
     @rest_errorhandler
     def get(self):
-        return jsonify({'MAX_BODY_SIZE': current_app.config['MAX_BODY_SIZE'],
-                        'MAX_ALLOWED_FILE_SIZE': current_app.config['MAX_ALLOWED_FILE_SIZE']})
+        info = {'MAX_BODY_SIZE': current_app.config['MAX_BODY_SIZE'],
+                'MAX_ALLOWED_FILE_SIZE': current_app.config['MAX_ALLOWED_FILE_SIZE'],
+                'UPLOAD_TRANSFER_ENCODINGS': ['base64', 'binary']}
+        if may(ADMIN):
+            info['JOBS'] = current_app.jobs.stats()
+            info['HIGHLIGHT'] = current_app.highlight_stats.stats()
+        return jsonify(info)
@@ -4,6 +4,7 @@ import hashlib
 
 from flask import (
     Flask,
+    Request as FlaskRequest,
     current_app,
     g as flaskg,  # searching for 1 letter name "g" isn't nice, thus we use flaskg
     render_template,
@@ -13,6 +14,13 @@ from markupsafe import Markup
 
 from .apis import blueprint as blueprint_apis
 from .storage import create_storage
+from .utils.compression import compress_response
+from .utils.highlight import HighlightStats, create_highlight_cache
+from .utils.housekeeping import create_housekeeper
+from .utils.jobs import create_job_queue
+from .utils.pool import create_worker_pool
+from .utils.render import create_render_limits
+from .utils.timestamps import DownloadTimestamps
 from .utils.name import setup_werkzeug_routing
 from .utils.permissions import (
     ADMIN,
@@ -47,6 +55,36 @@ class PrefixMiddleware:
             return [b'This URL does not belong to the Bepasty app.']
 
 
+class Request(FlaskRequest):
+    """
+    Request that can write uploaded files directly into storage items.
+
+    If the view class has an item_writer(**view_args) method and the user
+    may create items (judged without the POST form, as this is just being
+    parsed), file uploads in multipart form data are written into storage
+    through the ItemWriter it returns, instead of into temporary files.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.item_writers = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        view_func = current_app.view_functions.get(self.endpoint)
+        item_writer = getattr(getattr(view_func, 'view_class', None), 'item_writer', None)
+        if item_writer is not None and CREATE in get_permissions(use_form=False):
+            writer = item_writer(**self.view_args)
+            if writer is not None:
+                self.item_writers.append(writer)
+                return writer
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+    def close(self):
+        super().close()
+        # also the ones not in self.files due to an error while parsing
+        for writer in self.item_writers:
+            writer.close()
+
+
 def setup_secret_key(app):
     """
     The secret key is used to sign cookies and cookies not signed with the
@@ -68,6 +106,7 @@ def setup_secret_key(app):
 
 def create_app():
     app = Flask(__name__)
+    app.request_class = Request
 
     app.config.from_object('bepasty.config.Config')
     if os.environ.get('BEPASTY_CONFIG'):
@@ -80,6 +119,13 @@ def create_app():
         app.wsgi_app = PrefixMiddleware(app.wsgi_app, prefix=prefix)
 
     app.storage = create_storage(app)
+    app.jobs = create_job_queue(app)
+    app.worker_pool = create_worker_pool(app)
+    app.download_timestamps = DownloadTimestamps(app)
+    app.highlight_cache = create_highlight_cache(app)
+    app.highlight_stats = HighlightStats()
+    app.render_limits = create_render_limits(app)
+    app.housekeeper = create_housekeeper(app)
     setup_werkzeug_routing(app)
 
     app.register_blueprint(blueprint)
@@ -120,12 +166,22 @@ def create_app():
         Before the request is handled (by its view function), we compute some
         values here and make them easily available.
         """
+        if current_app.housekeeper is not None:
+            # started here, so it runs in the (maybe forked) server process
+            current_app.housekeeper.start()
+        current_app.download_timestamps.start()
+        # jobs of server processes that went away
+        current_app.jobs.take_over(min_interval=60)
         flaskg.logged_in = logged_in()
         flaskg.permissions = get_permissions()
         flaskg.icon_permissions = get_permission_icons()
         if flaskg.logged_in:
             session.permanent = current_app.config['PERMANENT_SESSION']
 
+    @app.after_request
+    def after_request(response):
+        return compress_response(response)
+
     def datetime_format(ts):
         """
         Takes a Unix timestamp and outputs an ISO 8601–like formatted string.
@@ -8,7 +8,7 @@ import argparse
 import logging
 import time
 
-from flask import Flask
+from flask import Flask, current_app
 
 from ..constants import (
     COMPLETE,
@@ -22,6 +22,7 @@ from ..constants import (
     TIMESTAMP_UPLOAD,
     TYPE,
 )
+from ..utils.compression import compressible_at_rest
 from ..utils.hashing import compute_hash
 from ..storage import create_storage
 
@@ -34,7 +35,7 @@ class Main:
 
     def do_migrate(self, storage, name, args):
         tnow = time.time()
-        with storage.openwrite(name) as item:
+        with storage.openlocked(name) as item:
             # compatibility support for bepasty 0.0.1 and pre-0.1.0
             # old items might have a 'timestamp' value which is not used any more
             # (superseded by 'timestamp-*') - delete it:
@@ -69,7 +70,7 @@ class Main:
 
     def do_purge(self, storage, name, args):
         tnow = time.time()
-        with storage.openwrite(name) as item:
+        with storage.open(name) as item:
             file_name = item.meta[FILENAME]
             file_size = item.meta[SIZE]
             t_upload = item.meta[TIMESTAMP_UPLOAD]
@@ -109,7 +110,7 @@ class Main:
                          help='only remove if file mimetype starts with PURGE_TYPE')
 
     def do_consistency(self, storage, name, args):
-        with storage.openwrite(name) as item:
+        with storage.openlocked(name) as item:
             file_name = item.meta[FILENAME]
             meta_size = item.meta[SIZE]
             meta_type = item.meta[TYPE]
@@ -165,7 +166,7 @@ class Main:
     _parser.set_defaults(func=do_info)
 
     def do_set(self, storage, name, args):
-        with storage.openwrite(name) as item:
+        with storage.openlocked(name) as item:
             print(name)
 
             if args.flag_complete is not None:
@@ -182,6 +183,42 @@ class Main:
                     print('  set not locked')
                 item.meta[LOCKED] = args.flag_locked
 
+    def do_relayout(self, storage, name, args):
+        if storage.in_other_layout(name):
+            print('moving: %s (to %s layout)' % (name, storage.layout))
+            storage.relocate(name)
+
+    _parser = _subparsers.add_parser('relayout',
+                                     help='Move objects into the configured storage layout (STORAGE_FILESYSTEM_LAYOUT)')
+    _parser.set_defaults(func=do_relayout)
+
+    def setup_compress(self, storage, names, args):
+        if not current_app.config.get('STORAGE_FILESYSTEM_COMPRESS'):
+            raise SystemExit('Compression is not enabled (see STORAGE_FILESYSTEM_COMPRESS).')
+
+    def do_compress(self, storage, name, args):
+        with storage.open(name) as item:
+            compressible = compressible_at_rest(current_app.config, item)
+        if compressible and storage.compress(name, current_app.config['STORAGE_FILESYSTEM_COMPRESS']):
+            print('compressed: %s' % name)
+
+    _parser = _subparsers.add_parser('compress',
+                                     help='Store object data compressed (STORAGE_FILESYSTEM_COMPRESS)')
+    _parser.set_defaults(func=do_compress, setup=setup_compress)
+
+    def setup_reindex(self, storage, names, args):
+        if storage.index is None:
+            raise SystemExit('Metadata index is not enabled (see STORAGE_FILESYSTEM_INDEX).')
+        if args.all_names:
+            # start from scratch, so entries of vanished items get dropped also
+            storage.index.clear()
+
+    def do_reindex(self, storage, name, args):
+        storage.reindex(name)
+
+    _parser = _subparsers.add_parser('reindex', help='Rebuild the metadata index for objects')
+    _parser.set_defaults(func=do_reindex, setup=setup_reindex)
+
     _parser = _subparsers.add_parser('set', help='Set flags on objects')
     _parser.set_defaults(func=do_set)
     _group = _parser.add_mutually_exclusive_group()
@@ -210,10 +247,14 @@ class Main:
             for i in app.before_request_funcs.get(None, ()):
                 i()
 
-            if len(args.names) == 1 and args.names[0] == '*':
+            args.all_names = len(args.names) == 1 and args.names[0] == '*'
+            if args.all_names:
                 names = list(storage)
             else:
                 names = args.names
+            setup = getattr(args, 'setup', None)
+            if setup is not None:
+                setup(self, storage, names, args)
             for name in names:
                 try:
                     args.func(self, storage, name, args)
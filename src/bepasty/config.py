@@ -45,7 +45,7 @@ class Config:
     #: beyond the limit set for its type, it will not be rendered, but just
     #: offered for download. Lookup within MAX_RENDER_SIZE is done by
     #: first-match and it is automatically sorted for longer content-type-
-    #: prefixes first.
+    #: prefixes first (once, when the app is created).
     #:
     #: Format of entries: content-type-prefix: max_size
     MAX_RENDER_SIZE = {
@@ -70,6 +70,163 @@ class Config:
         '': 1 * 1000 * 1000,
     }
 
+    #: Let the front-end web server send the data of downloads, so the WSGI
+    #: app does not need to copy it. bepasty still checks permissions, lock
+    #: state and lifetime, but then just sends a response header pointing to
+    #: the data file in the storage:
+    #:
+    #: - None - bepasty sends the data itself
+    #: - 'x-accel-redirect' - for nginx, the header value is
+    #:   DOWNLOAD_OFFLOAD_PREFIX + the path relative to the storage directory.
+    #:   You need an internal location for the prefix, like:
+    #:
+    #:   ::
+    #:
+    #:       location /_bepasty_storage/ {
+    #:           internal;
+    #:           alias /srv/bepasty/storage/;
+    #:           # nginx only keeps some headers from the app response:
+    #:           add_header X-Content-Type-Options nosniff;
+    #:       }
+    #:
+    #: - 'x-sendfile' - for Apache (mod_xsendfile) or lighttpd, the header
+    #:   value is the absolute path of the data file.
+    DOWNLOAD_OFFLOAD = None
+    DOWNLOAD_OFFLOAD_PREFIX = '/_bepasty_storage/'
+
+    #: With the metadata index (see STORAGE_FILESYSTEM_INDEX), a background
+    #: thread deletes expired items soon after their maximum lifetime is over.
+    #: It checks the index at least every EXPIRY_INTERVAL seconds and deletes
+    #: at most EXPIRY_BATCH_SIZE items at once (then pauses a second).
+    #: With several server processes, only one of them does this (the one
+    #: holding the lock on bepasty-housekeeping.lock in the storage directory).
+    #: 0 disables this, then expired items are deleted when they are accessed
+    #: (or by bepasty-object purge).
+    EXPIRY_INTERVAL = 60
+    EXPIRY_BATCH_SIZE = 100
+
+    #: With the metadata index and EXPIRY_INTERVAL set, the background thread
+    #: can also evict items when the disk gets full: if the filesystem of the
+    #: storage directory is used above EVICTION_HIGH_WATERMARK (a fraction of
+    #: its size, e.g. 0.9), it deletes complete, unlocked items until the usage
+    #: is below EVICTION_LOW_WATERMARK (e.g. 0.8). Items downloaded least
+    #: recently go first, locked items are never evicted. With
+    #: EVICTION_SIZE_WEIGHTED, the time since the last download is multiplied
+    #: by the item size, so bigger items go first.
+    #: Evicted items are logged (with level WARNING).
+    #: None means no eviction. Without STORAGE_FILESYSTEM_INDEX or with
+    #: EXPIRY_INTERVAL 0, there is no eviction either (a warning is logged).
+    EVICTION_HIGH_WATERMARK = None
+    EVICTION_LOW_WATERMARK = None
+    EVICTION_SIZE_WEIGHTED = False
+
+    #: Download timestamps are collected in memory and written to the items'
+    #: metadata in batches, every DOWNLOAD_TIMESTAMP_INTERVAL seconds (and
+    #: before evicting items and when the process ends). So serving items
+    #: does not need to write their metadata. 0 means writing them with every
+    #: download.
+    DOWNLOAD_TIMESTAMP_INTERVAL = 60
+
+    #: Number of worker processes (per server process) for CPU-bound work,
+    #: like making thumbnails. 0 means doing it in the request threads.
+    WORKER_PROCESSES = 2
+
+    #: Making a thumbnail is aborted after THUMBNAIL_TIMEOUT seconds and not
+    #: even tried for images with more than THUMBNAIL_MAX_PIXELS pixels.
+    #: A placeholder is shown instead then.
+    THUMBNAIL_TIMEOUT = 10
+    THUMBNAIL_MAX_PIXELS = 50 * 1000 * 1000
+
+    #: Whether to make thumbnails of image items in the background when their
+    #: upload completes (otherwise, when they are first requested).
+    #: Thumbnails are cached in the storage, next to the item.
+    THUMBNAIL_EAGER = False
+
+    #: Syntax highlighting (done in the worker processes, see WORKER_PROCESSES)
+    #: is aborted after HIGHLIGHT_TIMEOUT seconds, the text is shown without
+    #: highlighting then.
+    HIGHLIGHT_TIMEOUT = 10
+
+    #: Items of HIGHLIGHT_STREAM_SIZE bytes or more are highlighted by a
+    #: worker process into a file in the storage, next to the item, while the
+    #: start of the page is sent. The HTML is then sent from that file (also
+    #: to later requests), so we never need to keep all of it in memory.
+    #: After HIGHLIGHT_TIMEOUT seconds (checked between tokens), the rest is
+    #: shown as plain text. None disables it.
+    HIGHLIGHT_STREAM_SIZE = 1000 * 1000
+
+    #: Items bigger than MAX_RENDER_SIZE['HIGHLIGHT_TYPES'] are highlighted,
+    #: too, if we expect it to take at most HIGHLIGHT_TIME_BUDGET seconds,
+    #: going by the throughput of the lexer in the previous renders (of the
+    #: server process). None means just using the MAX_RENDER_SIZE limit.
+    HIGHLIGHT_TIME_BUDGET = 1.0
+
+    #: Downloads of items may be cached by browsers and proxies (until the
+    #: item expires) for at most DOWNLOAD_CACHE_MAX_AGE seconds. Items being
+    #: deleted or locked meanwhile might still be served from caches then.
+    DOWNLOAD_CACHE_MAX_AGE = 24 * 3600
+
+    #: Responses of RESPONSE_COMPRESS_TYPES (content type prefixes, like
+    #: rendered pages and JSON) with at least RESPONSE_COMPRESS_MIN_SIZE bytes
+    #: (or streamed) are compressed for clients accepting one of the
+    #: RESPONSE_COMPRESS_ENCODINGS (in our order of preference; 'br' needs the
+    #: brotli package, 'zstd' the zstandard package), with compression level
+    #: RESPONSE_COMPRESS_LEVEL (1 - 9, higher is smaller, but slower).
+    #: Item downloads are not compressed here (see PRECOMPRESS_ENCODINGS).
+    #: An empty list disables it (the default, usually your front-end web
+    #: server does it), enable it e.g. with ['br', 'gzip'].
+    RESPONSE_COMPRESS_ENCODINGS = []
+    RESPONSE_COMPRESS_MIN_SIZE = 1024
+    RESPONSE_COMPRESS_LEVEL = 6
+    RESPONSE_COMPRESS_TYPES = [
+        'text/html',
+        'application/json',
+    ]
+
+    #: Items of PRECOMPRESS_TYPES (content type prefixes) with at least
+    #: PRECOMPRESS_MIN_SIZE bytes are compressed in the background after their
+    #: upload, with each of the PRECOMPRESS_ENCODINGS: 'gzip', 'br' (needs the
+    #: brotli package) and 'zstd' (needs the zstandard package). Downloads are
+    #: then sent compressed to clients accepting it (but not for Range
+    #: requests). The variants are kept in the storage, next to the item
+    #: (taking extra disk space), so this is disabled by default (an empty
+    #: list), enable it e.g. with ['gzip'].
+    PRECOMPRESS_ENCODINGS = []
+    PRECOMPRESS_MIN_SIZE = 64 * 1024
+    PRECOMPRESS_TYPES = [
+        'text/',
+        'application/json',
+        'application/javascript',
+        'application/xml',
+        'application/x-asciinema-recording',
+        'image/svg+xml',
+    ]
+
+    #: Text items too big to render all at once are shown DISPLAY_LINES
+    #: lines at a time (the lines are found using an index, made in the
+    #: background when the upload completes and kept next to the item).
+    DISPLAY_LINES = 1000
+
+    #: Syntax highlighted HTML of text items is cached, up to
+    #: HIGHLIGHT_CACHE_SIZE characters in memory (per server process,
+    #: least recently used entries are dropped first, 0 disables it).
+    #: With HIGHLIGHT_CACHE_PERSIST, it is also cached in the storage, next to
+    #: the item (needs more disk space, but survives restarts).
+    HIGHLIGHT_CACHE_SIZE = 32 * 1000 * 1000
+    HIGHLIGHT_CACHE_PERSIST = False
+
+    #: Maximum number of threads (per process) running background jobs, like
+    #: computing the hash of uploaded files. More jobs wait in a queue.
+    JOB_WORKERS = 2
+
+    #: Path of an SQLite database recording queued background jobs, so jobs not
+    #: done when a bepasty process ends are resumed by another one (the server
+    #: processes check for such jobs every minute while serving requests).
+    #: Use the same journal for all processes of a server, but not one on a
+    #: network filesystem shared between several machines.
+    #: None means no journal.
+    JOB_JOURNAL = None
+
     # Whether to use the python-magic module to guess a file's MIME
     # type by looking into its content (if the MIME type cannot be
     # determined from the filename extension).
@@ -87,6 +244,44 @@ class Config:
     #: Filesystem storage path
     STORAGE_FILESYSTEM_DIRECTORY = '/tmp/'
 
+    #: Directory layout of the filesystem storage:
+    #:
+    #: - 'flat' - all files directly in STORAGE_FILESYSTEM_DIRECTORY
+    #: - 'sharded' - files in two levels of subdirectories named after the
+    #:   first two characters of the item name (e.g. a/b/abcdefgh.data).
+    #:   Use this if you have many items, so directories stay small.
+    #:
+    #: Items stored with the other layout are moved when they are accessed.
+    #: To move all of them at once, use: bepasty-object relayout '*'
+    STORAGE_FILESYSTEM_LAYOUT = 'flat'
+
+    #: Whether to keep an index of all items' metadata (an SQLite database
+    #: in the storage directory). With many items, this makes listing them
+    #: much faster, as not every item needs to be opened.
+    #:
+    #: The index is built automatically when it does not exist yet. If it
+    #: gets out of sync (e.g. because files were removed manually), rebuild
+    #: it with: bepasty-object reindex '*'
+    STORAGE_FILESYSTEM_INDEX = False
+
+    #: Store the data of complete items of STORAGE_FILESYSTEM_COMPRESS_TYPES
+    #: (content type prefixes) compressed, with 'zlib' or 'zstd' (needs the
+    #: zstandard package). It is compressed in blocks (in the background, after
+    #: the upload), so ranges of it can still be read without decompressing
+    #: all of it. Compressed data can not be sent by the front-end web server
+    #: (see DOWNLOAD_OFFLOAD), so it goes through bepasty then.
+    #: None disables it, items compressed before stay readable.
+    #: To compress the existing items, use: bepasty-object compress '*'
+    STORAGE_FILESYSTEM_COMPRESS = None
+    STORAGE_FILESYSTEM_COMPRESS_TYPES = [
+        'text/',
+        'application/json',
+        'application/javascript',
+        'application/xml',
+        'application/x-asciinema-recording',
+        'image/svg+xml',
+    ]
+
     #: Server secret key needed for safe session cookies.
     #: You must set a very long (20–100 chars), very random, very secret string here,
     #: otherwise bepasty will not work (and will crash when trying to log in)!
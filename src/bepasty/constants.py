@@ -9,10 +9,12 @@ TIMESTAMP_UPLOAD = 'timestamp-upload'
 TIMESTAMP_DOWNLOAD = 'timestamp-download'
 TIMESTAMP_MAX_LIFE = 'timestamp-max-life'
 ID = 'id'  # storage name
+RANGES = 'ranges'  # received data ranges of incomplete uploads
 FOREVER = -1
 
 # Headers
 TRANSACTION_ID = 'Transaction-ID'  # keep in sync with bepasty-cli
+LINE_COUNT = 'Line-Count'
 
 # Used internally only
-internal_meta = [TYPE_HINT]
+internal_meta = [TYPE_HINT, RANGES]
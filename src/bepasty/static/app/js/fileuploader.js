@@ -15,6 +15,154 @@ $(function () {
         return Math.round(size * 10) / 10 + " " + suffix[tier];
     }
 
+    // Number of chunks of a file that are uploaded at the same time
+    var PARALLEL_CHUNKS = 4;
+
+    // Bytes uploaded and total bytes of the uploads in progress, by item name
+    var progress = {};
+
+    function progressUpdate() {
+        var loaded = 0, total = 0;
+        $.each(progress, function (name, p) {
+            loaded += p.loaded;
+            total += p.total;
+        });
+        var percent = total ? parseInt(loaded / total * 100, 10) : 100;
+        $('#fileupload-progress').find('.progress-bar').css('width', percent + '%');
+    }
+
+    function progressStart(name, total) {
+        if ($.isEmptyObject(progress)) {
+            $('#fileupload-progress').css('visibility', 'visible');
+            $('#fileupload-abort').css('visibility', 'visible');
+        }
+        progress[name] = {loaded: 0, total: total};
+        progressUpdate();
+    }
+
+    function progressStop(name) {
+        delete progress[name];
+        if ($.isEmptyObject(progress)) {
+            var progressBar = $('#fileupload-progress');
+            progressBar.css('visibility', 'hidden');
+            progressBar.find('.progress-bar').css('width', 0 + '%');
+            $('#fileupload-abort').css('visibility', 'hidden');
+        } else {
+            progressUpdate();
+        }
+    }
+
+    // Upload file to url in chunks of at most MAX_BODY_SIZE bytes,
+    // PARALLEL_CHUNKS of them at the same time (the server accepts them
+    // in any order). Returns a promise, which also has an abort method.
+    function sendChunks(url, name, file) {
+        var deferred = $.Deferred(),
+            requests = {},  // chunk requests in progress, by begin
+            loaded = {},  // bytes uploaded, by chunk begin
+            nextBegin = 0,
+            finished = false,
+            result;
+
+        function fail(jqXHR, textStatus, errorThrown) {
+            if (!finished) {
+                finished = true;
+                $.each(requests, function (begin, request) {
+                    request.abort();
+                });
+                deferred.reject(jqXHR, textStatus, errorThrown);
+            }
+        }
+
+        function sendChunk(begin, end) {
+            var formData = new FormData(),
+                headers = {};
+            formData.append('file', file.slice(begin, end), file.name);
+            if (end - begin < file.size) {
+                headers['Content-Range'] = 'bytes ' + begin + '-' + (end - 1) + '/' + file.size;
+            }
+            loaded[begin] = 0;
+            requests[begin] = $.ajax({
+                type: 'POST',
+                url: url,
+                data: formData,
+                processData: false,
+                contentType: false,
+                dataType: 'json',
+                headers: headers,
+                xhr: function () {
+                    var xhr = $.ajaxSettings.xhr();
+                    xhr.upload.addEventListener('progress', function (e) {
+                        loaded[begin] = Math.min(e.loaded, end - begin);
+                        if (progress[name]) {
+                            progress[name].loaded = 0;
+                            $.each(loaded, function (b, l) {
+                                progress[name].loaded += l;
+                            });
+                            progressUpdate();
+                        }
+                    });
+                    return xhr;
+                }
+            })
+                .done(function (chunkResult) {
+                    delete requests[begin];
+                    result = chunkResult;
+                    sendNext();
+                })
+                .fail(function (jqXHR, textStatus, errorThrown) {
+                    delete requests[begin];
+                    fail(jqXHR, textStatus, errorThrown);
+                });
+        }
+
+        function sendNext() {
+            if (finished) {
+                return;
+            }
+            while (nextBegin < file.size && Object.keys(requests).length < PARALLEL_CHUNKS) {
+                var begin = nextBegin;
+                nextBegin = Math.min(begin + MAX_BODY_SIZE, file.size);
+                sendChunk(begin, nextBegin);
+            }
+            if ($.isEmptyObject(requests)) {
+                finished = true;
+                deferred.resolve(result);
+            }
+        }
+
+        if (file.size === 0) {
+            sendChunk(0, 0);
+        } else {
+            sendNext();
+        }
+        return deferred.promise({
+            abort: function () {
+                fail(null, 'abort', null);
+            }
+        });
+    }
+
+    function uploadDone(context, result) {
+        $(context)
+            .attr('class', 'alert alert-success');
+        $.each(result.files, function (index, file) {
+            $(context[0].childNodes[1])
+                .wrapInner($('<a target="_blank" class="alert-link">')
+                    .prop('href', file.url));
+            $('#filelist').append(file.name + "\n");
+            delete jqXHR[file.name];
+            $('#' + file.name).css('display', 'none');
+        });
+        $('#filelist-form').show();
+    }
+
+    function uploadFailed(context, name) {
+        $(context)
+            .attr('class', 'alert alert-danger')
+            .append('<p><strong>Upload failed!</strong></p>');
+        delete jqXHR[name];
+    }
+
     $('#fileupload')
         .fileupload({
             dataType: 'json',
@@ -62,59 +210,29 @@ $(function () {
                         + ')</span>');
                     fileItem.appendTo(data.context);
 
-                    var _jqXHR = $this.fileupload('send', data);
-                    _jqXHR.error(function (jqXHR, textStatus, errorThrown) {
+                    progressStart(result.name, file.size);
+                    var upload = sendChunks(data.url, result.name, file);
+                    upload
+                        .done(function (uploadResult) {
+                            uploadDone(data.context, uploadResult);
+                        })
+                        .fail(function () {
                             // Delete file-upload garbage on the server
                             $.ajax({
                                 type: 'GET',
-                                url: data.url+'/abort'
+                                url: data.url + '/abort'
                             });
+                            uploadFailed(data.context, result.name);
+                        })
+                        .always(function () {
+                            progressStop(result.name);
                         });
-                    jqXHR[result.name] = _jqXHR;
+                    jqXHR[result.name] = upload;
                 }
             });
             return false;
         })
 
-        .on('fileuploaddone', function (e, data) {
-            $(data.context)
-                .attr('class', 'alert alert-success');
-            $.each(data.result.files, function (index, file) {
-                $(data.context[0].childNodes[1])
-                    .wrapInner($('<a target="_blank" class="alert-link">')
-                        .prop('href', file.url));
-                $('#filelist').append(file.name + "\n");
-                delete jqXHR[file.name];
-                $('#' + file.name).css('display', 'none');
-            });
-            $('#filelist-form').show();
-        })
-
-        .on('fileuploadfail', function (e, data) {
-            $(data.context)
-                .attr('class', 'alert alert-danger')
-                .append('<p><strong>Upload failed!</strong></p>');
-            var name = data.url.split('/').pop();
-            delete jqXHR[name];
-        })
-
-        .on('fileuploadprogressall', function (e, data) {
-            var progress = parseInt(data.loaded / data.total * 100, 10);
-            $('#fileupload-progress').find('.progress-bar').css('width', progress + '%');
-        })
-
-        .on('fileuploadstart', function (e, data) {
-            $('#fileupload-progress').css('visibility', 'visible');
-            $('#fileupload-abort').css('visibility', 'visible')
-        })
-
-        .on('fileuploadstop', function (e, data) {
-            var progressBar = $('#fileupload-progress')
-            progressBar.css('visibility', 'hidden');
-            progressBar.find('.progress-bar').css('width', 0 + '%');
-            $('#fileupload-abort').css('visibility', 'hidden');
-        })
-
         .on('fileuploadprocessfail', function (e, data) {
             $(data.context)
                 .attr('class', 'alert alert-danger');
@@ -1,3 +1,4 @@
+import glob
 import os
 import pickle
 import logging
@@ -5,20 +6,48 @@ import tempfile
 
 from collections.abc import MutableMapping
 
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
+from .compressed import CompressedData, write_compressed
+from .index import MetaIndex
+
 logger = logging.getLogger(__name__)
 
 
 def create_storage(app):
     # Decouple Storage class from Flask app
     storage_dir = app.config['STORAGE_FILESYSTEM_DIRECTORY']
-    return Storage(storage_dir)
+    index = app.config.get('STORAGE_FILESYSTEM_INDEX', False)
+    layout = app.config.get('STORAGE_FILESYSTEM_LAYOUT', 'flat')
+    return Storage(storage_dir, index=index, layout=layout)
 
 
 class Storage:
     """
     Filesystem storage - store meta and data into separate files in a directory.
+
+    Files are either stored directly in the storage directory ("flat" layout)
+    or in two levels of subdirectories named after the first characters of the
+    item name ("sharded" layout, e.g. a/b/abcdefgh.data), so that no directory
+    gets too many entries. Items found in the other layout get moved into the
+    configured one when they are accessed.
+
+    Optionally, a metadata index is kept in an SQLite database, see MetaIndex.
+
+    The data of complete items may be stored compressed (.datz instead of
+    .data file), see compress().
     """
-    def __init__(self, storage_dir):
+    INDEX_FILENAME = 'bepasty-index.sqlite'
+    LAYOUTS = ('flat', 'sharded')
+
+    def __init__(self, storage_dir, index=False, layout='flat'):
+        if layout not in self.LAYOUTS:
+            raise ValueError("Unknown storage layout: %r" % layout)
+        self.layout = layout
         try:
             fd, fname = tempfile.mkstemp(dir=storage_dir)
         except OSError as e:
@@ -28,17 +57,92 @@ class Storage:
             os.close(fd)
             os.remove(fname)
             self.directory = storage_dir
+        self.index = None
+        if index:
+            index_filename = os.path.join(storage_dir, self.INDEX_FILENAME)
+            new_index = not os.path.exists(index_filename)
+            self.index = MetaIndex(index_filename)
+            if new_index:
+                # the storage might already contain items, index them
+                for name in self:
+                    self.reindex(name)
+
+    @property
+    def other_layout(self):
+        return 'flat' if self.layout == 'sharded' else 'sharded'
 
-    def _filename(self, name):
+    def _filename(self, name, layout=None):
         if '/' in name:
             raise RuntimeError
+        if (layout or self.layout) == 'sharded':
+            # '.' is not used in item names, but make sure we never get '..'
+            shard = name.replace('.', '_').ljust(2, '_')
+            return os.path.join(self.directory, shard[0], shard[1], name)
         return os.path.join(self.directory, name)
 
-    def _open(self, name, mode):
+    def _open(self, name, mode, lock=False):
         basefilename = self._filename(name)
-        file_data = open(basefilename + '.data', mode)
-        file_meta = open(basefilename + '.meta', mode)
-        return Item(file_data, file_meta)
+        if mode == 'w+b':
+            os.makedirs(os.path.dirname(basefilename), exist_ok=True)
+        try:
+            file_data, compressed = self._open_data(basefilename, mode)
+        except FileNotFoundError:
+            if mode == 'w+b' or not self.relocate(name):
+                raise
+            file_data, compressed = self._open_data(basefilename, mode)
+        try:
+            file_meta = open(basefilename + '.meta', mode)
+        except FileNotFoundError:
+            # the item might be just being relocated by someone else
+            if mode == 'w+b' or not self.relocate(name):
+                file_data.close()
+                raise
+            file_meta = open(basefilename + '.meta', mode)
+        if lock and fcntl is not None:
+            # released when the file is closed
+            fcntl.flock(file_meta.fileno(), fcntl.LOCK_EX)
+        return Item(file_data, file_meta, name=name, index=self.index, compressed=compressed)
+
+    def _open_data(self, basefilename, mode):
+        """
+        Open the data file of an item.
+
+        :return: (file object, whether it is compressed)
+        """
+        try:
+            return open(basefilename + '.data', mode), False
+        except FileNotFoundError:
+            if mode == 'w+b':
+                raise
+        # compressed data is only read
+        return open(basefilename + '.datz', 'rb'), True
+
+    def in_other_layout(self, name):
+        """
+        Check whether item <name> is stored with the other (not configured) layout.
+        """
+        return os.path.exists(self._filename(name, self.other_layout) + '.meta')
+
+    def relocate(self, name):
+        """
+        Move item <name> from the other layout into the configured one.
+
+        :return: True if the item is now in the configured layout, False if it was not found
+        """
+        src = self._filename(name, self.other_layout)
+        dst = self._filename(name)
+        if not self.in_other_layout(name):
+            return os.path.exists(dst + '.meta')
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        # move the .meta file last, so the item is always found in one of the layouts
+        suffixes = ['.data', '.datz', '.meta'] + [path[len(src):] for path in self._sidecar_paths(src)]
+        for suffix in suffixes:
+            try:
+                os.rename(src + suffix, dst + suffix)
+            except FileNotFoundError:
+                # somebody else was faster
+                pass
+        return True
 
     def create(self, name, size):
         return self._open(name, 'w+b')
@@ -49,10 +153,22 @@ class Storage:
     def openwrite(self, name):
         return self._open(name, 'r+b')
 
+    def openlocked(self, name):
+        """
+        Like openwrite, but hold an exclusive lock on the metadata until the item is closed.
+
+        Use this to update metadata that concurrent requests might also update
+        (where the platform does not support file locking, there is no lock).
+        """
+        return self._open(name, 'r+b', lock=True)
+
     def remove(self, name):
+        self.relocate(name)
         basefilename = self._filename(name)
         file_data = basefilename + '.data'
         file_meta = basefilename + '.meta'
+        if not os.path.exists(file_data) and os.path.exists(basefilename + '.datz'):
+            file_data = basefilename + '.datz'
         try:
             os.remove(file_data)
         except OSError as e:
@@ -63,15 +179,144 @@ class Storage:
         except OSError as e:
             logger.error("Could not delete file: {}\n {}".format(file_meta, str(e)))
             raise
+        for path in self._sidecar_paths(basefilename):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if self.index is not None:
+            self.index.remove(name)
+
+    def _sidecar_paths(self, basefilename):
+        return [path for path in glob.glob(glob.escape(basefilename) + '.*')
+                if not path.endswith(('.data', '.datz', '.meta'))]
+
+    def compress(self, name, codec='zlib', max_ratio=0.9):
+        """
+        Store the data of the complete item <name> compressed with <codec> (see
+        storage.filesystem.compressed), if that saves space.
+
+        Reading the data works like before, but it can not be written any more
+        and has no file of its own (Data.path and Data.file_at give None).
+
+        :return: whether the data is stored compressed now (False if it already
+                 was or the compressed data would be bigger than <max_ratio> of it)
+        """
+        self.relocate(name)
+        basefilename = self._filename(name)
+        with self.open(name) as item:
+            if isinstance(item.data, CompressedData):
+                return False
+            size = item.data.size
+            fd, tmpname = tempfile.mkstemp(prefix=os.path.basename(basefilename) + '.',
+                                           dir=os.path.dirname(basefilename))
+            try:
+                with os.fdopen(fd, 'w+b') as f:
+                    write_compressed(item.data, f, codec)
+                    compressed_size = f.seek(0, os.SEEK_END)
+                if compressed_size > size * max_ratio:
+                    os.remove(tmpname)
+                    return False
+                os.replace(tmpname, basefilename + '.datz')
+            except BaseException:
+                if os.path.exists(tmpname):
+                    os.remove(tmpname)
+                raise
+        # readers having it open can still read it
+        os.remove(basefilename + '.data')
+        return True
+
+    def read_sidecar(self, name, kind, key):
+        """
+        Return the content of the <kind> sidecar file of item <name> if it was
+        written with <key>, otherwise None.
+
+        Sidecar files keep data derived from the item (like thumbnails) next to
+        it. The key identifies what it was derived from (e.g. the item hash),
+        so outdated content is not used. They are relocated and removed
+        together with the item.
+        """
+        f = self.open_sidecar(name, kind, key)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def open_sidecar(self, name, kind, key):
+        """
+        Like read_sidecar, but return the sidecar file, opened for reading and
+        positioned at the content (for reading big content in pieces).
+        """
+        try:
+            f = open(self._filename(name) + '.' + kind, 'rb')
+        except FileNotFoundError:
+            return None
+        if f.readline() != key.encode() + b'\n':
+            f.close()
+            return None
+        return f
+
+    def write_sidecar(self, name, kind, key, data):
+        """
+        Write <data> into the <kind> sidecar file of item <name>, see read_sidecar.
+
+        <data> is bytes or an iterable of bytes (for big content).
+        """
+        if not kind.isalnum() or '\n' in key:
+            raise ValueError('Invalid sidecar kind or key')
+        filename = self._filename(name) + '.' + kind
+        fd, tmpname = tempfile.mkstemp(prefix=os.path.basename(filename) + '.', dir=os.path.dirname(filename))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(key.encode() + b'\n')
+                if isinstance(data, bytes):
+                    f.write(data)
+                else:
+                    for buf in data:
+                        f.write(buf)
+            # replace atomically, readers get the old or the new content
+            os.replace(tmpname, filename)
+        except BaseException:
+            os.remove(tmpname)
+            raise
+
+    def reindex(self, name):
+        """
+        Update the metadata index entry of item <name> from its .meta file.
+        """
+        if self.index is None:
+            return
+        try:
+            with self.open(name) as item:
+                meta = dict(item.meta)
+        except FileNotFoundError:
+            meta = None
+        except pickle.UnpicklingError:
+            logger.error("Could not index item with corrupted metadata: %s", name)
+            meta = None
+        if meta:
+            self.index.update(name, meta)
+        else:
+            self.index.remove(name)
+
+    def _listdir_meta(self, directory):
+        return [fn[:-5] for fn in os.listdir(directory) if fn.endswith('.meta')]
+
+    def _listdir_shards(self, directory):
+        return [os.path.join(directory, fn) for fn in os.listdir(directory)
+                if len(fn) == 1 and os.path.isdir(os.path.join(directory, fn))]
 
     def __iter__(self):
-        names = [fn[:-5] for fn in os.listdir(self.directory)
-                 if fn.endswith('.meta')]
+        # we always look into both layouts, so not yet relocated items are found also
+        names = self._listdir_meta(self.directory)
+        for shard_dir in self._listdir_shards(self.directory):
+            for subshard_dir in self._listdir_shards(shard_dir):
+                names.extend(self._listdir_meta(subshard_dir))
         yield from names
 
     def __contains__(self, name):
-        meta_filename = self._filename(name) + '.meta'
-        return os.path.exists(meta_filename)
+        return any(os.path.exists(self._filename(name, layout) + '.meta')
+                   for layout in (self.layout, self.other_layout))
 
 
 class Item:
@@ -80,13 +325,16 @@ class Item:
 
     :ivar data: Open file-like object for data.
     """
-    def __init__(self, file_data, file_meta):
+    def __init__(self, file_data, file_meta, name=None, index=None, compressed=False):
         """
         :param file_data: Open file-like object for the data file.
         :param file_meta: Open file-like object for the meta file.
+        :param name: Storage name of the item (needed for the index).
+        :param index: MetaIndex to update when metadata is written (or None).
+        :param compressed: Whether the data file is block-compressed (see CompressedData).
         """
-        self.data = Data(file_data)
-        self.meta = Meta(file_meta)
+        self.data = CompressedData(file_data) if compressed else Data(file_data)
+        self.meta = Meta(file_meta, name=name, index=index)
 
     def __enter__(self):
         return self
@@ -117,6 +365,23 @@ class Data:
         self._file.seek(offset)
         return self._file.read(size)
 
+    @property
+    def path(self):
+        """
+        Filesystem path of the data file (e.g. for letting a front-end web server send it).
+        """
+        return self._file.name
+
+    def file_at(self, offset):
+        """
+        Return the underlying file object, positioned at <offset>.
+
+        This is for handing the file over to the WSGI server, so it can transfer
+        it without copying the data through Python (e.g. using sendfile).
+        """
+        self._file.seek(offset)
+        return self._file
+
     def write(self, data, offset):
         self._file.seek(offset)
         return self._file.write(data)
@@ -126,9 +391,11 @@ class Meta(MutableMapping):
     """
     Metadata of the item.
     """
-    def __init__(self, file_meta):
+    def __init__(self, file_meta, name=None, index=None):
         self._changed = False
         self._file = file_meta
+        self._name = name
+        self._index = index
         data = file_meta.read()
         if data:
             self._data = pickle.loads(data)
@@ -171,3 +438,5 @@ class Meta(MutableMapping):
         # cause problems with existing pickles.
         pickle.dump(self._data, self._file, protocol=2)
         self._file.seek(0)
+        if self._index is not None:
+            self._index.update(self._name, self._data)
@@ -0,0 +1,154 @@
+"""
+Block-compressed data files.
+
+The data of complete items may be stored compressed (see Storage.compress).
+It is split into blocks of block_size bytes, compressed independently, so
+reading a range of it only needs to decompress the blocks it touches.
+
+File layout (integers are unsigned, little-endian):
+
+- header: magic, codec (1 byte), block size (4 bytes), data size and index offset (8 bytes each)
+- the compressed blocks
+- index: offsets of the compressed blocks, followed by the index offset (8 bytes each)
+"""
+
+from array import array
+import io
+import struct
+import sys
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    # zstandard is optional
+    zstandard = None
+
+MAGIC = b'BPZ1'
+HEADER = struct.Struct('<4sB3xIQQ')
+
+BLOCK_SIZE = 1024 * 1024
+
+# codec name -> codec id in the header
+CODECS = {
+    'zlib': 0,
+    'zstd': 1,
+}
+
+
+def _compress_function(codec):
+    if codec == 'zlib':
+        return zlib.compress
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError('Compressing with zstd needs the zstandard package')
+        return zstandard.ZstdCompressor().compress
+    raise ValueError('Unknown codec: %r' % codec)
+
+
+def _decompress_function(codec_id):
+    if codec_id == CODECS['zlib']:
+        return zlib.decompress
+    if codec_id == CODECS['zstd']:
+        if zstandard is None:
+            raise ValueError('Reading zstd compressed data needs the zstandard package')
+        return zstandard.ZstdDecompressor().decompress
+    raise ValueError('Unknown codec id: %r' % codec_id)
+
+
+def _offsets_to_bytes(offsets):
+    if sys.byteorder == 'big':
+        offsets = array('Q', offsets)
+        offsets.byteswap()
+    return offsets.tobytes()
+
+
+def _offsets_from_bytes(buf):
+    offsets = array('Q')
+    offsets.frombytes(buf)
+    if sys.byteorder == 'big':
+        offsets.byteswap()
+    return offsets
+
+
+def write_compressed(data, f, codec='zlib', block_size=BLOCK_SIZE):
+    """
+    Write <data> (an item's Data) block-compressed with <codec> into the new file <f>.
+    """
+    compress = _compress_function(codec)
+    size = data.size
+    f.write(HEADER.pack(MAGIC, CODECS[codec], block_size, size, 0))
+    offsets = array('Q')
+    offset = 0
+    while offset < size:
+        buf = data.read(min(block_size, size - offset), offset)
+        if not buf:
+            raise ValueError('Data ended before its size')
+        offsets.append(f.tell())
+        f.write(compress(buf))
+        offset += len(buf)
+    index_offset = f.tell()
+    offsets.append(index_offset)
+    f.write(_offsets_to_bytes(offsets))
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, CODECS[codec], block_size, size, index_offset))
+
+
+class CompressedData:
+    """
+    Data of the item, stored in a block-compressed file (read-only).
+
+    To read sequentially in small pieces efficiently, we keep the last block
+    we decompressed.
+    """
+    def __init__(self, file_data):
+        self._file = file_data
+        file_data.seek(0)
+        magic, codec_id, self._block_size, self._size, index_offset = HEADER.unpack(file_data.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('Not a compressed data file')
+        self._decompress = _decompress_function(codec_id)
+        file_data.seek(index_offset)
+        self._offsets = _offsets_from_bytes(file_data.read())
+        self._block = None, b''
+
+    @property
+    def size(self):
+        return self._size
+
+    def close(self):
+        self._file.close()
+
+    def _read_block(self, number):
+        if self._block[0] != number:
+            begin, end = self._offsets[number], self._offsets[number + 1]
+            self._file.seek(begin)
+            self._block = number, self._decompress(self._file.read(end - begin))
+        return self._block[1]
+
+    def read(self, size, offset):
+        end = self._size if size < 0 else min(offset + size, self._size)
+        if offset >= end:
+            return b''
+        pieces = []
+        for number in range(offset // self._block_size, (end - 1) // self._block_size + 1):
+            block_offset = number * self._block_size
+            block = self._read_block(number)
+            pieces.append(block[max(0, offset - block_offset):end - block_offset])
+        return b''.join(pieces)
+
+    @property
+    def path(self):
+        """
+        None, as there is no file with the data (see Data.path).
+        """
+        return None
+
+    def file_at(self, offset):
+        """
+        None, as there is no file with the data (see Data.file_at).
+        """
+        return None
+
+    def write(self, data, offset):
+        raise io.UnsupportedOperation('Compressed data can not be written')
@@ -0,0 +1,148 @@
+"""
+Metadata index for the filesystem storage.
+
+Listing a big storage by opening and unpickling every .meta file is slow,
+so we additionally keep a copy of all items' metadata in an SQLite database.
+It is updated whenever metadata is written or an item is removed. The .meta
+files stay authoritative, the index can be rebuilt from them at any time.
+"""
+
+import logging
+import pickle
+import sqlite3
+
+from ...constants import (
+    COMPLETE,
+    LOCKED,
+    SIZE,
+    TIMESTAMP_DOWNLOAD,
+    TIMESTAMP_MAX_LIFE,
+    TIMESTAMP_UPLOAD,
+)
+from ...utils.process import SQLiteConnections
+
+logger = logging.getLogger(__name__)
+
+# last use of an item: its last download or (if there was none) its upload
+LAST_USE = 'MAX(COALESCE(timestamp_download, 0), COALESCE(timestamp_upload, 0))'
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS items (
+        name TEXT PRIMARY KEY,
+        size INTEGER,
+        complete INTEGER,
+        locked INTEGER,
+        timestamp_upload INTEGER,
+        timestamp_download INTEGER,
+        timestamp_max_life INTEGER,
+        meta BLOB
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS items_timestamp_upload ON items (timestamp_upload)",
+    "CREATE INDEX IF NOT EXISTS items_timestamp_max_life ON items (timestamp_max_life)",
+    "CREATE INDEX IF NOT EXISTS items_last_use ON items (%s)" % LAST_USE,
+]
+
+
+class MetaIndex:
+    """
+    SQLite database with one row per storage item.
+
+    Besides the pickled metadata, the values we need for sorting and
+    selecting items are kept in separate (indexed) columns.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._connections = SQLiteConnections(path)
+        with self._connections.get() as conn:
+            for statement in SCHEMA:
+                conn.execute(statement)
+
+    def update(self, name, meta):
+        """
+        Insert or replace the index entry for item <name> with metadata <meta>.
+        """
+        row = (
+            name,
+            meta.get(SIZE),
+            meta.get(COMPLETE),
+            meta.get(LOCKED),
+            meta.get(TIMESTAMP_UPLOAD),
+            meta.get(TIMESTAMP_DOWNLOAD),
+            meta.get(TIMESTAMP_MAX_LIFE),
+            pickle.dumps(dict(meta), protocol=2),
+        )
+        try:
+            with self._connections.get() as conn:
+                conn.execute('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)', row)
+        except sqlite3.Error as e:
+            # the .meta file was written, so a reindex can fix this later.
+            logger.error("Could not update metadata index for %s: %s", name, e)
+
+    def remove(self, name):
+        """
+        Remove the index entry for item <name> (if any).
+        """
+        try:
+            with self._connections.get() as conn:
+                conn.execute('DELETE FROM items WHERE name = ?', (name, ))
+        except sqlite3.Error as e:
+            logger.error("Could not remove %s from metadata index: %s", name, e)
+
+    def clear(self):
+        """
+        Remove all index entries.
+        """
+        with self._connections.get() as conn:
+            conn.execute('DELETE FROM items')
+
+    def items(self):
+        """
+        Iterate over (name, meta) of all indexed items, most recent uploads first.
+        """
+        cursor = self._connections.get().execute(
+            'SELECT name, meta FROM items ORDER BY timestamp_upload DESC')
+        for name, meta in cursor:
+            yield name, pickle.loads(meta)
+
+    def expired(self, now, limit):
+        """
+        Return names of up to <limit> items whose maximum lifetime is over at <now>, most overdue first.
+        """
+        cursor = self._connections.get().execute(
+            'SELECT name FROM items WHERE timestamp_max_life > 0 AND timestamp_max_life < ? '
+            'ORDER BY timestamp_max_life LIMIT ?', (now, limit))
+        return [name for name, in cursor]
+
+    def next_expiry(self):
+        """
+        Return the earliest end of a maximum lifetime (or None if no item has one).
+        """
+        cursor = self._connections.get().execute(
+            'SELECT MIN(timestamp_max_life) FROM items WHERE timestamp_max_life > 0')
+        return cursor.fetchone()[0]
+
+    def least_recently_used(self, limit, size_weighted=False, now=None):
+        """
+        Return (name, size) of up to <limit> complete, unlocked items, least recently used first.
+
+        The last use is the last download (or the upload, if there was none).
+        With <size_weighted>, the time since the last use is multiplied by the
+        size, so big items go first.
+        """
+        if size_weighted:
+            order, params = '(? - %s) * size DESC' % LAST_USE, (now, limit)
+        else:
+            order, params = LAST_USE, (limit, )
+        cursor = self._connections.get().execute(
+            'SELECT name, size FROM items WHERE complete AND NOT COALESCE(locked, 0) '
+            'ORDER BY ' + order + ' LIMIT ?', params)
+        return cursor.fetchall()
+
+    def __contains__(self, name):
+        cursor = self._connections.get().execute('SELECT 1 FROM items WHERE name = ?', (name, ))
+        return cursor.fetchone() is not None
+
+    def __len__(self):
+        return self._connections.get().execute('SELECT COUNT(*) FROM items').fetchone()[0]
@@ -1,28 +1,50 @@
-from os import close, unlink
 from random import random
-from tempfile import mkstemp
 
 import pytest
 
 from bepasty.app import create_app
+from bepasty.config import Config
 
 
-@pytest.fixture(scope='module')
-def app(request):
+@pytest.fixture
+def app_config():
     """
-    Create a bepasty app instance.
+    Config values (overriding bepasty.config.Config) for the app fixture.
+
+    Override this fixture in a test module to change them for its tests
+    (values read by create_app need to be set here, others may also be set
+    in app.config by the tests).
+    """
+    return {}
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch, app_config):
+    """
+    Create a bepasty app instance, with the storage in a temporary directory.
+
+    Token 'secret' gives all permissions, everybody may read.
     """
+    config = {
+        'STORAGE_FILESYSTEM_DIRECTORY': str(tmp_path),
+        'PERMISSIONS': {'secret': 'admin,list,create,modify,read,delete'},
+        'DEFAULT_PERMISSIONS': 'read',
+    }
+    config.update(app_config)
+    for key, value in config.items():
+        monkeypatch.setattr(Config, key, value)
     app = create_app()
+    app.config['TESTING'] = True
     yield app
-    unlink(app.config['DATABASE'])
+    app.download_timestamps.stop()
+    app.worker_pool.close()
 
 
-@pytest.fixture(scope='module')
-def testclient(request, app):
+@pytest.fixture
+def testclient(app):
     """
     Create a Flask test client instance for bepasty.
     """
-    db_file, app.config['DATABASE'] = mkstemp()
     # reset default permissions
     app.config['DEFAULT_PERMISSIONS'] = ''
     # set up a secret key
@@ -35,5 +57,36 @@ def testclient(request, app):
         'd': 'delete',
         'a': 'admin'
     }
-    yield app.test_client()
-    close(db_file)
+    return app.test_client()
+
+
+def upload(client, form):
+    """
+    Upload an item with the web form fields <form> (using the 'secret' token).
+
+    Waits until the background jobs for the item are done, so tests see their
+    results.
+
+    :return: the item name
+    """
+    response = client.post('/+upload?token=secret', data=form)
+    assert response.status_code == 302
+    client.application.jobs.join()
+    return response.location.split('/')[-1].split('#')[0]
+
+
+def upload_text(client, text='hello world', contenttype='text/plain', filename='test.txt', **fields):
+    """
+    Upload <text> as item (see upload), with more form <fields> (e.g. maxlife-unit).
+    """
+    return upload(client, dict(fields, text=text, contenttype=contenttype, filename=filename))
+
+
+def get(client, url, **kwargs):
+    """
+    GET <url> and read and close the response (streamed responses must be
+    consumed, so the app is done with them).
+    """
+    with client.get(url, **kwargs) as response:
+        response.get_data()
+    return response
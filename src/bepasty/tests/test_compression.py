@@ -0,0 +1,150 @@
+import gzip
+import random
+import string
+
+import pytest
+from werkzeug.wsgi import FileWrapper
+
+from ..utils import compression
+from .conftest import get, upload_text
+
+
+@pytest.fixture
+def app_config():
+    return {'PRECOMPRESS_ENCODINGS': ['gzip'], 'PRECOMPRESS_MIN_SIZE': 100, 'RESPONSE_COMPRESS_ENCODINGS': ['gzip']}
+
+
+TEXT = ''.join('line %d\n' % i for i in range(1000))
+
+
+@pytest.mark.parametrize('url', ['/{}/+download', '/{}/+inline', '/apis/rest/items/{}/download'])
+def test_precompressed(app, url):
+    with app.test_client() as client:
+        name = upload_text(client, TEXT)
+        url = url.format(name)
+        response = get(client, url, headers={'Accept-Encoding': 'gzip, deflate'})
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        assert int(response.headers['Content-Length']) == len(response.data) < len(TEXT)
+        assert gzip.decompress(response.data) == TEXT.encode()
+        etag = response.headers['ETag']
+        assert etag.endswith('-gzip"')
+        response = get(client, url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        assert response.status_code == 304
+
+        for accept_encoding in [None, 'identity', 'gzip;q=0, deflate']:
+            headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+            response = get(client, url, headers=headers)
+            assert 'Content-Encoding' not in response.headers
+            assert response.headers['Vary'] == 'Accept-Encoding'
+            assert response.data == TEXT.encode()
+            assert response.headers['ETag'] != etag
+            # the client has the other representation
+            response = get(client, url, headers=dict(headers, **{'If-None-Match': etag}))
+            assert response.status_code == 200
+
+        # Range requests get the data as it is
+        response = get(client, url, headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=0-6'})
+        assert response.status_code == 206
+        assert 'Content-Encoding' not in response.headers
+        assert response.data == b'line 0\n'
+
+
+def test_not_precompressed(app, monkeypatch):
+    with app.test_client() as client:
+        # too small
+        name = upload_text(client, 'hello')
+        response = get(client, f'/{name}/+download', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+        assert 'Vary' not in response.headers
+
+        # does not compress well enough
+        monkeypatch.setattr(compression, 'MAX_RATIO', 0.5)
+        rng = random.Random(0)
+        text = ''.join(rng.choice(string.ascii_letters) for _ in range(1000))
+        name = upload_text(client, text)
+        response = get(client, f'/{name}/+download', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+        assert response.data == text.encode()
+
+
+def test_precompress_disabled(app):
+    app.config['PRECOMPRESS_ENCODINGS'] = []
+    with app.test_client() as client:
+        name = upload_text(client, TEXT)
+        with app.storage.open(name) as item:
+            assert app.storage.read_sidecar(name, 'gzip', item.meta['hash']) is None
+        response = get(client, f'/{name}/+download', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+
+
+def test_compressed_at_rest(app, tmp_path):
+    app.config['STORAGE_FILESYSTEM_COMPRESS'] = 'zlib'
+    app.config['PRECOMPRESS_ENCODINGS'] = []
+    with app.test_client() as client:
+        name = upload_text(client, TEXT)
+        assert not (tmp_path / f'{name}.data').exists()
+        assert (tmp_path / f'{name}.datz').stat().st_size < len(TEXT)
+        response = get(client, f'/{name}/+download', environ_overrides={'wsgi.file_wrapper': FileWrapper})
+        assert response.data == TEXT.encode()
+        response = get(client, f'/{name}/+download', headers={'Range': 'bytes=7-13'})
+        assert response.status_code == 206
+        assert response.data == b'line 1\n'
+        app.config['DOWNLOAD_OFFLOAD'] = 'x-sendfile'
+        response = get(client, f'/{name}/+download')
+        assert 'X-Sendfile' not in response.headers
+        assert response.data == TEXT.encode()
+        response = get(client, f'/{name}/+lines?start=2&end=2')
+        assert response.data == b'line 1\n'
+
+
+def test_compressed_response(app):
+    with app.test_client() as client:
+        name = upload_text(client, TEXT)
+        response = get(client, f'/{name}', headers={'Accept-Encoding': 'gzip'})
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        assert int(response.headers['Content-Length']) == len(response.data)
+        assert b'line 999' in gzip.decompress(response.data)
+
+        response = get(client, f'/{name}')
+        assert 'Content-Encoding' not in response.headers
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        assert b'line 999' in response.data
+
+        # too small
+        response = get(client, '/apis/rest', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+
+        app.config['RESPONSE_COMPRESS_ENCODINGS'] = []
+        response = get(client, f'/{name}', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+
+
+def test_compressed_response_streamed(app):
+    app.config['HIGHLIGHT_STREAM_SIZE'] = 10
+    app.config['PRECOMPRESS_ENCODINGS'] = []
+    with app.test_client() as client:
+        name = upload_text(client, TEXT)
+        with client.get(f'/{name}', headers={'Accept-Encoding': 'gzip'}) as response:
+            assert response.is_streamed
+            assert response.headers['Content-Encoding'] == 'gzip'
+            assert b'line 999' in gzip.decompress(response.get_data())
+
+            assert len(response.response) < 10
+
+        # downloads are not compressed on the fly
+        response = get(client, f'/{name}/+download', headers={'Accept-Encoding': 'gzip'})
+        assert 'Content-Encoding' not in response.headers
+        assert response.data == TEXT.encode()
+
+
+def test_compress_chunks(monkeypatch):
+    monkeypatch.setattr(compression, 'FLUSH_SIZE', 100)
+    chunks = ['line %d\n' % i for i in range(100)]
+    pieces = list(compression.compress_chunks(chunks, compression.GzipCompressor()))
+    # small chunks are collected, not flushed one by one
+    assert 1 < len(pieces) < 10
+    assert gzip.decompress(b''.join(pieces)) == ''.join(chunks).encode()
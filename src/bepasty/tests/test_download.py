@@ -0,0 +1,121 @@
+import time
+
+import pytest
+
+from .conftest import get, upload_text
+
+
+@pytest.mark.parametrize('url', ['/{}/+download', '/{}/+inline', '/apis/rest/items/{}/download'])
+def test_conditional(app, url):
+    with app.test_client() as client:
+        name = upload_text(client)
+        with app.storage.open(name) as item:
+            file_hash = item.meta['hash']
+        url = url.format(name)
+        response = get(client, url)
+        assert response.status_code == 200
+        assert response.headers['ETag'] == f'"{file_hash}"'
+        assert response.headers['Last-Modified']
+        assert response.cache_control.public
+        assert response.cache_control.max_age == app.config['DOWNLOAD_CACHE_MAX_AGE']
+
+        response = get(client, url, headers={'If-None-Match': f'"{file_hash}"'})
+        assert response.status_code == 304
+        assert response.data == b''
+        assert response.headers['ETag'] == f'"{file_hash}"'
+
+        response = get(client, url, headers={'If-None-Match': '"other"'})
+        assert response.status_code == 200
+        assert response.data == b'hello world'
+
+        last_modified = get(client, url).headers['Last-Modified']
+        response = get(client, url, headers={'If-Modified-Since': last_modified})
+        assert response.status_code == 304
+
+
+def test_cache_control(app):
+    with app.test_client() as client:
+        name = upload_text(client, **{'maxlife-unit': 'MINUTES', 'maxlife-value': 10})
+        response = get(client, f'/{name}/+download')
+        assert 590 <= response.cache_control.max_age <= 600
+
+        client.post(f'/{name}/+lock?token=secret')
+        response = get(client, f'/{name}/+download?token=secret')
+        assert response.cache_control.private
+        assert not response.cache_control.public
+
+
+def test_cache_control_private(app):
+    app.config['DEFAULT_PERMISSIONS'] = ''
+    with app.test_client() as client:
+        name = upload_text(client)
+        response = get(client, f'/{name}/+download?token=secret')
+        assert response.status_code == 200
+        assert response.cache_control.private
+
+
+def test_thumbnail_placeholder_not_conditional(app):
+    with app.test_client() as client:
+        name = upload_text(client)
+        etag = get(client, f'/{name}/+download').headers['ETag']
+        # a text item has the placeholder thumbnail, which is not the item data
+        response = get(client, f'/{name}/+thumbnail')
+        assert 'ETag' not in response.headers
+        assert get(client, f'/{name}/+thumbnail', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_not_modified_records_download(app):
+    with app.test_client() as client:
+        name = upload_text(client)
+        etag = get(client, f'/{name}/+download').headers['ETag']
+        app.download_timestamps.flush()
+        with app.storage.openwrite(name) as item:
+            item.meta['timestamp-download'] = 0
+        before = int(time.time())
+        get(client, f'/{name}/+download', headers={'If-None-Match': etag})
+        app.download_timestamps.flush()
+        with app.storage.open(name) as item:
+            assert item.meta['timestamp-download'] >= before
+
+
+@pytest.mark.parametrize('url', ['/{}/+download', '/{}/+inline', '/apis/rest/items/{}/download'])
+def test_range(app, url):
+    with app.test_client() as client:
+        name = upload_text(client)
+        url = url.format(name)
+        response = get(client, url)
+        assert response.headers['Accept-Ranges'] == 'bytes'
+
+        response = get(client, url, headers={'Range': 'bytes=-5'})
+        assert response.status_code == 206
+        assert response.data == b'world'
+        assert response.headers['Content-Range'] == 'bytes 6-10/11'
+        assert response.headers['ETag']
+
+        response = get(client, url, headers={'Range': 'bytes=0-1,6-7'})
+        assert response.status_code == 206
+        assert response.mimetype == 'multipart/byteranges'
+        assert b'Content-Range: bytes 0-1/11\r\n\r\nhe\r\n' in response.data
+        assert b'Content-Range: bytes 6-7/11\r\n\r\nwo\r\n' in response.data
+
+        response = get(client, url, headers={'Range': 'bytes=20-'})
+        assert response.status_code == 416
+        assert response.headers['Content-Range'] == 'bytes */11'
+
+
+def test_if_range(app):
+    with app.test_client() as client:
+        name = upload_text(client)
+        url = f'/{name}/+download'
+        response = get(client, url)
+        etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+
+        for if_range in [etag, last_modified]:
+            response = get(client, url, headers={'Range': 'bytes=0-4', 'If-Range': if_range})
+            assert response.status_code == 206
+            assert response.data == b'hello'
+
+        for if_range in ['"other"', 'W/' + etag, 'Thu, 01 Jan 1970 00:00:00 GMT']:
+            response = get(client, url, headers={'Range': 'bytes=0-4', 'If-Range': if_range})
+            assert response.status_code == 200
+            assert response.data == b'hello world'
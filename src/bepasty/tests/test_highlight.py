@@ -0,0 +1,153 @@
+import pytest
+from pygments.lexers import PythonLexer
+
+from ..utils.formatters import BlockHtmlFormatter
+from ..utils.highlight import FORMATTER_OPTIONS, HighlightCache
+from .conftest import upload_text
+
+CODE = 'print("hello")\n'
+
+
+def test_highlight_cache_lru():
+    cache = HighlightCache(10)
+    cache.put('a', 'k', 'aaaa')
+    cache.put('b', 'k', 'bbbb')
+    assert cache.get('a', 'k') == 'aaaa'  # now b is least recently used
+    cache.put('c', 'k', 'cccc')
+    assert cache.get('b', 'k') is None
+    assert cache.get('a', 'k') == 'aaaa'
+    assert cache.get('c', 'k') == 'cccc'
+    assert cache.size == 8
+    cache.put('d', 'k', 'd' * 11)  # too big to cache
+    assert cache.get('d', 'k') is None
+    cache.invalidate('a')
+    assert cache.get('a', 'k') is None
+    assert cache.size == 4
+
+
+def test_highlight_cached(app, monkeypatch):
+    with app.test_client() as client:
+        name = upload_text(client, CODE, contenttype='text/x-python')
+        response = client.get(f'/{name}')
+        assert response.status_code == 200
+        assert b'<span class="nb">print</span>' in response.data
+
+        def render_highlighted(*args, **kwargs):
+            raise AssertionError('HTML should be cached')
+        monkeypatch.setattr('bepasty.utils.highlight.render_highlighted', render_highlighted)
+        assert client.get(f'/{name}').data == response.data
+
+
+def test_highlight_persisted(app, monkeypatch):
+    app.config['HIGHLIGHT_CACHE_PERSIST'] = True
+    app.highlight_cache = HighlightCache(1000 * 1000, app.storage)
+    with app.test_client() as client:
+        name = upload_text(client, CODE, contenttype='text/x-python')
+        response = client.get(f'/{name}')
+
+        # a new process, with an empty cache in memory
+        app.highlight_cache = HighlightCache(1000 * 1000, app.storage)
+
+        def render_highlighted(*args, **kwargs):
+            raise AssertionError('HTML should be cached')
+        monkeypatch.setattr('bepasty.utils.highlight.render_highlighted', render_highlighted)
+        assert client.get(f'/{name}').data == response.data
+
+
+def test_highlight_type_changed(app):
+    with app.test_client() as client:
+        name = upload_text(client, CODE, contenttype='text/x-python')
+        response = client.get(f'/{name}')
+        assert b'<span class="nb">print</span>' in response.data
+        client.post(f'/{name}/+modify?token=secret', data={'contenttype': 'text/plain'})
+        response = client.get(f'/{name}')
+        assert b'<span class="nb">print</span>' not in response.data
+
+
+@pytest.mark.parametrize('error', [TimeoutError(), RuntimeError('Worker process died')])
+def test_highlight_timeout(app, monkeypatch, error):
+    def run(timeout, func, *args):
+        raise error
+    monkeypatch.setattr(app.worker_pool, 'run', run)
+    with app.test_client() as client:
+        name = upload_text(client, CODE, contenttype='text/x-python')
+        response = client.get(f'/{name}')
+        assert response.status_code == 200
+        # plain text, with line numbers
+        assert b'<span class="nb">print</span>' not in response.data
+        assert b'print(&quot;hello&quot;)' in response.data
+        assert b'<a href="#L-1">1</a>' in response.data
+    stats = app.highlight_stats.stats()['text/x-python']
+    assert stats['renders'] == 1
+    assert stats['timeouts'] == 1
+
+
+def test_highlight_stats(app):
+    with app.test_client() as client:
+        name = upload_text(client, CODE, contenttype='text/x-python')
+        client.get(f'/{name}')
+    stats = app.highlight_stats.stats()['text/x-python']
+    assert stats['renders'] == 1
+    assert stats['timeouts'] == 0
+    assert stats['size'] == len(CODE)
+    assert stats['time'] > 0
+
+
+def test_block_formatter():
+    text = ''.join('x = %d\n' % i for i in range(1, 26))
+    formatter = BlockHtmlFormatter(lines_per_block=10, **FORMATTER_OPTIONS)
+    blocks = list(formatter.format_blocks(PythonLexer().get_tokens(text)))
+    assert len(blocks) == 3
+    assert blocks[0].count('<p id=') == 10
+    assert blocks[2].count('<p id=') == 5
+    assert 'id="L-11"' in blocks[1]
+    assert formatter.linenostart == 1
+
+
+def test_highlight_streamed(app):
+    app.config['HIGHLIGHT_STREAM_SIZE'] = 10
+    text = ''.join('print(%d)\n' % i for i in range(1, 2001))
+    with app.test_client() as client:
+        name = upload_text(client, text, contenttype='text/x-python')
+        response = client.get(f'/{name}')
+        assert response.status_code == 200
+        assert response.is_streamed
+        assert response.data.count(b'<span class="nb">print</span>') == 2000
+        assert response.data.count(b'<table class="highlighttable">') == 2
+        assert b'id="L-2000"' in response.data
+        # rendered once, then sent from the sidecar file
+        assert client.get(f'/{name}').data == response.data
+    assert app.highlight_stats.stats()['text/x-python']['renders'] == 1
+
+
+def test_highlight_streamed_timeout(app):
+    app.config['HIGHLIGHT_STREAM_SIZE'] = 10
+    app.config['HIGHLIGHT_TIMEOUT'] = 0
+    text = ''.join('print(%d)\n' % i for i in range(1, 101))
+    with app.test_client() as client:
+        name = upload_text(client, text, contenttype='text/x-python')
+        response = client.get(f'/{name}')
+        # the first token is highlighted, the rest is plain text
+        assert response.data.count(b'<span class="nb">print</span>') == 1
+        assert b'print(100)' in response.data
+        assert b'id="L-100"' in response.data
+    assert app.highlight_stats.stats()['text/x-python']['timeouts'] == 1
+
+
+@pytest.mark.parametrize('error', [TimeoutError(), RuntimeError('Worker process died')])
+def test_highlight_streamed_killed(app, monkeypatch, error):
+    app.config['HIGHLIGHT_STREAM_SIZE'] = 10
+    run = app.worker_pool.run
+
+    def run_too_long(timeout, func, *args):
+        if 'text/x-python' in args:
+            raise error
+        return run(timeout, func, *args)
+    monkeypatch.setattr(app.worker_pool, 'run', run_too_long)
+    with app.test_client() as client:
+        name = upload_text(client, CODE, contenttype='text/x-python')
+        response = client.get(f'/{name}')
+        # plain text
+        assert b'<span class="nb">print</span>' not in response.data
+        assert b'print(&quot;hello&quot;)' in response.data
+    assert app.highlight_stats.stats()['text/x-python']['timeouts'] == 1
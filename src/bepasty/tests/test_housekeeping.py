@@ -0,0 +1,136 @@
+import time
+from types import SimpleNamespace
+
+from bepasty.constants import TIMESTAMP_MAX_LIFE
+from bepasty.storage.filesystem import Storage
+from bepasty.utils.housekeeping import Housekeeper, create_housekeeper
+
+
+def create_items(storage, max_lifes):
+    for name, max_life in max_lifes.items():
+        with storage.create(name, 0) as item:
+            item.meta[TIMESTAMP_MAX_LIFE] = max_life
+
+
+def test_expire(tmpdir):
+    storage = Storage(str(tmpdir), index=True)
+    now = int(time.time())
+    create_items(storage, {
+        'forever': -1,
+        'expired1': now - 100,
+        'expired2': now - 200,
+        'expired3': now - 300,
+        'later': now + 100,
+    })
+    housekeeper = Housekeeper(storage, interval=3600, batch_size=2)
+    # most overdue items first
+    assert housekeeper.expire() == 2
+    assert set(storage) == {'forever', 'expired1', 'later'}
+    # removed by somebody else, but still in the index
+    Storage(str(tmpdir)).remove('expired1')
+    assert housekeeper.expire() == 1
+    assert 'expired1' not in storage.index
+    assert housekeeper.expire() == 0
+    assert set(storage) == {'forever', 'later'}
+    # sleep until "later" expires
+    assert 99 < housekeeper.run_once() <= 101
+
+
+def test_thread(tmpdir):
+    storage = Storage(str(tmpdir), index=True)
+    create_items(storage, {'expired': int(time.time()) - 1})
+    housekeeper = Housekeeper(storage)
+    housekeeper.start()
+    try:
+        for _ in range(100):
+            if 'expired' not in storage:
+                break
+            time.sleep(0.05)
+        assert 'expired' not in storage
+    finally:
+        housekeeper.stop()
+
+
+def create_complete_items(storage, items):
+    for name, (size, upload, download, locked) in items.items():
+        with storage.create(name, 0) as item:
+            item.meta.update({'size': size, 'complete': True, 'locked': locked,
+                              'timestamp-upload': upload, 'timestamp-download': download,
+                              TIMESTAMP_MAX_LIFE: -1})
+
+
+def test_evict(tmpdir, monkeypatch):
+    storage = Storage(str(tmpdir), index=True)
+    items = {
+        # name: (size, upload, download, locked)
+        'old': (100, 10, 0, False),
+        'old-locked': (100, 5, 0, True),
+        'downloaded': (100, 10, 50, False),
+        'middle': (100, 30, 0, False),
+        'recent': (100, 40, 0, False),
+    }
+    create_complete_items(storage, items)
+    sizes = {name: size for name, (size, *_) in items.items()}
+    sizes['big'] = 1000
+    # disk usage by other files
+    usage = {'other': 350}
+
+    def disk_usage(path):
+        used = usage['other'] + sum(sizes[name] for name in storage)
+        return SimpleNamespace(total=1000, used=used, free=1000 - used)
+
+    monkeypatch.setattr('bepasty.utils.housekeeping.shutil.disk_usage', disk_usage)
+    housekeeper = Housekeeper(storage, high_watermark=0.9, low_watermark=0.7)
+    # below high watermark
+    assert housekeeper.evict() == 0
+    # least recently used first, until below low watermark
+    usage['other'] = 450
+    assert housekeeper.evict() == 3
+    assert set(storage) == {'old-locked', 'downloaded'}
+    # size weighted: big items go first
+    create_complete_items(storage, items)
+    create_complete_items(storage, {'big': (1000, 45, 0, False)})
+    usage['other'] = 200
+    housekeeper.size_weighted = True
+    assert housekeeper.evict() == 1
+    assert set(storage) == set(items)
+
+
+def test_evict_flush(tmpdir, monkeypatch):
+    storage = Storage(str(tmpdir), index=True)
+    create_complete_items(storage, {
+        'old': (100, 10, 0, False),
+        'recent': (100, 40, 0, False),
+    })
+
+    def flush():
+        # 'old' was downloaded, but the timestamp was not written yet
+        with storage.openlocked('old') as item:
+            item.meta['timestamp-download'] = 50
+
+    monkeypatch.setattr('bepasty.utils.housekeeping.shutil.disk_usage',
+                        lambda path: SimpleNamespace(total=1000, used=800 + 100 * len(list(storage)), free=0))
+    housekeeper = Housekeeper(storage, high_watermark=0.9, low_watermark=0.9, flush=flush)
+    assert housekeeper.evict() == 1
+    assert set(storage) == {'old'}
+
+
+def test_lead(tmpdir):
+    storage = Storage(str(tmpdir), index=True)
+    housekeeper = Housekeeper(storage)
+    other = Housekeeper(storage)
+    try:
+        assert housekeeper.lead()
+        assert housekeeper.lead()
+        # only one of them does the work
+        assert not other.lead()
+        housekeeper.stop()
+        assert other.lead()
+    finally:
+        other.stop()
+
+
+def test_evict_without_index(tmpdir, caplog):
+    app = SimpleNamespace(storage=Storage(str(tmpdir)), config={'EVICTION_HIGH_WATERMARK': 0.9})
+    assert create_housekeeper(app) is None
+    assert 'items are not evicted' in caplog.text
@@ -1,7 +1,7 @@
 import pytest
-from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import BadRequest, RequestedRangeNotSatisfiable
 
-from bepasty.utils.http import ContentRange
+from bepasty.utils.http import ContentRange, DownloadRange
 
 
 def test_contentrange_parse():
@@ -27,3 +27,28 @@ def test_contentrange_parse():
 
     with pytest.raises(BadRequest):
         ContentRange.parse('bytes 0-2/2')
+
+
+def test_downloadrange_parse():
+    assert DownloadRange.parse('bytes=0-9', 100) == [(0, 9)]
+    assert DownloadRange.parse('bytes=90-', 100) == [(90, 99)]
+    assert DownloadRange.parse('bytes=-10', 100) == [(90, 99)]
+    assert DownloadRange.parse('bytes=-200', 100) == [(0, 99)]
+    assert DownloadRange.parse('bytes=90-200', 100) == [(90, 99)]
+    assert DownloadRange.parse('bytes=0-9, 50-59', 100) == [(0, 9), (50, 59)]
+    # ordered, overlapping and adjacent ranges merged
+    assert DownloadRange.parse('bytes=50-59,0-9,5-19,20-29', 100) == [(0, 29), (50, 59)]
+    # unsatisfiable ranges are dropped
+    assert DownloadRange.parse('bytes=0-9,200-', 100) == [(0, 9)]
+    assert DownloadRange.parse('bytes=0-9', 100)[0].size == 10
+    assert DownloadRange(0, 9).content_range(100) == 'bytes 0-9/100'
+
+    # ignored
+    for download_range in ['other', 'bytes=invalid', 'other=0-9', 'bytes=x-9', 'bytes=0-x', 'bytes=-',
+                           'bytes=9-0', 'bytes=\u00b2-', 'bytes=0-\u0661', 'bytes=0-9,9-0',
+                           'bytes=', ','.join(['bytes=0-0'] * (DownloadRange.max_ranges + 1))]:
+        assert DownloadRange.parse(download_range, 100) is None
+
+    for download_range in ['bytes=100-', 'bytes=-0']:
+        with pytest.raises(RequestedRangeNotSatisfiable):
+            DownloadRange.parse(download_range, 100)
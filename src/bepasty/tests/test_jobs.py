@@ -0,0 +1,126 @@
+import os
+import threading
+import time
+
+import pytest
+from flask import Flask
+
+from ..utils import jobs
+from ..utils.jobs import PRIORITY_HIGH, PRIORITY_LOW, JobJournal, JobQueue, background, owner_alive, owner_token
+
+results = []
+blocker = threading.Event()
+
+
+@background()
+def block():
+    blocker.wait(10)
+
+
+@background(priority=PRIORITY_LOW)
+def low(value):
+    results.append(value)
+
+
+@background(priority=PRIORITY_HIGH)
+def high(value):
+    results.append(value)
+
+
+@background()
+def fail():
+    raise ValueError
+
+
+def test_priority():
+    app = Flask(__name__)
+    app.jobs = JobQueue(app, workers=1)
+    results.clear()
+    blocker.clear()
+    with app.app_context():
+        block()  # keep the only worker busy while we queue the other jobs
+        low(1)
+        low(2)
+        high(3)
+        fail()
+        stats = app.jobs.stats()
+        assert stats['queued'] + stats['running'] == 5
+        blocker.set()
+        app.jobs.join()
+    assert results == [3, 1, 2]
+    stats = app.jobs.stats()
+    assert stats['queued'] == stats['running'] == 0
+    assert stats['done'] == 5
+    assert stats['failed'] == 1
+
+
+def test_journal(tmp_path, monkeypatch):
+    path = str(tmp_path / 'jobs.sqlite')
+    journal = JobJournal(path)
+    # jobs of a process that went away
+    journal.add(PRIORITY_LOW, 'bepasty.tests.test_jobs.low', [1], 0.0)
+    monkeypatch.setattr(os, 'getpid', lambda: 2 ** 22 + 1)
+    journal.add(PRIORITY_LOW, 'bepasty.tests.test_jobs.low', [2], 0.0)
+    monkeypatch.undo()
+    monkeypatch.setattr('bepasty.utils.jobs.pid_alive', lambda pid: pid == os.getpid())
+
+    app = Flask(__name__)
+    results.clear()
+    app.jobs = JobQueue(app, journal=JobJournal(path))
+    app.jobs.take_over()
+    app.jobs.join()
+    # only the job of the dead process was resumed, and it is done now
+    assert results == [2]
+    monkeypatch.setattr('bepasty.utils.jobs.os.getpid', lambda: 2 ** 22 + 2)
+    assert JobJournal(path).take_over() == [(1, PRIORITY_LOW, 'bepasty.tests.test_jobs.low', [1], 0.0)]
+
+
+def test_owner_token(monkeypatch):
+    token = owner_token()
+    assert token.startswith(f'{os.getpid()}:')
+    assert owner_alive(token)
+    # old journals have just the pid
+    assert owner_alive(os.getpid())
+    # another process got the pid
+    monkeypatch.setattr(jobs, 'process_start_time', lambda pid: 42)
+    assert not owner_alive(token)
+
+
+def test_journal_take_over_periodically(tmp_path, monkeypatch):
+    path = str(tmp_path / 'jobs.sqlite')
+    app = Flask(__name__)
+    results.clear()
+    app.jobs = JobQueue(app, journal=JobJournal(path))
+    app.jobs.take_over()
+    # the process owning this job goes away later
+    monkeypatch.setattr(os, 'getpid', lambda: 2 ** 22 + 1)
+    JobJournal(path).add(PRIORITY_LOW, 'bepasty.tests.test_jobs.low', [1], 0.0)
+    monkeypatch.undo()
+    app.jobs.take_over(min_interval=60)
+    app.jobs.join()
+    assert results == []
+    app.jobs.take_over()
+    app.jobs.join()
+    assert results == [1]
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs os.fork')
+def test_fork():
+    app = Flask(__name__)
+    app.jobs = JobQueue(app, workers=1)
+    blocker.clear()
+    with app.app_context():
+        block()  # keeps the worker thread of this process busy
+        pid = os.fork()
+        if not pid:
+            # that thread does not exist in the child, which needs a worker thread of its own
+            results.clear()
+            low(1)
+            deadline = time.time() + 10
+            while not results and time.time() < deadline:
+                time.sleep(0.01)
+            os._exit(0 if results == [1] else 1)
+        blocker.set()
+        app.jobs.join()
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
@@ -0,0 +1,38 @@
+import pytest
+from pygments.lexers import PythonLexer, get_lexer_for_filename
+from pygments.util import ClassNotFound
+
+from ..utils.lexers import LexerRegistry
+
+
+@pytest.fixture(scope='module')
+def registry():
+    return LexerRegistry()
+
+
+@pytest.mark.parametrize('filename', [
+    'test.py', 'Makefile', 'CMakeLists.txt', 'foo.h', 'archive.tar.gz', 'a.b.c.js', '.bashrc', 'README', 'x.unknown',
+])
+def test_contenttype_for_filename(registry, filename):
+    try:
+        lexer = get_lexer_for_filename(filename)
+    except ClassNotFound:
+        expected = None
+    else:
+        expected = lexer.mimetypes[0] if lexer.mimetypes else None
+    assert registry.contenttype_for_filename(filename) == expected
+
+
+def test_registry(registry):
+    assert registry.has_mimetype('text/x-python')
+    assert not registry.has_mimetype('text/x-bepasty-redirect')
+    assert registry.contenttypes[0] == 'text/x-bepasty-redirect'
+    assert '"text/x-python"' in registry.contenttypes_json
+    assert registry.contenttype_for_alias('python') == 'text/x-python'
+    assert registry.contenttype_for_alias('nonexistent') is None
+    lexer = registry.lexer('text/x-python')
+    assert isinstance(lexer, PythonLexer)
+    assert registry.lexer('text/x-python') is lexer
+    assert registry.lexer('text/x-python', stripnl=False) is not lexer
+    with pytest.raises(KeyError):
+        registry.lexer('application/octet-stream')
@@ -0,0 +1,122 @@
+from io import BytesIO
+import threading
+
+import pytest
+
+from ..storage.filesystem import Data
+from ..utils import lines
+from ..utils.lines import LineIndex, LineIndexCache, get_line_index
+from .conftest import upload_text
+
+
+@pytest.mark.parametrize('text', [
+    b'',
+    b'\n',
+    b'one line',
+    b'one line\n',
+    b'\n'.join(b'line %d' % i for i in range(100)),
+    b'\n'.join(b'line %d' % i for i in range(100)) + b'\n',
+    b'\n' * 50 + b'x' * 1000 + b'\n' * 50,
+])
+def test_line_index(text, monkeypatch):
+    monkeypatch.setattr(lines, 'BLOCK_SIZE', 7)
+    data = Data(BytesIO(text))
+    expected = text.splitlines(keepends=True)
+    index = LineIndex.build(data, step=3)
+    assert index.count == len(expected)
+    index = LineIndex.from_bytes(index.to_bytes())
+    assert index.step == 3
+    for start in range(len(expected) + 2):
+        for end in range(start, len(expected) + 2):
+            begin, limit = index.range(data, start, end)
+            assert text[begin:limit] == b''.join(expected[start:end])
+
+
+def test_get_line_index(app, monkeypatch):
+    monkeypatch.setattr(lines, 'LINE_INDEX_MIN_SIZE', 10)
+    text = 'a line\n' * 100
+    with app.test_client() as client:
+        name = upload_text(client, text)
+    app.jobs.join()
+    with app.storage.open(name) as item:
+        assert app.storage.read_sidecar(name, 'lines', '{}-1000'.format(item.meta['hash'])) is not None
+        monkeypatch.setattr(LineIndex, 'build', None)  # must not be needed now
+        monkeypatch.setattr(lines, 'line_indexes', LineIndexCache())  # nor memory
+        assert get_line_index(app.storage, name, item).count == 100
+
+
+def test_get_line_index_memory(app, monkeypatch):
+    monkeypatch.setattr(lines, 'line_indexes', LineIndexCache(max_entries=1))
+    with app.test_client() as client:
+        name = upload_text(client, 'a line\n' * 10)
+        other_name = upload_text(client, 'a line\n' * 20)
+    with app.storage.open(name) as item:
+        index = get_line_index(app.storage, name, item)
+        # small items have no sidecar file, but we keep the index in memory
+        assert get_line_index(app.storage, name, item) is index
+        with app.storage.open(other_name) as other_item:
+            assert get_line_index(app.storage, other_name, other_item).count == 20
+        # evicted
+        assert get_line_index(app.storage, name, item) is not index
+
+
+def test_lines_view(app):
+    text = ''.join('line %d\n' % i for i in range(1, 101))
+    with app.test_client() as client:
+        name = upload_text(client, text)
+        response = client.get(f'/{name}/+lines?start=10&end=12')
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == 'text/plain'
+        assert response.headers['Line-Count'] == '100'
+        assert response.data == b'line 10\nline 11\nline 12\n'
+
+        response = client.get(f'/{name}/+lines?start=99&end=1000&format=html')
+        assert response.status_code == 200
+        assert b'<p id="L-99">' in response.data
+        assert b'</a>line 100\n' in response.data
+        assert b'line 98' not in response.data
+
+        assert client.get(f'/{name}/+lines?start=0').status_code == 400
+
+
+def test_display_lines(app):
+    app.config['DISPLAY_LINES'] = 10
+    app.render_limits.max_render_size = [('', 100)]
+    app.render_limits.time_budget = None
+    text = ''.join('line %d\n' % i for i in range(1, 101))
+    with app.test_client() as client:
+        name = upload_text(client, text)
+        response = client.get(f'/{name}')
+        assert b'Lines 1 to 10 of 100' in response.data
+        assert b'</a>line 10\n' in response.data
+        assert b'line 11' not in response.data
+        response = client.get(f'/{name}?start=95')
+        assert b'Lines 95 to 100 of 100' in response.data
+        assert b'<p id="L-100">' in response.data
+        assert b'Next lines' not in response.data
+        assert f'href="/{name}?start=85">Previous lines'.encode() in response.data
+
+
+def test_lines_being_indexed(app, monkeypatch):
+    monkeypatch.setattr(lines, 'LINE_INDEX_MIN_SIZE', 10)
+    monkeypatch.setattr(lines, 'line_indexes', LineIndexCache())
+    # the upload does not index the item
+    monkeypatch.setattr('bepasty.utils.upload.background_index_lines', lambda name: None)
+    build = LineIndex.build
+
+    def build_in_job(cls, data, step=lines.LINE_INDEX_STEP):
+        assert threading.current_thread().name == 'bepasty-jobs'
+        return build(data, step)
+    monkeypatch.setattr(LineIndex, 'build', classmethod(build_in_job))
+    app.config['DISPLAY_LINES'] = 10
+    app.render_limits.max_render_size = [('', 100)]
+    app.render_limits.time_budget = None
+    text = ''.join('line %d\n' % i for i in range(1, 101))
+    with app.test_client() as client:
+        name = upload_text(client, text)
+        other_name = upload_text(client, text)
+        assert b'being indexed' in client.get(f'/{name}').data
+        assert client.get(f'/{other_name}/+lines?start=10').status_code == 503
+        app.jobs.join()
+        assert b'Lines 1 to 10 of 100' in client.get(f'/{name}').data
+        assert client.get(f'/{other_name}/+lines?start=10').status_code == 200
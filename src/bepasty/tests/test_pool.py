@@ -0,0 +1,71 @@
+import os
+import threading
+import time
+
+import pytest
+
+from ..utils.pool import WorkerPool
+
+
+def getpid():
+    return os.getpid()
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def sleep_with(data, seconds):
+    time.sleep(seconds)
+
+
+def fail():
+    raise ValueError('failed')
+
+
+@pytest.fixture
+def pool():
+    pool = WorkerPool(processes=1)
+    yield pool
+    pool.close()
+
+
+def test_run(pool):
+    assert pool.run(30, getpid) != os.getpid()
+    with pytest.raises(ValueError):
+        pool.run(30, fail)
+
+
+def test_timeout(pool):
+    pid = pool.run(30, getpid)
+    with pytest.raises(TimeoutError):
+        pool.run(0.1, sleep, 10)
+    # the worker process was replaced
+    assert pool.run(30, getpid) != pid
+
+
+def test_timeout_logged(pool, caplog):
+    with pytest.raises(TimeoutError):
+        pool.run(0.1, sleep_with, b'secret' * 1000, 10)
+    assert 'sleep_with (arguments: 6000, int)' in caplog.text
+    assert 'secret' not in caplog.text
+
+
+def test_timeout_other_jobs():
+    pool = WorkerPool(processes=2)
+    try:
+        results = []
+        thread = threading.Thread(target=lambda: results.append(pool.run(30, sleep, 1)))
+        thread.start()
+        with pytest.raises(TimeoutError):
+            pool.run(0.1, sleep, 10)
+        thread.join()
+        # the job running at the same time was not terminated
+        assert results == [1]
+    finally:
+        pool.close()
+
+
+def test_no_processes():
+    assert WorkerPool(processes=0).run(0, getpid) == os.getpid()
@@ -0,0 +1,46 @@
+from ..utils.highlight import HighlightStats
+from ..utils.render import RenderLimits
+
+MAX_RENDER_SIZE = {
+    'HIGHLIGHT_TYPES': 100,
+    'image/': 1000,
+    'image/svg': 10,
+    '': 50,
+}
+
+
+def test_render_limits():
+    limits = RenderLimits(MAX_RENDER_SIZE)
+    assert limits.allowed('image/png', 1000)
+    assert not limits.allowed('image/png', 1001)
+    assert not limits.allowed('image/svg+xml', 11)  # longest prefix first
+    assert limits.allowed('application/zip', 50)
+    assert not limits.allowed('application/zip', 51)
+    assert limits.allowed('text/x-python', 100, highlight_type='text/x-python')
+    assert not limits.allowed('text/x-python', 101, highlight_type='text/x-python')
+
+
+def test_render_limits_time_budget():
+    stats = HighlightStats()
+    limits = RenderLimits(MAX_RENDER_SIZE, time_budget=2.0, stats=stats)
+    size = 10 * stats.min_sample_size
+    # nothing learned yet
+    assert not limits.allowed('text/x-python', size, highlight_type='text/x-python')
+    stats.record('text/x-python', size, 1.0)
+    assert stats.throughput('text/x-python') == size
+    assert limits.allowed('text/x-python', 2 * size, highlight_type='text/x-python')
+    assert not limits.allowed('text/x-python', 3 * size, highlight_type='text/x-python')
+    assert not limits.allowed('text/x-c', 2 * size, highlight_type='text/x-c')
+    # the static limit always applies
+    assert limits.allowed('text/x-c', 100, highlight_type='text/x-c')
+
+
+def test_highlight_stats_throughput():
+    stats = HighlightStats()
+    stats.record('text/plain', 100, 1.0)  # too small to learn from
+    assert stats.throughput('text/plain') is None
+    size = stats.min_sample_size
+    stats.record('text/plain', size, 1.0)
+    stats.record('text/plain', size, 0.5)
+    assert size < stats.throughput('text/plain') < 2 * size
+    assert stats.stats()['text/plain']['renders'] == 3
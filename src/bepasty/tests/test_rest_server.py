@@ -11,6 +11,7 @@ import hashlib
 import re
 from requests.auth import _basic_auth_str
 from flask import current_app, url_for, json
+from werkzeug.wsgi import FileWrapper
 
 import pytest
 
@@ -57,7 +58,8 @@ def wait_background():
 
     main_thread = threading.current_thread()
     for t in threading.enumerate():
-        if t is not main_thread:
+        # daemon threads (like writing download timestamps) run until the end
+        if t is not main_thread and not t.daemon:
             t.join()
 
 
@@ -172,7 +174,7 @@ def check_err_response(response, code, check_data=True):
 
 
 def check_data_response(response, meta, data, offset=0, total_size=None,
-                        check_data=True):
+                        check_data=True, code=200):
     ftype = meta['file-meta'][TYPE]
     filename = meta['file-meta'][FILENAME]
     if total_size is None:
@@ -182,7 +184,7 @@ def check_data_response(response, meta, data, offset=0, total_size=None,
     range_str = 'bytes {}-{}/{}'.format(offset, offset + len(data) - 1,
                                         total_size)
 
-    check_response(response, 200, ftype, check_data)
+    check_response(response, code, ftype, check_data)
     assert response.headers['Content-Disposition'] == disposition
     assert response.headers['Content-Range'] == range_str
     if check_data:
@@ -238,9 +240,16 @@ def test_config(client_fixture):
     # get server config
     with client.get(url.config) as response:
         check_response(response, 200)
-        assert len(response.json) == 2
+        assert len(response.json) == 3
         assert response.json['MAX_ALLOWED_FILE_SIZE'] == app.config['MAX_ALLOWED_FILE_SIZE']
         assert response.json['MAX_BODY_SIZE'] == app.config['MAX_BODY_SIZE']
+        assert response.json['UPLOAD_TRANSFER_ENCODINGS'] == ['base64', 'binary']
+
+    # admins also get the job queue and highlighting statistics
+    with client.get(url.config, headers=add_auth('user', 'admin')) as response:
+        check_response(response, 200)
+        assert response.json['JOBS']['workers'] == app.config['JOB_WORKERS']
+        assert response.json['HIGHLIGHT'] == {}
 
     # get server config (head)
     with client.head(url.config) as response:
@@ -261,7 +270,9 @@ def _upload(client, data, token=None, filename=None, ftype=None, lifetime=None,
     }
     if set_range:
         if range_str is None:
-            range_str = f'bytes 0-{payload_len - 1}/{payload_len}'
+            # the range of the (decoded) data
+            size = len(data) if data else 0
+            range_str = f'bytes 0-{size - 1}/{size}'
         headers['Content-Range'] = range_str
     if filename is not None:
         headers['Content-Filename'] = filename
@@ -550,7 +561,7 @@ def test_upload_range(client_fixture):
     check_detail_or_download(app, client, item_id, meta, UPLOAD_DATA,
                              download=True)
 
-    # upload again with item.data.size != start position (invalid position)
+    # upload again into the complete item
     data = UPLOAD_DATA[sep + 1:]
     range_str = 'bytes {}-{}/{}'.format(sep + 1, len(UPLOAD_DATA) - 1,
                                         len(UPLOAD_DATA))
@@ -559,6 +570,74 @@ def test_upload_range(client_fixture):
         check_err_response(response, 409)
 
 
+def test_upload_out_of_order(client_fixture):
+    app, client, _ = client_fixture
+
+    size = len(UPLOAD_DATA)
+    headers = add_auth('user', 'full', {
+        'Content-Filename': 'test.py',
+        'Content-Type': 'text/x-python',
+        'Content-Transfer-Encoding': 'binary',
+    })
+    chunks = [(20, size), (0, 10), (10, 20)]
+    for i, (begin, end) in enumerate(chunks):
+        headers['Content-Range'] = f'bytes {begin}-{end - 1}/{size}'
+        with client.post(RestUrl().upload, headers=headers, data=UPLOAD_DATA[begin:end]) as response:
+            if i < len(chunks) - 1:
+                check_upload_response(response, 200)
+                headers[TRANSACTION_ID] = response.headers[TRANSACTION_ID]
+            else:
+                uri = check_upload_response(response)
+
+        if i == 0:
+            # total size inconsistent with the first chunk
+            range_headers = dict(headers, **{'Content-Range': f'bytes 0-9/{size - 1}'})
+            with client.post(RestUrl().upload, headers=range_headers, data=UPLOAD_DATA[:10]) as response:
+                check_err_response(response, 409)
+    wait_background()
+
+    item_id = os.path.basename(uri)
+    meta = make_meta(UPLOAD_DATA, filename='test.py', ftype='text/x-python', uri=uri)
+    check_detail_or_download(app, client, item_id, meta, UPLOAD_DATA)
+    check_detail_or_download(app, client, item_id, meta, UPLOAD_DATA, download=True)
+
+
+def test_upload_binary(client_fixture):
+    app, client, _ = client_fixture
+
+    filename = 'test.py'
+    ftype = 'text/x-python'
+    headers = add_auth('user', 'full', {
+        'Content-Filename': filename,
+        'Content-Type': ftype,
+        'Content-Transfer-Encoding': 'binary',
+    })
+
+    # first chunk
+    sep = 10
+    headers['Content-Range'] = f'bytes 0-{sep - 1}/{len(UPLOAD_DATA)}'
+    with client.post(RestUrl().upload, headers=headers, data=UPLOAD_DATA[:sep]) as response:
+        check_upload_response(response, 200)
+        headers[TRANSACTION_ID] = response.headers[TRANSACTION_ID]
+
+    # Content-Length must match Content-Range
+    headers['Content-Range'] = f'bytes {sep}-{len(UPLOAD_DATA) - 1}/{len(UPLOAD_DATA)}'
+    with client.post(RestUrl().upload, headers=headers, data=UPLOAD_DATA[sep:-1]) as response:
+        check_err_response(response, 400)
+
+    # last chunk, the hash was continued from the first one
+    with client.post(RestUrl().upload, headers=headers, data=UPLOAD_DATA[sep:]) as response:
+        uri = check_upload_response(response)
+    item_id = os.path.basename(uri)
+    with app.storage.open(item_id) as item:
+        assert item.meta[HASH] == hashlib.sha256(UPLOAD_DATA).hexdigest()
+
+    with client.get(RestUrl(item_id).download, headers=add_auth('user', 'full')) as response:
+        assert response.data == UPLOAD_DATA
+    with client.get(RestUrl(item_id).detail, headers=add_auth('user', 'full')) as response:
+        assert response.json['file-meta'][HASH] == hashlib.sha256(UPLOAD_DATA).hexdigest()
+
+
 def test_bad_data(client_fixture):
     app, client, _ = client_fixture
 
@@ -577,6 +656,12 @@ def test_bad_data(client_fixture):
                  ftype=ftype, range_str=range_str, encode=False) as response:
         check_err_response(response, 400)
 
+    # decoded data size does not match Content-Range
+    range_str = f'bytes 0-{len(UPLOAD_DATA)}/{len(UPLOAD_DATA) + 1}'
+    with _upload(client, UPLOAD_DATA, token='full', filename=filename,
+                 ftype=ftype, range_str=range_str) as response:
+        check_err_response(response, 400)
+
     # server must not have left garbage files
     assert len(os.listdir(app.config['STORAGE_FILESYSTEM_DIRECTORY'])) == 0
 
@@ -727,70 +812,51 @@ def test_download_range(client_fixture):
         url = RestUrl(item_id=item_id)
         headers = add_auth('user', 'full')
 
-        # Range: other (invalid format)
-        offset = 0
-        limit = 10
-        headers['Range'] = 'other'
-        with client.get(url.download, headers=headers) as response:
-            check_err_response(response, 400)
-
-        # Range: bytes=invalid (invalid format)
-        offset = 0
-        limit = 10
-        headers['Range'] = 'bytes=invalid'
-        with client.get(url.download, headers=headers) as response:
-            check_err_response(response, 400)
-
-        # Range: other=0-10 (invalid unit)
-        offset = 0
-        limit = 10
-        headers['Range'] = f'other={offset}-{limit - 1}'
-        with client.get(url.download, headers=headers) as response:
-            check_err_response(response, 400)
-
-        # Range: bytes=invalid-10 (invalid first)
-        offset = 0
-        limit = 10
-        headers['Range'] = f'bytes=invalid-{limit - 1}'
-        with client.get(url.download, headers=headers) as response:
-            check_err_response(response, 400)
+        # Range headers we do not understand are ignored
+        for range_header in ['other', 'bytes=invalid', 'other=0-9', 'bytes=invalid-9', 'bytes=0-invalid']:
+            headers['Range'] = range_header
+            with client.get(url.download, headers=headers) as response:
+                check_data_response(response, meta, data)
 
-        # Range: bytes=0-invalid (invalid last)
-        offset = 0
-        limit = 10
-        headers['Range'] = f'other={offset}-invalid'
+        # Range: bytes=9-0 (invalid first > last, ignored)
+        headers['Range'] = 'bytes=9-0'
         with client.get(url.download, headers=headers) as response:
-            check_err_response(response, 400)
+            check_data_response(response, meta, data)
 
-        # Range: bytes=10-0 (invalid first > last)
-        offset = 0
-        limit = 10
-        headers['Range'] = f'bytes={limit - 1}-{offset}'
+        # Range: bytes=<size>- (not satisfiable)
+        headers['Range'] = f'bytes={len(data)}-'
         with client.get(url.download, headers=headers) as response:
-            check_err_response(response, 400)
+            check_err_response(response, 416)
+            assert response.headers['Content-Range'] == f'bytes */{len(data)}'
 
-        # Range: bytes=0-9,10-<limit - 1> (not supported for now)
-        offset = 0
+        # Range: bytes=0-9,20-<limit - 1> (multipart)
         limit = len(data)
-        headers['Range'] = f'bytes={offset}-9,10-{limit - 1}'
+        headers['Range'] = f'bytes=0-9,20-{limit - 1}'
         with client.get(url.download, headers=headers) as response:
-            check_err_response(response, 400)
-
-        # Range: bytes=0-10
+            assert response.status_code == 206
+            ctype, boundary = response.headers['Content-Type'].split('; boundary=')
+            assert ctype == 'multipart/byteranges'
+            assert int(response.headers['Content-Length']) == len(response.data)
+            parts = response.data.split(f'\r\n--{boundary}'.encode())
+            assert parts[0] == b'' and parts[-1] == b'--\r\n'
+            assert parts[1].endswith(f'Content-Range: bytes 0-9/{limit}\r\n\r\n'.encode() + data[:10])
+            assert parts[2].endswith(f'Content-Range: bytes 20-{limit - 1}/{limit}\r\n\r\n'.encode() + data[20:])
+
+        # Range: bytes=0-9
         offset = 0
         limit = 10
         headers['Range'] = f'bytes={offset}-{limit - 1}'
         with client.get(url.download, headers=headers) as response:
             check_data_response(response, meta, data[offset:limit],
-                                offset=offset, total_size=len(data))
+                                offset=offset, total_size=len(data), code=206)
 
-        # Range: bytes=-9
-        # FIXME: suffix-byte-range-spec is not supported for now
-        offset = 0
-        limit = 10
-        headers['Range'] = f'bytes=-{limit - 1}'
+        # Range: bytes=-9 (suffix)
+        offset = len(data) - 9
+        limit = len(data)
+        headers['Range'] = 'bytes=-9'
         with client.get(url.download, headers=headers) as response:
-            check_err_response(response, 400)
+            check_data_response(response, meta, data[offset:limit],
+                                offset=offset, total_size=len(data), code=206)
 
         # Range: bytes=10-<limit - 1>
         offset = 10
@@ -798,7 +864,7 @@ def test_download_range(client_fixture):
         headers['Range'] = f'bytes={offset}-{limit - 1}'
         with client.get(url.download, headers=headers) as response:
             check_data_response(response, meta, data[offset:limit],
-                                offset=offset, total_size=len(data))
+                                offset=offset, total_size=len(data), code=206)
 
         # Range: bytes=10-
         offset = 10
@@ -806,7 +872,66 @@ def test_download_range(client_fixture):
         headers['Range'] = f'bytes={offset}-'
         with client.get(url.download, headers=headers) as response:
             check_data_response(response, meta, data[offset:limit],
-                                offset=offset, total_size=len(data))
+                                offset=offset, total_size=len(data), code=206)
+
+
+def test_download_file_wrapper(client_fixture):
+    app, client, faketime = client_fixture
+
+    faketime.set_time(100)
+
+    datas, metas = upload_files(client)
+
+    environ = {'wsgi.file_wrapper': FileWrapper}
+    for item_id in metas.keys():
+        data = datas[item_id]
+        meta = metas[item_id]
+
+        url = RestUrl(item_id=item_id)
+        headers = add_auth('user', 'full')
+
+        faketime.set_time(200)
+        with client.get(url.download, headers=headers, environ_overrides=environ) as response:
+            check_data_response(response, meta, data)
+
+        # partial content is not served via the file wrapper
+        offset = 10
+        headers['Range'] = f'bytes=0-{offset - 1}'
+        with client.get(url.download, headers=headers, environ_overrides=environ) as response:
+            check_data_response(response, meta, data[:offset], total_size=len(data), code=206)
+        del headers['Range']
+
+        # download timestamps are written behind
+        app.download_timestamps.flush()
+        with client.get(url.detail, headers=headers) as response:
+            assert response.json['file-meta'][TIMESTAMP_DOWNLOAD] == 200
+
+
+def test_download_offload(client_fixture):
+    app, client, faketime = client_fixture
+
+    faketime.set_time(100)
+
+    datas, metas = upload_files(client)
+    storage_dir = app.config['STORAGE_FILESYSTEM_DIRECTORY']
+
+    for item_id in metas.keys():
+        meta = metas[item_id]
+        url = RestUrl(item_id=item_id)
+        headers = add_auth('user', 'full')
+
+        with TmpConfig(app, {'DOWNLOAD_OFFLOAD': 'x-accel-redirect'}):
+            with client.get(url.download, headers=headers) as response:
+                assert response.status_code == 200
+                assert response.data == b''
+                assert response.headers['X-Accel-Redirect'] == f'/_bepasty_storage/{item_id}.data'
+                assert response.headers['Content-Type'] == meta['file-meta'][TYPE]
+
+        with TmpConfig(app, {'DOWNLOAD_OFFLOAD': 'x-sendfile'}):
+            with client.get(url.download, headers=headers) as response:
+                assert response.status_code == 200
+                assert response.data == b''
+                assert response.headers['X-Sendfile'] == os.path.join(storage_dir, f'{item_id}.data')
 
 
 def test_modify(client_fixture):
@@ -1,6 +1,9 @@
+from io import BytesIO
+
 import pytest
 
-from bepasty.storage.filesystem import Storage
+from bepasty.storage.filesystem import Data, Storage
+from bepasty.storage.filesystem.compressed import CompressedData, write_compressed
 
 
 def test_contains(tmpdir):
@@ -35,3 +38,142 @@ def test_invalid_name(tmpdir):
     name = "../invalid"
     with pytest.raises(RuntimeError):
         storage.create(name, 0)
+
+
+def test_index(tmpdir):
+    storage = Storage(str(tmpdir), index=True)
+    assert len(storage.index) == 0
+    with storage.create("foo", 0) as item:
+        item.meta['timestamp-upload'] = 1
+    with storage.create("bar", 0) as item:
+        item.meta['timestamp-upload'] = 2
+    # most recent uploads first
+    assert [name for name, meta in storage.index.items()] == ["bar", "foo"]
+    with storage.openwrite("foo") as item:
+        item.meta['timestamp-upload'] = 3
+    assert [(name, meta['timestamp-upload']) for name, meta in storage.index.items()] == [("foo", 3), ("bar", 2)]
+    storage.remove("foo")
+    assert "foo" not in storage.index
+    assert "bar" in storage.index
+
+
+def test_index_rebuild(tmpdir):
+    storage = Storage(str(tmpdir))
+    assert storage.index is None
+    for name in ["foo", "bar", ]:
+        with storage.create(name, 0) as item:
+            item.meta['timestamp-upload'] = 0
+    # a new index gets built from the existing items
+    storage = Storage(str(tmpdir), index=True)
+    assert set(name for name, meta in storage.index.items()) == {"foo", "bar"}
+    # removed without updating the index
+    Storage(str(tmpdir)).remove("foo")
+    assert "foo" in storage.index
+    storage.reindex("foo")
+    assert "foo" not in storage.index
+
+
+def test_sharded(tmpdir):
+    storage = Storage(str(tmpdir), layout='sharded')
+    with storage.create("foobar", 0) as item:
+        item.data.write(b'data', 0)
+    assert tmpdir.join('f', 'o', 'foobar.data').check()
+    assert "foobar" in storage
+    assert list(storage) == ["foobar"]
+    with storage.open("foobar") as item:
+        assert item.data.read(4, 0) == b'data'
+    storage.remove("foobar")
+    assert "foobar" not in storage
+
+
+def test_relocate(tmpdir):
+    flat = Storage(str(tmpdir))
+    for name in ["foo", "bar", ]:
+        with flat.create(name, 0) as item:
+            item.meta['flag'] = name
+    storage = Storage(str(tmpdir), layout='sharded')
+    assert set(storage) == {"foo", "bar"}
+    assert storage.in_other_layout("foo")
+    # moved on first access
+    with storage.open("foo") as item:
+        assert item.meta['flag'] == "foo"
+    assert not storage.in_other_layout("foo")
+    assert tmpdir.join('f', 'o', 'foo.meta').check()
+    # moved explicitly
+    assert storage.relocate("bar")
+    assert not tmpdir.join('bar.meta').check()
+    assert set(storage) == {"foo", "bar"}
+    # and back again
+    assert flat.relocate("bar")
+    assert tmpdir.join('bar.meta').check()
+
+
+def test_sidecar(tmpdir):
+    storage = Storage(str(tmpdir))
+    with storage.create("foo", 0):
+        pass
+    assert storage.read_sidecar("foo", "thumb", "key") is None
+    storage.write_sidecar("foo", "thumb", "key", b'data')
+    assert storage.read_sidecar("foo", "thumb", "key") == b'data'
+    # outdated
+    assert storage.read_sidecar("foo", "thumb", "otherkey") is None
+    # in pieces
+    storage.write_sidecar("foo", "gzip", "key", iter([b'da', b'ta']))
+    with storage.open_sidecar("foo", "gzip", "key") as f:
+        assert f.read(2) == b'da'
+        assert f.read() == b'ta'
+    assert storage.open_sidecar("foo", "gzip", "otherkey") is None
+    # moved with the item
+    storage = Storage(str(tmpdir), layout='sharded')
+    assert storage.relocate("foo")
+    assert storage.read_sidecar("foo", "thumb", "key") == b'data'
+    # removed with the item
+    storage.remove("foo")
+    assert storage.read_sidecar("foo", "thumb", "key") is None
+    assert tmpdir.join('f', 'o').listdir() == []
+
+
+@pytest.mark.parametrize('size', [0, 1, 999, 1000, 1001, 3500])
+def test_compressed_data(tmpdir, size):
+    data = b''.join(b'%d\n' % i for i in range(size))[:size]
+    with tmpdir.join('data').open('w+b') as f:
+        write_compressed(Data(BytesIO(data)), f, block_size=1000)
+        f.seek(0)
+        compressed = CompressedData(f)
+        assert compressed.size == size
+        for offset in range(0, size + 2, 250):
+            for length in [0, 1, 250, 999, 1000, 1001, 5000]:
+                assert compressed.read(length, offset) == data[offset:offset + length]
+        assert compressed.read(-1, 0) == data
+
+
+def test_compress(tmpdir):
+    storage = Storage(str(tmpdir))
+    data = b'hello world\n' * 1000
+    with storage.create("foo", 0) as item:
+        item.data.write(data, 0)
+    assert storage.compress("foo")
+    assert not tmpdir.join('foo.data').check()
+    assert not storage.compress("foo")
+    with storage.open("foo") as item:
+        assert item.data.size == len(data)
+        assert item.data.read(12, 12 * 500) == b'hello world\n'
+        assert item.data.path is None
+    # the metadata can still be changed
+    with storage.openwrite("foo") as item:
+        item.meta['key'] = 'value'
+    # moved with the item
+    storage = Storage(str(tmpdir), layout='sharded')
+    with storage.open("foo") as item:
+        assert item.data.read(len(data), 0) == data
+    storage.remove("foo")
+    assert tmpdir.join('f', 'o').listdir() == []
+
+
+def test_compress_not_worth_it(tmpdir):
+    storage = Storage(str(tmpdir))
+    with storage.create("foo", 0) as item:
+        item.data.write(bytes(range(256)), 0)
+    assert not storage.compress("foo")
+    assert tmpdir.join('foo.data').check()
+    assert sorted(tmpdir.listdir()) == [tmpdir.join('foo.data'), tmpdir.join('foo.meta')]
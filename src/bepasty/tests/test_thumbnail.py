@@ -0,0 +1,112 @@
+from io import BytesIO
+
+import pytest
+
+from .conftest import upload
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def upload_image(client, fmt='png', size=(800, 600)):
+    image = BytesIO()
+    Image.new('RGB', size, 'red').save(image, fmt)
+    image.seek(0)
+    return upload(client, {'file': (image, 'test.' + fmt)})
+
+
+def test_thumbnail_cached(app, monkeypatch):
+    with app.test_client() as client:
+        name = upload_image(client)
+        response = client.get(f'/{name}/+thumbnail')
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == 'image/png'
+        assert response.headers['ETag']
+        assert 'max-age' in response.headers['Cache-Control']
+        with Image.open(BytesIO(response.data)) as thumbnail:
+            assert thumbnail.size == (144, 108)
+
+        # now it is served from the cache
+        def render_thumbnail(*args, **kwargs):
+            raise AssertionError('thumbnail should be cached')
+        monkeypatch.setattr('bepasty.utils.thumbnail.render_thumbnail', render_thumbnail)
+        cached = client.get(f'/{name}/+thumbnail')
+        assert cached.data == response.data
+
+
+def test_thumbnail_conditional(app):
+    with app.test_client() as client:
+        name = upload_image(client)
+        etag = client.get(f'/{name}/+thumbnail').headers['ETag']
+        assert etag.startswith('"thumb-')
+        assert client.get(f'/{name}/+thumbnail', headers={'If-None-Match': etag}).status_code == 304
+        # other representation of the item
+        assert client.get(f'/{name}/+download', headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_thumbnail_eager(app, monkeypatch):
+    app.config['THUMBNAIL_EAGER'] = True
+    with app.test_client() as client:
+        name = upload_image(client)
+        app.jobs.join()
+        with app.storage.open(name) as item:
+            key = '{}-192x108'.format(item.meta['hash'])
+        assert app.storage.read_sidecar(name, 'thumb', key) is not None
+
+
+def test_thumbnail_unsupported(app):
+    with app.test_client() as client:
+        form = {'text': 'hello', 'contenttype': 'text/plain', 'filename': 'test.txt'}
+        response = client.post('/+upload?token=secret', data=form)
+        name = response.location.split('/')[-1].split('#')[0]
+        response = client.get(f'/{name}/+thumbnail')
+        assert response.headers['Content-Type'] == 'image/svg+xml'
+        # the placeholder is not cached
+        assert 'ETag' not in response.headers
+        assert 'Last-Modified' not in response.headers
+        assert response.headers['Cache-Control'] == 'no-cache'
+
+
+def test_thumbnail_jpeg(app):
+    with app.test_client() as client:
+        name = upload_image(client, fmt='jpeg', size=(1600, 1200))
+        response = client.get(f'/{name}/+thumbnail')
+        assert response.headers['Content-Type'] == 'image/jpeg'
+        with Image.open(BytesIO(response.data)) as thumbnail:
+            assert thumbnail.size == (144, 108)
+
+
+def test_thumbnail_too_big(app):
+    app.config['THUMBNAIL_MAX_PIXELS'] = 1000
+    with app.test_client() as client:
+        name = upload_image(client)
+        for _ in range(2):  # the second time, the failure is cached
+            response = client.get(f'/{name}/+thumbnail')
+            assert response.headers['Content-Type'] == 'image/svg+xml'
+
+
+@pytest.mark.parametrize('error', [TimeoutError(), RuntimeError('Worker process died')])
+def test_thumbnail_failure_not_cached(app, monkeypatch, error):
+    with app.test_client() as client:
+        name = upload_image(client)
+        run = app.worker_pool.run
+
+        def run_failing(*args):
+            raise error
+        monkeypatch.setattr(app.worker_pool, 'run', run_failing)
+        response = client.get(f'/{name}/+thumbnail')
+        assert response.headers['Content-Type'] == 'image/svg+xml'
+        # it might work next time
+        monkeypatch.setattr(app.worker_pool, 'run', run)
+        response = client.get(f'/{name}/+thumbnail')
+        assert response.headers['Content-Type'] == 'image/png'
+
+
+def test_thumbnail_compressed(app):
+    with app.test_client() as client:
+        name = upload_image(client)
+        # even if it is not worth it
+        assert app.storage.compress(name, max_ratio=10)
+        response = client.get(f'/{name}/+thumbnail')
+        assert response.status_code == 200
+        with Image.open(BytesIO(response.data)) as thumbnail:
+            assert thumbnail.size == (144, 108)
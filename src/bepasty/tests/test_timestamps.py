@@ -0,0 +1,61 @@
+import time
+
+import pytest
+
+from ..constants import TIMESTAMP_DOWNLOAD
+
+
+@pytest.fixture
+def app_config():
+    return {'DOWNLOAD_TIMESTAMP_INTERVAL': 60}
+
+
+@pytest.fixture(autouse=True)
+def items(app):
+    for name in ('foo', 'bar'):
+        with app.storage.create(name, 0) as item:
+            item.meta[TIMESTAMP_DOWNLOAD] = 0
+
+
+def download_timestamp(app, name):
+    with app.storage.open(name) as item:
+        return item.meta[TIMESTAMP_DOWNLOAD]
+
+
+def test_write_behind(app, monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now)
+    timestamps = app.download_timestamps
+    timestamps.record('foo')
+    timestamps.record('bar')
+    # nothing written yet
+    assert download_timestamp(app, 'foo') == 0
+    # when the interval is over, all pending timestamps get written in the background
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    timestamps.record('foo')
+    app.jobs.join()
+    assert download_timestamp(app, 'foo') == int(now + 61)
+    assert download_timestamp(app, 'bar') == int(now)
+
+
+def test_flush(app):
+    app.download_timestamps.record('foo')
+    app.storage.remove('bar')
+    app.download_timestamps.record('bar')
+    app.download_timestamps.flush()
+    assert download_timestamp(app, 'foo') > 0
+
+
+def test_thread(app):
+    timestamps = app.download_timestamps
+    timestamps.interval = 0.05
+    timestamps.start()
+    try:
+        timestamps.record('foo')
+        for _ in range(100):
+            if download_timestamp(app, 'foo'):
+                break
+            time.sleep(0.05)
+        assert download_timestamp(app, 'foo') > 0
+    finally:
+        timestamps.stop()
@@ -0,0 +1,198 @@
+#
+# web upload tests
+#
+
+import hashlib
+from io import BytesIO
+import os
+
+import pytest
+
+from ..constants import COMPLETE, HASH, RANGES, SIZE, TIMESTAMP_DOWNLOAD
+from ..utils.hashing import HashStates, NoHash
+from ..utils.upload import background_compute_hash, merge_range
+
+UPLOAD_DATA = b'hello, world\n' * 1000
+
+
+@pytest.fixture
+def app_config():
+    return {'DEFAULT_PERMISSIONS': ''}
+
+
+def stored_items(app):
+    storage = app.storage
+    result = {}
+    for name in storage:
+        with storage.open(name) as item:
+            result[name] = dict(item.meta), item.data.read(item.data.size, 0)
+    return result
+
+
+@pytest.mark.parametrize('token_in_form', [False, True])
+def test_upload_file(app, token_in_form):
+    # with the token in the query args, the file gets written into storage while
+    # parsing the request, with the token in the form, it is copied there later.
+    form = {'file': (BytesIO(UPLOAD_DATA), 'test.txt')}
+    url = '/+upload'
+    if token_in_form:
+        form['token'] = 'secret'
+    else:
+        url += '?token=secret'
+    with app.test_client() as client:
+        response = client.post(url, data=form)
+        assert response.status_code == 302
+    items = stored_items(app)
+    assert len(items) == 1
+    meta, data = list(items.values())[0]
+    assert data == UPLOAD_DATA
+    assert meta[SIZE] == len(UPLOAD_DATA)
+    assert meta[HASH] == hashlib.sha256(UPLOAD_DATA).hexdigest()
+    assert meta[COMPLETE]
+
+
+def test_upload_file_forbidden(app):
+    form = {'file': (BytesIO(UPLOAD_DATA), 'test.txt')}
+    with app.test_client() as client:
+        response = client.post('/+upload?token=invalid', data=form)
+        assert response.status_code == 403
+    assert stored_items(app) == {}
+
+
+def test_upload_file_too_big(app):
+    app.config['MAX_ALLOWED_FILE_SIZE'] = len(UPLOAD_DATA) - 1
+    form = {'file': (BytesIO(UPLOAD_DATA), 'test.txt')}
+    with app.test_client() as client:
+        response = client.post('/+upload?token=secret', data=form)
+        assert response.status_code == 413
+    # the partially written item must be gone
+    assert stored_items(app) == {}
+
+
+def test_upload_chunks(app, monkeypatch):
+    # the hash is continued over the chunks, so no re-reading of the data is needed
+    def background_compute_hash(name):
+        raise AssertionError('hash should be known')
+    monkeypatch.setattr('bepasty.utils.upload.background_compute_hash', background_compute_hash)
+    sep = 5000
+    with app.test_client() as client:
+        response = client.post('/+upload/new?token=secret', json={
+            'filename': 'test.txt', 'size': len(UPLOAD_DATA), 'type': 'text/plain',
+        })
+        name = response.json['name']
+        for begin, end in [(0, sep), (sep, len(UPLOAD_DATA))]:
+            headers = {'Content-Range': f'bytes {begin}-{end - 1}/{len(UPLOAD_DATA)}'}
+            form = {'file': (BytesIO(UPLOAD_DATA[begin:end]), 'test.txt')}
+            response = client.post(f'/+upload/{name}?token=secret', data=form, headers=headers)
+            assert response.status_code == 200
+    meta, data = stored_items(app)[name]
+    assert data == UPLOAD_DATA
+    assert meta[HASH] == hashlib.sha256(UPLOAD_DATA).hexdigest()
+    assert meta[COMPLETE]
+
+
+def test_hash_states():
+    states = HashStates(max_states=2)
+    hasher = states.resume('a', 0)
+    hasher.update(b'foo')
+    states.suspend('a', 3, hasher)
+    assert states.resume('a', 3) is hasher
+    # resuming consumes the state
+    assert isinstance(states.resume('a', 3), NoHash)
+    # wrong offset: hash unknown, and the state is dropped
+    states.suspend('a', 3, hasher)
+    assert isinstance(states.resume('a', 2), NoHash)
+    assert isinstance(states.resume('a', 3), NoHash)
+    # oldest states get evicted
+    for name in 'abc':
+        states.suspend(name, 3, hasher)
+    assert isinstance(states.resume('a', 3), NoHash)
+    assert states.resume('c', 3) is hasher
+
+
+def test_upload_chunks_out_of_order(app):
+    sep = 5000
+    with app.test_client() as client:
+        response = client.post('/+upload/new?token=secret', json={
+            'filename': 'test.txt', 'size': len(UPLOAD_DATA), 'type': 'text/plain',
+        })
+        name = response.json['name']
+        # total size inconsistent with the announced one
+        headers = {'Content-Range': f'bytes 0-{sep - 1}/{len(UPLOAD_DATA) + 1}'}
+        form = {'file': (BytesIO(UPLOAD_DATA[:sep]), 'test.txt')}
+        response = client.post(f'/+upload/{name}?token=secret', data=form, headers=headers)
+        assert response.status_code == 409
+        for begin, end in [(sep, len(UPLOAD_DATA)), (0, sep)]:
+            headers = {'Content-Range': f'bytes {begin}-{end - 1}/{len(UPLOAD_DATA)}'}
+            form = {'file': (BytesIO(UPLOAD_DATA[begin:end]), 'test.txt')}
+            response = client.post(f'/+upload/{name}?token=secret', data=form, headers=headers)
+            assert response.status_code == 200
+            meta, data = stored_items(app)[name]
+            assert meta[COMPLETE] == (begin == 0)
+        app.jobs.join()
+    meta, data = stored_items(app)[name]
+    assert data == UPLOAD_DATA
+    assert meta[HASH] == hashlib.sha256(UPLOAD_DATA).hexdigest()
+    assert RANGES not in meta
+
+
+def test_compute_hash_keeps_concurrent_changes(app, monkeypatch):
+    with app.test_client() as client:
+        response = client.post('/+upload/new?token=secret', json={
+            'filename': 'test.txt', 'size': len(UPLOAD_DATA), 'type': 'text/plain',
+        })
+        name = response.json['name']
+
+    def compute_hash(data, size):
+        # e.g. the download timestamps are written meanwhile
+        with app.storage.openlocked(name) as item:
+            item.meta[TIMESTAMP_DOWNLOAD] = 42
+        return 'hash'
+    monkeypatch.setattr('bepasty.utils.upload.compute_hash', compute_hash)
+    with app.app_context():
+        background_compute_hash.run(name)
+    meta, data = stored_items(app)[name]
+    assert meta[HASH] == 'hash'
+    assert meta[TIMESTAMP_DOWNLOAD] == 42
+
+
+def test_merge_range():
+    assert merge_range([], 5, 10) == [[5, 10]]
+    assert merge_range([[5, 10]], 0, 2) == [[0, 2], [5, 10]]
+    assert merge_range([[0, 2], [5, 10]], 2, 5) == [[0, 10]]
+    assert merge_range([[0, 2], [5, 10]], 1, 6) == [[0, 10]]
+    assert merge_range([[0, 2], [5, 10]], 12, 15) == [[0, 2], [5, 10], [12, 15]]
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_upload_chunk_into_complete_item(app, compressed):
+    app.config['STORAGE_FILESYSTEM_COMPRESS'] = 'zlib' if compressed else None
+    with app.test_client() as client:
+        response = client.post('/+upload?token=secret', data={'file': (BytesIO(UPLOAD_DATA), 'test.txt')})
+        assert response.status_code == 302
+        app.jobs.join()
+        name = response.location.split('/')[-1].split('#')[0]
+        assert os.path.exists(os.path.join(app.storage.directory, name + '.datz')) == compressed
+        for headers in [{'Content-Range': f'bytes 0-4/{len(UPLOAD_DATA)}'}, {}]:
+            form = {'file': (BytesIO(b'xxxxx'), 'test.txt')}
+            response = client.post(f'/+upload/{name}?token=secret', data=form, headers=headers)
+            assert response.status_code == 409
+    # nothing was written
+    meta, data = stored_items(app)[name]
+    assert data == UPLOAD_DATA
+    assert meta[HASH] == hashlib.sha256(UPLOAD_DATA).hexdigest()
+
+
+def test_upload_chunk_too_big(app):
+    with app.test_client() as client:
+        response = client.post('/+upload/new?token=secret', json={
+            'filename': 'test.txt', 'size': len(UPLOAD_DATA), 'type': 'text/plain',
+        })
+        name = response.json['name']
+        # the chunk is bigger than its Content-Range, it must not overwrite the data after it
+        headers = {'Content-Range': f'bytes 0-9/{len(UPLOAD_DATA)}'}
+        form = {'file': (BytesIO(UPLOAD_DATA[:20]), 'test.txt')}
+        response = client.post(f'/+upload/{name}?token=secret', data=form, headers=headers)
+        assert response.status_code == 400
+    meta, data = stored_items(app)[name]
+    assert len(data) <= 10
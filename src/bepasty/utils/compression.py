@@ -0,0 +1,302 @@
+"""
+Compression: precompressed variants of text items, sent to clients accepting
+their content encoding, compressing the stored data and compressing responses.
+"""
+
+import logging
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    # zstandard is optional
+    zstandard = None
+
+from flask import current_app, request
+
+from ..constants import COMPLETE, HASH, SIZE, TYPE
+from .jobs import PRIORITY_LOW, background
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 64 * 1024
+
+# we only keep variants at most this fraction of the data size
+MAX_RATIO = 0.9
+
+# streamed responses are flushed after at least this much data
+FLUSH_SIZE = 16 * 1024
+
+
+class GzipCompressor:
+    """
+    Compress data into the gzip format, in pieces.
+
+    All compressors have the same interface: compress() returns compressed
+    data of some of the input, flush() all compressed data of the input up to
+    now (without ending the stream), finish() the rest.
+    """
+    def __init__(self, level=6):
+        # wbits 16 + MAX_WBITS makes a gzip container
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    """
+    Adapt brotli.Compressor to the interface of GzipCompressor.
+    """
+    def __init__(self, level=6):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class ZstdCompressor:
+    """
+    Adapt zstandard compression objects to the interface of GzipCompressor.
+    """
+    def __init__(self, level=6):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+# content encoding -> compressor class
+COMPRESSORS = {
+    'gzip': GzipCompressor,
+}
+if brotli is not None:
+    COMPRESSORS['br'] = BrotliCompressor
+if zstandard is not None:
+    COMPRESSORS['zstd'] = ZstdCompressor
+
+
+def accepted_encodings(encodings, accept_encodings):
+    """
+    Return the <encodings> we have a compressor for and the client accepts
+    (see <accept_encodings>, the parsed Accept-Encoding header), the ones
+    the client prefers first, otherwise in the given order.
+    """
+    encodings = [encoding for encoding in encodings
+                 if encoding in COMPRESSORS and accept_encodings[encoding] > 0]
+    encodings.sort(key=lambda encoding: accept_encodings[encoding], reverse=True)
+    return encodings
+
+
+def precompress_encodings(config):
+    """
+    Return the PRECOMPRESS_ENCODINGS we have a compressor for.
+    """
+    return [encoding for encoding in config.get('PRECOMPRESS_ENCODINGS', []) if encoding in COMPRESSORS]
+
+
+def precompressible(config, item):
+    """
+    Return whether we keep (or would keep) compressed variants of <item>.
+    """
+    return (bool(precompress_encodings(config)) and bool(item.meta[HASH]) and
+            item.meta[SIZE] >= config.get('PRECOMPRESS_MIN_SIZE', 64 * 1024) and
+            item.meta[TYPE].startswith(tuple(config.get('PRECOMPRESS_TYPES', []))))
+
+
+def compress_data(data, encoding):
+    """
+    Compress <data> (an item's Data) with <encoding>, return an iterator of the compressed pieces.
+    """
+    compressor = COMPRESSORS[encoding]()
+    offset = 0
+    while offset < data.size:
+        buf = data.read(min(BLOCK_SIZE, data.size - offset), offset)
+        if not buf:
+            break
+        offset += len(buf)
+        yield compressor.compress(buf)
+    yield compressor.finish()
+
+
+def make_variant(storage, name, item, encoding):
+    """
+    Store the <encoding> variant of the open item <name> in a sidecar file,
+    keyed by the item hash.
+
+    If it is not much smaller than the data, we store an empty one instead,
+    so we neither try again nor send it.
+    """
+    size = 0
+
+    def counted(pieces):
+        nonlocal size
+        for buf in pieces:
+            size += len(buf)
+            yield buf
+
+    key = item.meta[HASH]
+    storage.write_sidecar(name, encoding, key, counted(compress_data(item.data, encoding)))
+    if size > item.data.size * MAX_RATIO:
+        storage.write_sidecar(name, encoding, key, b'')
+
+
+def open_variant(storage, name, item, encoding):
+    """
+    Return the sidecar file with the <encoding> variant of the open item
+    <name> (positioned at the compressed data), or None if there is none.
+    """
+    if not item.meta[HASH]:
+        return None
+    f = storage.open_sidecar(name, encoding, item.meta[HASH])
+    if f is None:
+        return None
+    if f.tell() == os.fstat(f.fileno()).st_size:
+        # not worth it, see make_variant
+        f.close()
+        return None
+    return f
+
+
+def select_encoding(storage, name, item, accept_encodings):
+    """
+    Return the content encoding of the variant of the open item <name> to send
+    to a client with <accept_encodings> (the parsed Accept-Encoding header),
+    or None to send the data as it is.
+    """
+    config = current_app.config
+    if not precompressible(config, item):
+        return None
+    for encoding in accepted_encodings(precompress_encodings(config), accept_encodings):
+        f = open_variant(storage, name, item, encoding)
+        if f is not None:
+            f.close()
+            return encoding
+    return None
+
+
+@background(priority=PRIORITY_LOW)
+def background_precompress(name):
+    storage = current_app.storage
+    config = current_app.config
+    with storage.open(name) as item:
+        if not precompressible(config, item):
+            return
+        for encoding in precompress_encodings(config):
+            f = storage.open_sidecar(name, encoding, item.meta[HASH])
+            if f is not None:
+                f.close()
+                continue
+            try:
+                make_variant(storage, name, item, encoding)
+            except OSError as e:
+                logger.warning("Could not store %s variant of %s: %s", encoding, name, e)
+
+
+def compressible_at_rest(config, item):
+    """
+    Return whether the data of <item> should be stored compressed (see STORAGE_FILESYSTEM_COMPRESS).
+    """
+    return (bool(config.get('STORAGE_FILESYSTEM_COMPRESS')) and bool(item.meta[COMPLETE]) and
+            item.meta[TYPE].startswith(tuple(config.get('STORAGE_FILESYSTEM_COMPRESS_TYPES', []))))
+
+
+@background(priority=PRIORITY_LOW)
+def background_compress_data(name):
+    storage = current_app.storage
+    config = current_app.config
+    with storage.open(name) as item:
+        if not compressible_at_rest(config, item):
+            return
+    storage.compress(name, config['STORAGE_FILESYSTEM_COMPRESS'])
+
+
+def compress_chunks(chunks, compressor):
+    """
+    Compress <chunks> (str or bytes) of a streamed response, return an
+    iterator of the compressed pieces.
+
+    The compressed data is flushed after every FLUSH_SIZE bytes of chunks, so
+    the client gets it early (flushing every small chunk would make it much
+    bigger). Closing the iterator closes <chunks>.
+    """
+    try:
+        pending = 0
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            buf = compressor.compress(chunk)
+            pending += len(chunk)
+            if pending >= FLUSH_SIZE:
+                buf += compressor.flush()
+                pending = 0
+            if buf:
+                yield buf
+        yield compressor.finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def compress_response(response):
+    """
+    Compress <response> with an encoding the client accepts (see
+    RESPONSE_COMPRESS_ENCODINGS), if it is worth it.
+
+    Only complete 200 responses of RESPONSE_COMPRESS_TYPES (rendered pages,
+    JSON) with at least RESPONSE_COMPRESS_MIN_SIZE bytes are compressed.
+    Item downloads (which have a Content-Disposition and might be compressed
+    already, see select_encoding) and responses sent by the WSGI server's
+    file wrapper are not.
+    """
+    config = current_app.config
+    encodings = config.get('RESPONSE_COMPRESS_ENCODINGS', [])
+    if (not encodings or response.status_code != 200 or response.direct_passthrough or
+            'Content-Encoding' in response.headers or 'Content-Disposition' in response.headers or
+            not response.mimetype.startswith(tuple(config.get('RESPONSE_COMPRESS_TYPES', [])))):
+        return response
+    if not response.is_streamed and len(response.get_data()) < config.get('RESPONSE_COMPRESS_MIN_SIZE', 1024):
+        return response
+    response.vary.add('Accept-Encoding')
+    encodings = accepted_encodings(encodings, request.accept_encodings)
+    if not encodings:
+        return response
+    encoding = encodings[0]
+    compressor = COMPRESSORS[encoding](config.get('RESPONSE_COMPRESS_LEVEL', 6))
+    if response.is_streamed:
+        response.response = compress_chunks(response.response, compressor)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compressor.compress(response.get_data()) + compressor.finish())
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None:
+        # another representation
+        response.set_etag(etag + '-' + encoding, weak)
+    return response
@@ -53,13 +53,32 @@ def time_unit_to_sec(value, unit):
     return secs
 
 
+def lifetime_over(meta):
+    """
+    Check whether the maximum lifetime given in the metadata <meta> has expired.
+    """
+    return 0 < meta[TIMESTAMP_MAX_LIFE] < time.time()
+
+
 def delete_if_lifetime_over(item, name):
     """
     Delete the file if its maximum lifetime has expired.
 
     :return: True if the file was deleted, otherwise False
     """
-    if 0 < item.meta[TIMESTAMP_MAX_LIFE] < time.time():
+    return delete_if_meta_lifetime_over(item.meta, name)
+
+
+def delete_if_meta_lifetime_over(meta, name):
+    """
+    Delete the file if the maximum lifetime given in its metadata has expired.
+
+    This is for callers that have the metadata without having the item open,
+    e.g. from the storage's metadata index.
+
+    :return: True if the file was deleted, otherwise False
+    """
+    if lifetime_over(meta):
         try:
             current_app.storage.remove(name)
         except OSError:
@@ -1,3 +1,5 @@
+from io import StringIO
+
 from pygments.formatters.html import HtmlFormatter
 
 
@@ -64,3 +66,59 @@ class CustomHtmlFormatter(HtmlFormatter):
 
         for t, piece in source:
             outfile.write(piece)
+
+
+class BlockHtmlFormatter(CustomHtmlFormatter):
+    """Custom HTML formatter, formatting blocks of <lines_per_block> lines separately.
+
+    So the HTML of the first lines can be sent while the rest is still being
+    highlighted. Each block is formatted like by CustomHtmlFormatter (with
+    its own table of line numbers, if enabled).
+    """
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.lines_per_block = options.get('lines_per_block', 1000)
+
+    def _split_blocks(self, tokensource):
+        """Split the tokens into lists of tokens of lines_per_block lines
+
+        :param tokensource: iterator of tuples in the format (tokentype, value)
+        :return: iterator of lists of tuples in the format (tokentype, value)
+        """
+        block = []
+        lines = 0
+        for ttype, value in tokensource:
+            while value:
+                # find the newline ending the block
+                pos = -1
+                for _ in range(self.lines_per_block - lines):
+                    pos = value.find('\n', pos + 1)
+                    if pos < 0:
+                        break
+                if pos < 0:
+                    block.append((ttype, value))
+                    lines += value.count('\n')
+                    break
+                block.append((ttype, value[:pos + 1]))
+                yield block
+                block = []
+                lines = 0
+                value = value[pos + 1:]
+        if block:
+            yield block
+
+    def format_blocks(self, tokensource):
+        """Format the tokens block by block
+
+        :param tokensource: iterator of tuples in the format (tokentype, value)
+        :return: iterator of HTML strings, one per block
+        """
+        linenostart = self.linenostart
+        try:
+            for block in self._split_blocks(tokensource):
+                outfile = StringIO()
+                self.format_unencoded(block, outfile)
+                yield outfile.getvalue()
+                self.linenostart += self.lines_per_block
+        finally:
+            self.linenostart = linenostart
@@ -1,4 +1,6 @@
+from collections import OrderedDict
 from hashlib import sha256 as hash_new
+import threading
 
 SIZE = 1024 * 1024
 
@@ -18,3 +20,69 @@ def compute_hash(data, size):
         offset += len(buf)
         hasher.update(buf)
     return hasher.hexdigest()
+
+
+class NoHash:
+    """
+    Stand-in for a hash object when we can not compute the hash of the whole data.
+
+    Its hexdigest is empty, which means "hash to be computed later".
+    """
+    def update(self, data):
+        pass
+
+    def hexdigest(self):
+        return ''
+
+
+class HashStates:
+    """
+    Hash states of chunked uploads in progress (in this process).
+
+    Python's hash objects can not be serialized, so we can not store the state
+    with the item. Instead, we keep it in memory, together with the offset up to
+    which the data was hashed. If the next chunk arrives here at that offset, we
+    continue hashing with it and have the digest ready when the last chunk is
+    written. Otherwise (chunks out of order, state evicted, another process
+    got the previous chunk), the hash is computed from the stored data after
+    the upload has completed.
+    """
+    def __init__(self, max_states=1000):
+        self.max_states = max_states
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resume(self, name, offset):
+        """
+        Return the hash object for the data of item <name> before <offset>.
+
+        If we do not have it, return a NoHash object. A state we have for
+        another offset is dropped: with this chunk not continuing it, the hash
+        gets computed after the upload anyway.
+        """
+        if offset == 0:
+            return hash_new()
+        with self._lock:
+            state = self._states.pop(name, None)
+        if state is not None and state[0] == offset:
+            return state[1]
+        return NoHash()
+
+    def suspend(self, name, offset, hasher):
+        """
+        Keep hash object <hasher> for the data of item <name> before <offset>.
+        """
+        if isinstance(hasher, NoHash):
+            return
+        with self._lock:
+            self._states[name] = offset, hasher
+            self._states.move_to_end(name)
+            while len(self._states) > self.max_states:
+                self._states.popitem(last=False)
+
+    def discard(self, name):
+        with self._lock:
+            self._states.pop(name, None)
+
+
+hash_states = HashStates()
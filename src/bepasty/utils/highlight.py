@@ -0,0 +1,351 @@
+"""
+Syntax highlighting of text items, with a cache of the rendered HTML.
+"""
+
+from collections import OrderedDict
+import hashlib
+import io
+import logging
+import threading
+import time
+
+from flask import current_app
+from markupsafe import Markup
+from pygments import highlight
+from pygments.token import Token
+
+from ..constants import HASH
+from ..storage.filesystem import Storage
+from .formatters import BlockHtmlFormatter, CustomHtmlFormatter
+from .lexers import lexer_registry
+
+logger = logging.getLogger(__name__)
+
+FORMATTER_OPTIONS = dict(linenos='table', lineanchors='L', lineparagraphs='L', anchorlinenos=True)
+# for the cache key of HTML rendered in blocks (see render_highlighted_blocks)
+BLOCKS_OPTIONS = dict(FORMATTER_OPTIONS, lines_per_block=1000)
+
+# sidecar file kind of HTML rendered in blocks
+HTML_BLOCKS = 'htmlblocks'
+
+BLOCK_SIZE = 64 * 1024
+
+
+def pygments_type(content_type):
+    """
+    Return the content type to get the Pygments lexer for items of <content_type> (None if not highlighted).
+    """
+    if lexer_registry.has_mimetype(content_type):
+        return content_type
+    if content_type.startswith('text/'):
+        # It seems we found a text type not supported by Pygments
+        # Use text/plain so we get a display with line numbers
+        return 'text/plain'
+    return None
+
+
+def decode_text(data):
+    # TODO: We don't have the encoding in metadata
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        # Well, it is not UTF-8 or ASCII, so we can only guess...
+        return data.decode('iso-8859-1')
+
+
+def render_highlighted(text, mimetype, options=FORMATTER_OPTIONS):
+    """
+    Return <text> highlighted with the Pygments lexer for <mimetype>, as HTML.
+
+    This runs in a worker process (see WorkerPool).
+    """
+    lexer = lexer_registry.lexer(mimetype)
+    formatter = CustomHtmlFormatter(**options)
+    return highlight(text, lexer, formatter)
+
+
+def highlight_key(item, mimetype, options=FORMATTER_OPTIONS):
+    """
+    Return the cache key of the HTML of <item> highlighted for <mimetype> with
+    formatter <options> (None if the item hash is not known yet).
+    """
+    if not item.meta[HASH]:
+        return None
+    options_hash = hashlib.sha256(repr(sorted(options.items())).encode()).hexdigest()[:16]
+    return '{}-{}-{}'.format(item.meta[HASH], mimetype, options_hash)
+
+
+class HighlightCache:
+    """
+    Least recently used cache of highlighted HTML, up to <max_size>
+    characters in memory.
+
+    With <storage>, the HTML is also kept in a sidecar file next to the item,
+    so it survives restarts and is shared by all server processes.
+
+    Entries are keyed by item name and highlight_key, so changing the content
+    type of an item (or its data) makes them unused. Call invalidate() to
+    drop the entries of an item (e.g. when it gets deleted).
+    """
+    def __init__(self, max_size, storage=None):
+        self.max_size = max_size
+        self.storage = storage
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, name, key):
+        with self._lock:
+            html = self._entries.get((name, key))
+            if html is not None:
+                self._entries.move_to_end((name, key))
+                return html
+        if self.storage is None:
+            return None
+        try:
+            data = self.storage.read_sidecar(name, 'html', key)
+        except OSError as e:
+            logger.warning("Could not read cached HTML of %s: %s", name, e)
+            return None
+        if data is None:
+            return None
+        html = data.decode('utf-8')
+        self._put(name, key, html)
+        return html
+
+    def put(self, name, key, html):
+        self._put(name, key, html)
+        if self.storage is not None:
+            try:
+                self.storage.write_sidecar(name, 'html', key, html.encode('utf-8'))
+            except OSError as e:
+                logger.warning("Could not cache HTML of %s: %s", name, e)
+
+    def _put(self, name, key, html):
+        if len(html) > self.max_size:
+            return
+        with self._lock:
+            old = self._entries.pop((name, key), None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[(name, key)] = html
+            self.size += len(html)
+            while self.size > self.max_size:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def invalidate(self, name):
+        """
+        Drop the entries of item <name> from memory.
+        """
+        with self._lock:
+            for entry_key in [k for k in self._entries if k[0] == name]:
+                self.size -= len(self._entries.pop(entry_key))
+
+
+class HighlightStats:
+    """
+    Number of renders and timeouts, data size and time spent highlighting, per content type.
+
+    We also estimate the throughput (bytes per second) of highlighting each
+    content type, as moving average over renders of at least
+    <min_sample_size> bytes (for smaller ones, the overhead dominates).
+    After a timeout, the real throughput is even lower than what we record.
+    """
+    min_sample_size = 16 * 1024
+    smoothing = 0.2
+
+    def __init__(self):
+        self._stats = {}
+        self._throughput = {}
+        self._lock = threading.Lock()
+
+    def record(self, mimetype, size, seconds, timed_out=False):
+        with self._lock:
+            stats = self._stats.setdefault(mimetype, dict(renders=0, timeouts=0, size=0, time=0.0))
+            stats['renders'] += 1
+            stats['timeouts'] += timed_out
+            stats['size'] += size
+            stats['time'] += seconds
+            if size >= self.min_sample_size and seconds > 0:
+                throughput = size / seconds
+                old = self._throughput.get(mimetype)
+                if old is not None:
+                    throughput = old + self.smoothing * (throughput - old)
+                self._throughput[mimetype] = throughput
+
+    def throughput(self, mimetype):
+        """
+        Return the estimated throughput of highlighting <mimetype> in bytes per second (None if unknown).
+        """
+        with self._lock:
+            return self._throughput.get(mimetype)
+
+    def stats(self):
+        """
+        Return a dict content type -> dict with the statistics (times are in seconds).
+        """
+        with self._lock:
+            return {mimetype: dict(stats) for mimetype, stats in self._stats.items()}
+
+
+def describe_failure(exc, timeout):
+    """
+    Describe why running a job in the worker pool with <timeout> failed with <exc>, for log messages.
+    """
+    if isinstance(exc, TimeoutError):
+        return f'took longer than {timeout}s'
+    return f'failed: {exc!r}'
+
+
+def highlight_data(name, data, mimetype, options=FORMATTER_OPTIONS):
+    """
+    Return <data> of item <name> highlighted for <mimetype> (with formatter <options>), as HTML.
+
+    Highlighting runs in the app's worker pool, as some lexers are very slow
+    for some input. If it takes longer than HIGHLIGHT_TIMEOUT seconds, it is
+    aborted and we return the data as plain text (with line numbers), same if
+    the worker process failed otherwise (e.g. it was killed for using too
+    much memory).
+    """
+    text = decode_text(data)
+    timeout = current_app.config.get('HIGHLIGHT_TIMEOUT', 10)
+    start = time.monotonic()
+    try:
+        html = current_app.worker_pool.run(timeout, render_highlighted, text, mimetype, options)
+    except Exception as e:
+        current_app.highlight_stats.record(mimetype, len(data), time.monotonic() - start, timed_out=True)
+        logger.warning("Highlighting %s as %s %s, showing plain text", name, mimetype, describe_failure(e, timeout))
+        return render_highlighted(text, 'text/plain', options)
+    current_app.highlight_stats.record(mimetype, len(data), time.monotonic() - start)
+    return html
+
+
+def render_highlighted_blocks(directory, layout, name, key, mimetype, timeout, options=BLOCKS_OPTIONS):
+    """
+    Highlight the data of item <name> (in the filesystem storage <directory>
+    with <layout>) for <mimetype>, in blocks (see BlockHtmlFormatter and its
+    <options>), and write the HTML into its sidecar file with <key>.
+
+    This runs in a worker process (see WorkerPool). It reads the data itself
+    and writes the HTML block by block, so neither is kept in the memory of
+    the server process. We check the time spent between tokens: after
+    <timeout> seconds, the rest is written as plain text.
+
+    :return: whether it timed out
+    """
+    storage = Storage(directory, layout=layout)
+    with storage.open(name) as item:
+        data = item.data.read(item.data.size, 0)
+    # the lexer must not change the text (see below), so we normalize it like it would
+    text = decode_text(data).replace('\r\n', '\n').replace('\r', '\n')
+    del data
+    if text.startswith('\ufeff'):
+        text = text[1:]
+    # keep leading and trailing newlines, so line numbers match the data
+    lexer = lexer_registry.lexer(mimetype, stripnl=False)
+    formatter = BlockHtmlFormatter(**options)
+    deadline = time.monotonic() + timeout
+    timed_out = False
+
+    def tokens():
+        nonlocal timed_out
+        consumed = 0
+        for ttype, value in lexer.get_tokens(text):
+            yield ttype, value
+            consumed += len(value)
+            if time.monotonic() > deadline:
+                timed_out = True
+                yield Token.Text, text[consumed:]
+                return
+
+    storage.write_sidecar(name, HTML_BLOCKS, key,
+                          (block.encode('utf-8') for block in formatter.format_blocks(tokens())))
+    return timed_out
+
+
+def stream_highlighted(name, item, mimetype, key):
+    """
+    Return an iterator of the HTML of the open item <name> highlighted for
+    <mimetype>, read in pieces from its sidecar file with <key>.
+
+    If there is none yet, a worker process renders it first (see
+    render_highlighted_blocks), when iterating starts. So the caller can send
+    the first part of the page before, and the item is highlighted only once.
+    A worker not done within twice HIGHLIGHT_TIMEOUT seconds (it only stops
+    between tokens, see there) is killed, the text is rendered as plain text
+    then (also if the worker failed otherwise).
+    """
+    storage = current_app.storage
+    size = item.data.size
+    stats = current_app.highlight_stats
+
+    def render():
+        timeout = current_app.config.get('HIGHLIGHT_TIMEOUT', 10)
+        # the worker only stops between tokens, give it some time to do that
+        kill_timeout = 2 * timeout + 1
+        pool = current_app.worker_pool
+        args = storage.directory, storage.layout, name, key
+        start = time.monotonic()
+        try:
+            timed_out = pool.run(kill_timeout, render_highlighted_blocks, *args, mimetype, timeout)
+        except Exception as e:
+            logger.warning("Highlighting %s as %s %s, showing plain text",
+                           name, mimetype, describe_failure(e, kill_timeout))
+            stats.record(mimetype, size, time.monotonic() - start, timed_out=True)
+            try:
+                pool.run(kill_timeout, render_highlighted_blocks, *args, 'text/plain', kill_timeout)
+            except Exception as e:
+                logger.error("Rendering %s as plain text %s", name, describe_failure(e, kill_timeout))
+            return
+        if timed_out:
+            logger.warning("Highlighting %s as %s took longer than %ss, showing the rest as plain text",
+                           name, mimetype, timeout)
+        stats.record(mimetype, size, time.monotonic() - start, timed_out=timed_out)
+
+    def blocks():
+        f = storage.open_sidecar(name, HTML_BLOCKS, key)
+        if f is None:
+            render()
+            f = storage.open_sidecar(name, HTML_BLOCKS, key)
+            if f is None:
+                yield Markup('<p>Rendering failed. Try downloading.</p>')
+                return
+        with io.TextIOWrapper(f, encoding='utf-8') as html:
+            while True:
+                buf = html.read(BLOCK_SIZE)
+                if not buf:
+                    break
+                yield Markup(buf)
+
+    return blocks()
+
+
+def get_highlighted(name, item, mimetype, stream_size=None):
+    """
+    Return the data of the open item <name> highlighted for <mimetype>, as HTML.
+
+    The plain text shown after a timeout is cached, too, so we do not try again.
+
+    If the item has at least <stream_size> bytes (and its hash is known),
+    return an iterator of HTML pieces instead (see stream_highlighted), so the
+    caller can send the first part of the page before all is highlighted, and
+    the HTML is never kept in memory (it is cached in a sidecar file).
+    """
+    key = highlight_key(item, mimetype)
+    if stream_size is not None and item.data.size >= stream_size and key is not None:
+        return stream_highlighted(name, item, mimetype, highlight_key(item, mimetype, BLOCKS_OPTIONS))
+    cache = current_app.highlight_cache
+    if key is not None:
+        html = cache.get(name, key)
+        if html is not None:
+            return html
+    html = highlight_data(name, item.data.read(item.data.size, 0), mimetype)
+    if key is not None:
+        cache.put(name, key, html)
+    return html
+
+
+def create_highlight_cache(app):
+    storage = app.storage if app.config.get('HIGHLIGHT_CACHE_PERSIST', False) else None
+    return HighlightCache(app.config.get('HIGHLIGHT_CACHE_SIZE', 32 * 1000 * 1000), storage)
@@ -0,0 +1,184 @@
+"""
+Storage housekeeping in the background.
+"""
+
+import logging
+import os
+import shutil
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
+from ..constants import LOCKED
+from .process import ProcessLocal, ProcessThread
+
+logger = logging.getLogger(__name__)
+
+
+class Housekeeper:
+    """
+    Thread deleting expired items and, if the disk gets full, evicting items.
+
+    The metadata index has the items ordered by TIMESTAMP_MAX_LIFE, so we do
+    not need to scan the storage: we sleep until the next item expires (but at
+    most <interval> seconds, as other processes may add items expiring
+    earlier) and then delete the expired items, at most <batch_size> at once,
+    pausing between batches.
+
+    If <high_watermark> is given and the filesystem of the storage is used
+    above it (as fraction of its size), complete, unlocked items are evicted,
+    least recently used first (see MetaIndex.least_recently_used), until the
+    usage is below <low_watermark>. Before, <flush> (if given) is called, to
+    write pending download timestamps (see DownloadTimestamps).
+
+    Every server process starts a housekeeper, but only one of them does the
+    work: the one holding an exclusive lock on LOCK_FILENAME in the storage
+    directory (see lead). The others try to take over every <interval>
+    seconds, in case that process ended.
+    """
+    LOCK_FILENAME = 'bepasty-housekeeping.lock'
+    pause = 1.0
+
+    def __init__(self, storage, interval=60, batch_size=100,
+                 high_watermark=None, low_watermark=None, size_weighted=False, flush=None):
+        self.storage = storage
+        self.flush = flush
+        self.interval = interval
+        self.batch_size = batch_size
+        self.high_watermark = high_watermark
+        self.low_watermark = high_watermark if low_watermark is None else low_watermark
+        self.size_weighted = size_weighted
+        self._thread = ProcessThread(self._run, 'bepasty-housekeeping')
+        # a lock file inherited from the parent process is not ours (the lock
+        # would be shared with the parent), so every process opens its own.
+        self._lock_file = ProcessLocal(
+            lambda: open(os.path.join(self.storage.directory, self.LOCK_FILENAME), 'a'))
+
+    def start(self):
+        """
+        Start the thread, unless it is already running in this process (see ProcessThread).
+        """
+        self._thread.start()
+
+    def stop(self):
+        self._thread.stop()
+        lock_file = self._lock_file.pop()
+        if lock_file is not None:
+            # closing it releases the lock, another process may take over
+            lock_file.close()
+
+    def lead(self):
+        """
+        Return whether this process does the housekeeping (taking the lead if
+        no other process has it).
+        """
+        if fcntl is None:
+            return True
+        try:
+            # succeeds again if we already have the lock
+            fcntl.flock(self._lock_file.get(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def _run(self, stop):
+        timeout = 0
+        while not stop.wait(timeout):
+            try:
+                if not self.lead():
+                    timeout = self.interval
+                    continue
+                timeout = self.run_once()
+            except Exception:
+                logger.exception("Housekeeping failed")
+                timeout = self.interval
+
+    def run_once(self):
+        """
+        Do one round of housekeeping, return the number of seconds until the next one.
+        """
+        if self.expire() == self.batch_size or self.evict() == self.batch_size:
+            # there might be more to do
+            return self.pause
+        next_expiry = self.storage.index.next_expiry()
+        if next_expiry is None:
+            return self.interval
+        # +1: items expire after the second given in their metadata
+        return max(self.pause, min(self.interval, next_expiry + 1 - time.time()))
+
+    def expire(self):
+        """
+        Delete up to batch_size expired items, return how many were deleted.
+        """
+        names = self.storage.index.expired(time.time(), self.batch_size)
+        for name in names:
+            try:
+                self.storage.remove(name)
+            except FileNotFoundError:
+                # deleted meanwhile (maybe by another process), but still in the index
+                self.storage.reindex(name)
+            except OSError as e:
+                logger.error("Could not delete expired item %s: %s", name, e)
+            else:
+                logger.info("Deleted expired item %s", name)
+        return len(names)
+
+    def evict(self):
+        """
+        If the disk usage is above the high watermark, evict up to batch_size
+        items to get below the low watermark. Return how many were evicted.
+        """
+        if self.high_watermark is None:
+            return 0
+        usage = shutil.disk_usage(self.storage.directory)
+        if usage.used <= self.high_watermark * usage.total:
+            return 0
+        if self.flush is not None:
+            # the last use of the items must be up to date
+            self.flush()
+        candidates = self.storage.index.least_recently_used(self.batch_size, self.size_weighted, time.time())
+        if not candidates:
+            logger.warning("Storage usage above high watermark, but no items to evict")
+        count = 0
+        for name, size in candidates:
+            if usage.used <= self.low_watermark * usage.total:
+                break
+            try:
+                # the index might be behind, we must never evict a locked item
+                with self.storage.open(name) as item:
+                    if item.meta.get(LOCKED):
+                        continue
+                self.storage.remove(name)
+            except FileNotFoundError:
+                self.storage.reindex(name)
+            except OSError as e:
+                logger.error("Could not evict item %s: %s", name, e)
+            else:
+                logger.warning("Evicted item %s (%d bytes) to free storage space", name, size or 0)
+                count += 1
+                # the sizes in the index are not what we free on disk (e.g.
+                # compressed data, sidecar files), so we check again.
+                usage = shutil.disk_usage(self.storage.directory)
+        return count
+
+
+def create_housekeeper(app):
+    """
+    Create the Housekeeper of <app> (or return None if it is not needed).
+    """
+    storage = app.storage
+    interval = app.config.get('EXPIRY_INTERVAL', 60)
+    if not interval or getattr(storage, 'index', None) is None:
+        if app.config.get('EVICTION_HIGH_WATERMARK') is not None:
+            logger.warning("EVICTION_HIGH_WATERMARK is set, but items are not evicted "
+                           "(needs STORAGE_FILESYSTEM_INDEX and EXPIRY_INTERVAL)")
+        return None
+    return Housekeeper(storage, interval=interval, batch_size=app.config.get('EXPIRY_BATCH_SIZE', 100),
+                       high_watermark=app.config.get('EVICTION_HIGH_WATERMARK'),
+                       low_watermark=app.config.get('EVICTION_LOW_WATERMARK'),
+                       size_weighted=app.config.get('EVICTION_SIZE_WEIGHTED', False),
+                       flush=app.download_timestamps.flush)
@@ -1,8 +1,10 @@
 import collections
+import re
 from urllib.parse import urlparse, urljoin
 
 from flask import request, redirect, url_for
-from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import BadRequest, RequestedRangeNotSatisfiable
+from werkzeug.http import parse_date, unquote_etag
 
 
 # Safely and comfortably redirect
@@ -118,59 +120,107 @@ class ContentRange(collections.namedtuple('ContentRange', ('begin', 'end', 'comp
         return self.end - self.begin + 1
 
 
+# only ASCII digits (str.isdigit also accepts others, which int() rejects)
+_digits_re = re.compile(r'[0-9]+')
+
+
 class DownloadRange(collections.namedtuple('DownloadRange', ('begin', 'end'))):
     """
-    Work with Range headers.
+    Work with Range headers (RFC 7233).
     """
     __slots__ = ()
 
+    # more ranges are ignored (the client gets all data), as they might be
+    # used to make us do a lot of work for a small request
+    max_ranges = 32
+
     @classmethod
-    def parse(cls, content_range):
-        """
-        Parse the Range header.
-        Format: "bytes=0-524287".
+    def parse(cls, download_range, size):
         """
-        try:
-            range_type, range_count = content_range.split('=', 1)
-        except ValueError:
-            raise BadRequest(description='Range header is incorrect')
-        # There are no other types than "bytes"
-        if range_type != 'bytes':
-            raise BadRequest(description='Range header is incorrect')
-
-        try:
-            range_begin, range_end = range_count.split('-', 1)
-        except ValueError:
-            raise BadRequest(description='Range header is incorrect')
+        Parse the Range header for data of <size> bytes.
+        Format: "bytes=0-524287", "bytes=500-", "bytes=-500", "bytes=0-9,20-29".
 
+        :return: list of DownloadRange (with overlapping or adjacent ranges
+                 merged, ordered by begin) or None if the header must be
+                 ignored (we serve all data then), like when it is invalid
+        :raises RequestedRangeNotSatisfiable: if no range is satisfiable
+        """
         try:
-            range_begin = int(range_begin)
+            range_type, range_set = download_range.split('=', 1)
         except ValueError:
-            raise BadRequest(description='Range header has an invalid first')
-
-        if range_end:
-            # For now, set of ranges (e.g. 0-1,2-10) is not supported
-            try:
-                range_end = int(range_end)
-            except ValueError:
-                raise BadRequest(description='Range header has an invalid last')
-        else:
-            range_end = -1
-
-        if range_begin <= range_end or range_end == -1:
-            return DownloadRange(range_begin, range_end)
-
-        raise BadRequest(description='Range header is incorrect')
+            return None
+        # We only know "bytes"
+        if range_type.strip() != 'bytes':
+            return None
+        specs = [spec.strip() for spec in range_set.split(',') if spec.strip()]
+        if not specs or len(specs) > cls.max_ranges:
+            return None
+
+        ranges = []
+        for spec in specs:
+            range_begin, sep, range_end = spec.partition('-')
+            range_begin, range_end = range_begin.strip(), range_end.strip()
+            if not sep or not (range_begin or range_end) or not all(
+                    _digits_re.fullmatch(value) for value in (range_begin, range_end) if value):
+                return None
+            if not range_begin:
+                # suffix: the last <range_end> bytes
+                range_begin = max(0, size - int(range_end))
+                if not int(range_end):
+                    continue  # not satisfiable
+                range_end = size - 1
+            else:
+                range_begin = int(range_begin)
+                if range_end:
+                    range_end = int(range_end)
+                    if range_end < range_begin:
+                        # syntactically invalid (RFC 7233, 2.1)
+                        return None
+                else:
+                    range_end = size - 1
+            if range_begin < size:
+                ranges.append([range_begin, min(range_end, size - 1)])
+        if not ranges:
+            raise RequestedRangeNotSatisfiable(length=size)
+
+        ranges.sort()
+        merged = [ranges[0]]
+        for range_begin, range_end in ranges[1:]:
+            if range_begin <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], range_end)
+            else:
+                merged.append([range_begin, range_end])
+        return [cls(range_begin, range_end) for range_begin, range_end in merged]
 
     @classmethod
-    def from_request(cls):
+    def from_request(cls, size, etag=None, last_modified=None):
         """
-        Read the Range header from the request and parse it.
+        Read the Range header from the request and parse it (see parse).
+
+        With If-Range, the Range header is only used if the data still has the
+        (strong) <etag> or is unmodified since <last_modified> (a datetime).
         """
         download_range = request.headers.get('Range')
-        if download_range is not None:
-            return cls.parse(download_range)
+        if download_range is None:
+            return None
+        if_range = request.headers.get('If-Range')
+        if if_range is not None:
+            if if_range.startswith(('"', 'W/')):
+                if_etag, weak = unquote_etag(if_range)
+                if weak or etag is None or if_etag != etag:
+                    return None
+            else:
+                if_date = parse_date(if_range)
+                if if_date is None or last_modified is None or if_date != last_modified.replace(microsecond=0):
+                    return None
+        return cls.parse(download_range, size)
 
     @property
     def size(self):
         return self.end - self.begin + 1
+
+    def content_range(self, complete):
+        """
+        Return the value of the Content-Range header for this range of data with <complete> bytes.
+        """
+        return 'bytes %d-%d/%d' % (self.begin, self.end, complete)
@@ -0,0 +1,320 @@
+"""
+Background jobs.
+
+Work that should not delay the response (like computing the hash of a big
+upload) is queued as a job and processed by a bounded number of worker
+threads, so a burst of jobs does not start a burst of threads competing for
+the disk with each other and with the requests.
+
+Optionally, queued jobs are recorded in a journal (an SQLite database), so
+that jobs of a process that went away before finishing them are resumed by
+the next one.
+"""
+
+import functools
+import itertools
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from flask import current_app
+
+from .process import ProcessLocal, SQLiteConnections
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+PRIORITY_LOW = 20
+
+#: job functions by job name, see background()
+job_functions = {}
+
+
+def background(priority=PRIORITY_NORMAL):
+    """
+    Decorator to run a function as background job of the current app.
+
+    Calling the decorated function just queues the job. The job runs within an
+    app context, so it may use current_app, but no request-related stuff.
+    Arguments must be JSON serializable (for the journal).
+    The undecorated function is available as the run attribute.
+    """
+    def decorator(func):
+        job_name = f'{func.__module__}.{func.__qualname__}'
+        job_functions[job_name] = func
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            current_app.jobs.submit(job_name, args, priority=priority)
+
+        wrapper.run = func
+        return wrapper
+    return decorator
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def process_start_time(pid):
+    """
+    Return the start time of process <pid> (in clock ticks since boot), or
+    None if we can not find out (no /proc filesystem).
+    """
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # the command name (in parentheses) may contain spaces
+    return int(stat.rpartition(')')[2].split()[19])
+
+
+def owner_token(pid=None):
+    """
+    Return the journal owner token of process <pid> (default: this one).
+
+    It is the pid and the process start time, so a new process which got
+    the pid of a dead owner is not taken for it.
+    """
+    pid = os.getpid() if pid is None else pid
+    start_time = process_start_time(pid)
+    return '{}:{}'.format(pid, '' if start_time is None else start_time)
+
+
+def owner_alive(owner):
+    """
+    Return whether the process of journal owner token <owner> is alive.
+    """
+    # journals of older versions have just the pid
+    pid, _, start_time = str(owner).partition(':')
+    if not pid_alive(int(pid)):
+        return False
+    return not start_time or start_time == str(process_start_time(int(pid)))
+
+
+class JobJournal:
+    """
+    SQLite database recording queued jobs until they are done.
+
+    Each job is owned by the process which queued it (see owner_token). The
+    JobQueue periodically takes over the jobs of owners that are not alive
+    any more (see JobQueue.take_over).
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            owner TEXT,
+            priority INTEGER,
+            name TEXT,
+            args TEXT,
+            queued REAL
+        )
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # autocommit, we use explicit transactions where needed
+        self._connections = SQLiteConnections(path, isolation_level=None)
+        self._owner = ProcessLocal(owner_token)
+        self._connections.get().execute(self.SCHEMA)
+
+    def add(self, priority, name, args, queued):
+        """
+        Record a new job, return its id.
+        """
+        cursor = self._connections.get().execute(
+            'INSERT INTO jobs (owner, priority, name, args, queued) VALUES (?, ?, ?, ?, ?)',
+            (self._owner.get(), priority, name, json.dumps(args), queued))
+        return cursor.lastrowid
+
+    def done(self, job_id):
+        """
+        Remove job <job_id> from the journal.
+        """
+        try:
+            self._connections.get().execute('DELETE FROM jobs WHERE id = ?', (job_id, ))
+        except sqlite3.Error as e:
+            # worst case, the job runs again later
+            logger.error("Could not remove job %d from journal: %s", job_id, e)
+
+    def take_over(self):
+        """
+        Take over the jobs of owners that are not alive any more.
+
+        :return: list of (id, priority, name, args, queued) of the jobs taken over
+        """
+        me = self._owner.get()
+        conn = self._connections.get()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            jobs = []
+            owners = [owner for owner, in conn.execute('SELECT DISTINCT owner FROM jobs')]
+            for owner in owners:
+                if owner != me and not owner_alive(owner):
+                    cursor = conn.execute(
+                        'SELECT id, priority, name, args, queued FROM jobs WHERE owner = ?', (owner, ))
+                    jobs.extend((job_id, priority, name, json.loads(args), queued)
+                                for job_id, priority, name, args, queued in cursor)
+                    conn.execute('UPDATE jobs SET owner = ? WHERE owner = ?', (me, owner))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return jobs
+
+
+class QueueState:
+    """
+    Queued jobs, worker threads and statistics of a JobQueue in one process.
+    """
+    def __init__(self):
+        self.queue = queue.PriorityQueue()
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        self.taken_over = None
+
+
+class JobQueue:
+    """
+    Priority queue of background jobs, processed by up to <workers> threads.
+
+    Jobs with a lower priority value run first, jobs with the same priority
+    in the order they were queued. Worker threads are started when jobs are
+    queued and end when there is nothing left to do.
+
+    Every process has a queue of its own (see QueueState), jobs queued before
+    a fork are done by the parent process.
+    """
+    def __init__(self, app, workers=2, journal=None):
+        self.app = app
+        self.workers = max(1, workers)
+        self.journal = journal
+        self._state = ProcessLocal(QueueState)
+
+    def take_over(self, min_interval=0):
+        """
+        Queue the journal's jobs of processes that went away (see
+        JobJournal.take_over), unless we did this less than <min_interval>
+        seconds ago.
+        """
+        if self.journal is None:
+            return
+        state = self._state.get()
+        now = time.time()
+        with state.lock:
+            if state.taken_over is not None and now - state.taken_over < min_interval:
+                return
+            state.taken_over = now
+        try:
+            jobs = self.journal.take_over()
+        except sqlite3.Error as e:
+            logger.error("Could not take over jobs from journal: %s", e)
+            return
+        if jobs:
+            logger.info("Resuming %d background jobs from journal", len(jobs))
+        for job_id, priority, name, args, queued in jobs:
+            self._put(priority, job_id, name, args, queued)
+
+    def submit(self, name, args=(), priority=PRIORITY_NORMAL):
+        """
+        Queue a job running job function <name> with <args>.
+        """
+        args = list(args)
+        queued = time.time()
+        job_id = None
+        if self.journal is not None:
+            job_id = self.journal.add(priority, name, args, queued)
+        self._put(priority, job_id, name, args, queued)
+
+    def _put(self, priority, job_id, name, args, queued):
+        state = self._state.get()
+        state.queue.put((priority, next(state.order), job_id, name, args, queued))
+        with state.lock:
+            if len(state.threads) < self.workers:
+                thread = threading.Thread(target=self._work, args=(state, ), name='bepasty-jobs')
+                state.threads.append(thread)
+                thread.start()
+
+    def _work(self, state):
+        while True:
+            with state.lock:
+                try:
+                    job = state.queue.get_nowait()
+                except queue.Empty:
+                    # while we hold the lock, _put can not rely on us any more
+                    state.threads.remove(threading.current_thread())
+                    return
+                state.running += 1
+            self._run(state, *job)
+
+    def _run(self, state, priority, order, job_id, name, args, queued):
+        started = time.time()
+        failed = False
+        try:
+            with self.app.app_context():
+                job_functions[name](*args)
+        except Exception:
+            failed = True
+            logger.exception("Background job %s%r failed", name, tuple(args))
+        finally:
+            # failed jobs are not retried, they would likely fail again
+            if job_id is not None:
+                self.journal.done(job_id)
+            with state.lock:
+                state.running -= 1
+                state.done += 1
+                state.failed += failed
+                state.wait_time += started - queued
+                state.run_time += time.time() - started
+            state.queue.task_done()
+
+    def join(self):
+        """
+        Wait until all queued jobs (of this process) are done.
+        """
+        self._state.get().queue.join()
+
+    def stats(self):
+        """
+        Return a dict with statistics about the queue of this process (times are in seconds).
+        """
+        state = self._state.get()
+        now = time.time()
+        with state.queue.mutex:
+            queued = [job[-1] for job in state.queue.queue]
+        with state.lock:
+            done = state.done
+            return {
+                'queued': len(queued),
+                'running': state.running,
+                'workers': self.workers,
+                'done': done,
+                'failed': state.failed,
+                'max_wait_time': now - min(queued) if queued else 0.0,
+                'avg_wait_time': state.wait_time / done if done else 0.0,
+                'avg_run_time': state.run_time / done if done else 0.0,
+            }
+
+
+def create_job_queue(app):
+    journal_path = app.config.get('JOB_JOURNAL')
+    journal = JobJournal(journal_path) if journal_path else None
+    return JobQueue(app, workers=app.config.get('JOB_WORKERS', 2), journal=journal)
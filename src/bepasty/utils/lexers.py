@@ -0,0 +1,142 @@
+"""
+Registry of the Pygments lexers and the content types they support.
+"""
+
+from fnmatch import fnmatchcase
+import json
+import os
+import re
+import threading
+
+from markupsafe import Markup
+from pygments.lexers import find_lexer_class, get_all_lexers
+
+# filename patterns we can look up by the filename extension
+_simple_pattern_re = re.compile(r'\*\.[^*?\[]+')
+
+
+class LexerRegistry:
+    """
+    The information about the Pygments lexers we need, collected once per
+    process (when first used), so we do not need to walk all the lexers for
+    every request (like the lookup functions of Pygments do).
+
+    Lexer classes are only loaded when needed, lexer instances are cached.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._built = False
+        self._lexers = {}
+
+    def _build(self):
+        if self._built:
+            return
+        with self._lock:
+            if self._built:
+                return
+            self._mimetypes = {}  # content type -> lexer name
+            self._alias_contenttypes = {}  # first alias -> content type
+            self._extensions = {}  # filename extension -> [(lexer name, pattern), ...]
+            self._patterns = []  # [(lexer name, pattern), ...] not matching by extension
+            self._lexer_mimetypes = {}  # lexer name -> content types
+            contenttypes = [
+                'text/x-bepasty-redirect',  # redirect/link shortener service
+            ]
+            # (name, aliases, filenames, mimetypes)
+            # e.g. ('Diff', ('diff',), ('*.diff', '*.patch'), ('text/x-diff', 'text/x-patch'))
+            for name, aliases, filenames, mimetypes in get_all_lexers():
+                contenttypes.extend(mimetypes)
+                self._lexer_mimetypes[name] = mimetypes
+                for mimetype in mimetypes:
+                    # like get_lexer_for_mimetype, the first lexer wins
+                    self._mimetypes.setdefault(mimetype, name)
+                for pattern in filenames:
+                    if _simple_pattern_re.fullmatch(pattern):
+                        self._extensions.setdefault(pattern[1:], []).append((name, pattern))
+                    else:
+                        self._patterns.append((name, pattern))
+                if aliases:
+                    # Find a content type, preferably one with text/*
+                    for ct in mimetypes:
+                        if ct.startswith('text/'):
+                            break
+                    else:
+                        ct = mimetypes[0] if mimetypes else None
+                    if ct:
+                        self._alias_contenttypes[aliases[0]] = ct
+            self._contenttypes = contenttypes
+            self._contenttypes_json = Markup(json.dumps(contenttypes))
+            self._built = True
+
+    @property
+    def contenttypes(self):
+        """
+        List of the content types for the upload form: the ones of all lexers
+        and bepasty's redirect type.
+        """
+        self._build()
+        return self._contenttypes
+
+    @property
+    def contenttypes_json(self):
+        """
+        The contenttypes, rendered as JSON array (for the templates).
+        """
+        self._build()
+        return self._contenttypes_json
+
+    def has_mimetype(self, mimetype):
+        """
+        Return whether there is a lexer for <mimetype>.
+        """
+        self._build()
+        return mimetype in self._mimetypes
+
+    def lexer(self, mimetype, **options):
+        """
+        Return a lexer for <mimetype> with <options> (like get_lexer_for_mimetype).
+
+        :raises KeyError: if there is none
+        """
+        self._build()
+        key = mimetype, tuple(sorted(options.items()))
+        lexer = self._lexers.get(key)
+        if lexer is None:
+            lexer = self._lexers[key] = find_lexer_class(self._mimetypes[mimetype])(**options)
+        return lexer
+
+    def contenttype_for_alias(self, alias):
+        """
+        Return the content type for the lexer with (first) alias <alias>, or None.
+        """
+        self._build()
+        return self._alias_contenttypes.get(alias)
+
+    def contenttype_for_filename(self, filename):
+        """
+        Return the (first) content type of the lexer for <filename> (like
+        get_lexer_for_filename), or None.
+        """
+        self._build()
+        fn = os.path.basename(filename)
+        matches = []
+        pos = fn.find('.')
+        while pos >= 0:
+            matches.extend(self._extensions.get(fn[pos:], []))
+            pos = fn.find('.', pos + 1)
+        matches.extend((name, pattern) for name, pattern in self._patterns if fnmatchcase(fn, pattern))
+        if not matches:
+            return None
+
+        def rating(match):
+            # like get_lexer_for_filename: explicit filenames are preferred
+            name, pattern = match
+            cls = find_lexer_class(name)
+            return cls.priority + (0 if '*' in pattern else 0.5), cls.__name__
+
+        name, _ = max(matches, key=rating)
+        mimetypes = self._lexer_mimetypes[name]
+        return mimetypes[0] if mimetypes else None
+
+
+lexer_registry = LexerRegistry()
@@ -0,0 +1,220 @@
+"""
+Line-offset index of text items, to read ranges of lines without reading all the data.
+"""
+
+from array import array
+from collections import OrderedDict
+import logging
+import sys
+import threading
+
+from flask import current_app
+
+from ..constants import HASH, TYPE
+from .jobs import PRIORITY_LOW, background
+
+logger = logging.getLogger(__name__)
+
+# we keep the offset of every LINE_INDEX_STEP-th line
+LINE_INDEX_STEP = 1000
+# for smaller items, making the index on the fly is cheap, so we do not store it
+LINE_INDEX_MIN_SIZE = 1024 * 1024
+
+BLOCK_SIZE = 64 * 1024
+
+
+def skip_lines(data, offset, count):
+    """
+    Return the offset of the line <count> lines after the one starting at <offset> in <data>.
+
+    If the data ends before, return its size.
+    """
+    size = data.size
+    while count > 0 and offset < size:
+        buf = data.read(min(BLOCK_SIZE, size - offset), offset)
+        if not buf:
+            break
+        newlines = buf.count(b'\n')
+        if newlines < count:
+            count -= newlines
+            offset += len(buf)
+            continue
+        pos = -1
+        for _ in range(count):
+            pos = buf.index(b'\n', pos + 1)
+        return offset + pos + 1
+    return offset if count == 0 else size
+
+
+class LineIndex:
+    """
+    Number of lines and offsets of every <step>-th line (starting with the
+    first) of the data of an item.
+    """
+    def __init__(self, count, offsets, step=LINE_INDEX_STEP):
+        self.count = count
+        self.offsets = offsets
+        self.step = step
+
+    @classmethod
+    def build(cls, data, step=LINE_INDEX_STEP):
+        """
+        Make the index of <data> (an item's Data), reading it once.
+        """
+        size = data.size
+        offsets = array('Q', [0])
+        count = 0  # newlines before offset
+        offset = 0
+        while offset < size:
+            buf = data.read(min(BLOCK_SIZE, size - offset), offset)
+            if not buf:
+                break
+            pos = 0
+            while True:
+                # the line after the next <missing> newlines needs an entry
+                missing = step * len(offsets) - count
+                newlines = buf.count(b'\n', pos)
+                if newlines < missing:
+                    count += newlines
+                    break
+                for _ in range(missing):
+                    pos = buf.index(b'\n', pos) + 1
+                count += missing
+                offsets.append(offset + pos)
+            offset += len(buf)
+        if size and data.read(1, size - 1) != b'\n':
+            count += 1  # last line without newline
+        if offsets[-1] == size:
+            # the data ends with the newline before that line
+            offsets.pop()
+        return cls(count, offsets, step)
+
+    @classmethod
+    def from_bytes(cls, buf):
+        values = array('Q')
+        values.frombytes(buf)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return cls(values[0], values[2:], values[1])
+
+    def to_bytes(self):
+        values = array('Q', [self.count, self.step]) + self.offsets
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values.tobytes()
+
+    def offset(self, data, line):
+        """
+        Return the offset of (0-based) <line> in <data>.
+        """
+        if line >= self.count:
+            return data.size
+        checkpoint = line // self.step
+        return skip_lines(data, self.offsets[checkpoint], line - checkpoint * self.step)
+
+    def range(self, data, start, end):
+        """
+        Return the offsets (begin, end) of the (0-based) lines <start> up to (excluding) <end> in <data>.
+        """
+        begin = self.offset(data, start)
+        if end >= self.count:
+            return begin, data.size
+        if end // self.step > start // self.step:
+            # starting from the index is faster
+            return begin, self.offset(data, end)
+        return begin, skip_lines(data, begin, end - start)
+
+
+class LineIndexCache:
+    """
+    Least recently used LineIndex objects (in this process), up to
+    <max_entries>, so paging through an item does not read all of it for
+    every page (also for items that have no hash yet or no sidecar file).
+
+    Entries are keyed by item name, data size and hash.
+
+    We also keep the names of the items a job was queued for to make their
+    index (see get_line_index), so we do not queue it again and again.
+    """
+    def __init__(self, max_entries=100):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._queued = set()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            index = self._entries.get(key)
+            if index is not None:
+                self._entries.move_to_end(key)
+            return index
+
+    def put(self, key, index):
+        with self._lock:
+            self._entries[key] = index
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def queue(self, name):
+        """
+        Queue a job making the index of item <name>, unless one is queued already.
+        """
+        with self._lock:
+            if name in self._queued:
+                return
+            self._queued.add(name)
+        background_index_lines(name)
+
+    def done(self, name):
+        with self._lock:
+            self._queued.discard(name)
+
+
+line_indexes = LineIndexCache()
+
+
+def get_line_index(storage, name, item, build=True):
+    """
+    Return the LineIndex of the open item <name>.
+
+    Recently used ones are kept in memory (see LineIndexCache). For big items,
+    it is also cached in a sidecar file, keyed by the item hash.
+
+    Making the index of a big item reads all its data, so with build=False,
+    we rather queue a job doing that (see background_index_lines) and return
+    None, if the index is not cached yet.
+    """
+    size = item.data.size
+    memory_key = name, size, item.meta[HASH]
+    index = line_indexes.get(memory_key)
+    if index is not None:
+        return index
+    key = '{}-{}'.format(item.meta[HASH], LINE_INDEX_STEP) if item.meta[HASH] else None
+    cache = key is not None and size >= LINE_INDEX_MIN_SIZE
+    buf = storage.read_sidecar(name, 'lines', key) if cache else None
+    if buf is not None:
+        index = LineIndex.from_bytes(buf)
+    elif not build and size >= LINE_INDEX_MIN_SIZE:
+        line_indexes.queue(name)
+        return None
+    else:
+        index = LineIndex.build(item.data)
+        if cache:
+            try:
+                storage.write_sidecar(name, 'lines', key, index.to_bytes())
+            except OSError as e:
+                logger.warning("Could not store line index of %s: %s", name, e)
+    line_indexes.put(memory_key, index)
+    return index
+
+
+@background(priority=PRIORITY_LOW)
+def background_index_lines(name):
+    storage = current_app.storage
+    try:
+        with storage.open(name) as item:
+            if item.meta[TYPE].startswith('text/') and item.data.size >= LINE_INDEX_MIN_SIZE:
+                get_line_index(storage, name, item)
+    finally:
+        line_indexes.done(name)
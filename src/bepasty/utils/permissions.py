@@ -32,18 +32,22 @@ def lookup_permissions(token):
     return current_app.config['PERMISSIONS'].get(token)
 
 
-def get_permissions():
+def get_permissions(use_form=True):
     """
     Get the permissions for the current user (if logged in)
     or the default permissions (if not logged in).
+
+    :param use_form: whether to look for a token in the POST form also
+                     (if False, the request body is not parsed)
     """
+    values = request.values if use_form else request.args
     auth = request.authorization
     if auth:
         # HTTP Basic auth header present
         permissions = lookup_permissions(auth.password)
-    elif 'token' in request.values:
+    elif 'token' in values:
         # Token present in query args or POST form (can be used by CLI clients)
-        permissions = lookup_permissions(request.values['token'])
+        permissions = lookup_permissions(values['token'])
     else:
         # Look into the session; login might have put something there
         permissions = session.get(PERMISSIONS)
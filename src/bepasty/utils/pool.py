@@ -0,0 +1,148 @@
+"""
+Pool of worker processes for CPU-bound work.
+"""
+
+import atexit
+import logging
+import multiprocessing
+import threading
+
+from .process import ProcessLocal
+
+logger = logging.getLogger(__name__)
+
+
+def _work(conn):
+    """
+    Main function of a worker process: run the jobs received through <conn>
+    and send back (True, result) or (False, exception).
+    """
+    while True:
+        try:
+            func, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            result = True, func(*args)
+        except Exception as e:
+            result = False, e
+        try:
+            conn.send(result)
+        except Exception as e:
+            # e.g. the result can not be pickled
+            conn.send((False, RuntimeError(f'Could not send result: {e!r}')))
+
+
+class Worker:
+    """
+    A worker process, running one job at a time.
+    """
+    def __init__(self, context):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_work, args=(child_conn, ), name='bepasty-worker', daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class PoolState:
+    """
+    Worker processes of a WorkerPool in one process.
+    """
+    def __init__(self, processes):
+        self.idle = []
+        self.workers = set()
+        # limits the number of jobs running at once
+        self.slots = threading.BoundedSemaphore(processes)
+        self.lock = threading.Lock()
+
+
+class WorkerPool:
+    """
+    Run functions in up to <processes> worker processes, so CPU-bound work
+    (like decoding images) does not block the request threads and can be
+    stopped if it takes too long.
+
+    Every worker process runs one job at a time, so if a job times out, just
+    its process gets killed (a new one is started when needed), the jobs
+    running in the other ones are not affected.
+
+    With processes=0, functions are just called (without timeout).
+    """
+    def __init__(self, processes=2):
+        self.processes = processes
+        # the worker processes of the process we were forked from are not ours
+        self._state = ProcessLocal(lambda: PoolState(self.processes))
+        atexit.register(self.close)
+
+    def _take_worker(self, state):
+        with state.lock:
+            if state.idle:
+                return state.idle.pop()
+        # forking a multi-threaded server process is not safe, so spawn
+        worker = Worker(multiprocessing.get_context('spawn'))
+        with state.lock:
+            state.workers.add(worker)
+        return worker
+
+    def _release_worker(self, state, worker, reuse):
+        if reuse:
+            with state.lock:
+                state.idle.append(worker)
+            return
+        with state.lock:
+            state.workers.discard(worker)
+        worker.kill()
+
+    def run(self, timeout, func, *args):
+        """
+        Run func(*args) in a worker process and return its result.
+
+        func must be importable by name (a module level function).
+
+        :raises TimeoutError: if it did not finish within <timeout> seconds
+        """
+        if not self.processes:
+            return func(*args)
+        state = self._state.get()
+        with state.slots:
+            worker = self._take_worker(state)
+            reuse = False
+            try:
+                worker.conn.send((func, args))
+                if worker.conn.poll(timeout):
+                    ok, value = worker.conn.recv()
+                    reuse = True
+                else:
+                    # the arguments might be big (e.g. item data), so we just log their sizes
+                    sizes = [len(arg) if isinstance(arg, (str, bytes)) else type(arg).__name__ for arg in args]
+                    logger.warning("Killing worker process, %s (arguments: %s) took longer than %ss",
+                                   func.__name__, ', '.join(map(str, sizes)), timeout)
+                    ok, value = False, TimeoutError()
+            except EOFError:
+                ok, value = False, RuntimeError('Worker process died')
+            finally:
+                self._release_worker(state, worker, reuse)
+        if not ok:
+            raise value
+        return value
+
+    def close(self):
+        """
+        Terminate the worker processes (new ones are started when needed).
+        """
+        state = self._state.pop()
+        if state is None:
+            return
+        with state.lock:
+            workers, state.workers, state.idle = state.workers, set(), []
+        for worker in workers:
+            worker.kill()
+
+
+def create_worker_pool(app):
+    return WorkerPool(app.config.get('WORKER_PROCESSES', 2))
@@ -0,0 +1,110 @@
+"""
+Helpers for objects used by several server processes.
+
+Servers may fork their processes after the app was created. Threads do not
+survive a fork, locks held by them stay locked in the child and SQLite
+connections must not be used by two processes, so such objects are kept
+per process (see ProcessLocal).
+"""
+
+import os
+import sqlite3
+import threading
+
+_lock = threading.Lock()
+
+
+def _reinit_lock():
+    # another thread might have held it when forking
+    global _lock
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reinit_lock)
+
+
+class ProcessLocal:
+    """
+    A value every process has its own of, made by calling <factory> when
+    get() is first called in a process (in a forked process, the value of
+    the parent is not used).
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self._pid = None
+        self._value = None
+
+    def get(self):
+        if self._pid != os.getpid():
+            with _lock:
+                if self._pid != os.getpid():
+                    self._value = self.factory()
+                    self._pid = os.getpid()
+        return self._value
+
+    def pop(self):
+        """
+        Forget the value of this process and return it (None if there is none).
+        """
+        with _lock:
+            if self._pid != os.getpid():
+                return None
+            value, self._value, self._pid = self._value, None, None
+            return value
+
+
+class ProcessThread:
+    """
+    Daemon thread running <target>(stop), where stop is a threading.Event
+    that gets set when the thread should end.
+
+    start() starts it unless it already runs in this process. This is cheap,
+    call it whenever convenient (so it runs in the maybe forked server process).
+    """
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self._thread = ProcessLocal(self._start)
+
+    def _start(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=self.target, args=(stop, ), name=self.name, daemon=True)
+        thread.start()
+        return thread, stop
+
+    def start(self):
+        self._thread.get()
+
+    def stop(self):
+        """
+        Stop the thread of this process (if it runs) and wait for it to end.
+        """
+        value = self._thread.pop()
+        if value is not None:
+            thread, stop = value
+            stop.set()
+            thread.join()
+
+
+class SQLiteConnections:
+    """
+    Connections to the SQLite database <path> (made with sqlite3.connect
+    <kwargs>), one per process and thread, as sqlite3 connections must not
+    be shared between threads nor used in forked processes.
+
+    They use WAL mode, which lets readers proceed while another process
+    writes.
+    """
+    def __init__(self, path, **kwargs):
+        self.path = path
+        self.kwargs = kwargs
+        self._local = ProcessLocal(threading.local)
+
+    def get(self):
+        local = self._local.get()
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, **self.kwargs)
+            conn.execute('PRAGMA journal_mode=WAL')
+            local.conn = conn
+        return conn
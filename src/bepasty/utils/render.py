@@ -0,0 +1,48 @@
+"""
+Limits for rendering items.
+"""
+
+
+class RenderLimits:
+    """
+    Decide whether items may be rendered, given their type and size.
+
+    <max_render_size> is the MAX_RENDER_SIZE table, sorted once here.
+
+    For syntax highlighting, the limit of 'HIGHLIGHT_TYPES' always applies,
+    but with a <time_budget> (in seconds), bigger items are highlighted, too,
+    if the throughput of the lexer (learned from past renders, see
+    HighlightStats) lets us expect it to finish in time.
+    """
+    def __init__(self, max_render_size, time_budget=None, stats=None):
+        # [(content_type_prefix, max_size), ...] with long prefixes first
+        self.max_render_size = sorted(max_render_size.items(), key=lambda e: len(e[0]), reverse=True)
+        self.time_budget = time_budget
+        self.stats = stats
+
+    def max_size(self, item_type):
+        for ct, size in self.max_render_size:
+            if item_type.startswith(ct):
+                return size
+        # There should be one entry with ct == '', so we should never get here:
+        return -1
+
+    def allowed(self, item_type, item_size, highlight_type=None):
+        """
+        Return whether an item of <item_type> and <item_size> may be rendered.
+
+        :param highlight_type: content type of the lexer, if it is rendered with syntax highlighting
+        """
+        if highlight_type is None:
+            return item_size <= self.max_size(item_type)
+        if item_size <= self.max_size('HIGHLIGHT_TYPES'):
+            return True
+        if not self.time_budget or self.stats is None:
+            return False
+        throughput = self.stats.throughput(highlight_type)
+        return throughput is not None and item_size <= throughput * self.time_budget
+
+
+def create_render_limits(app):
+    return RenderLimits(app.config['MAX_RENDER_SIZE'], app.config.get('HIGHLIGHT_TIME_BUDGET'),
+                        app.highlight_stats)
@@ -0,0 +1,122 @@
+"""
+Thumbnails of image items.
+"""
+
+from io import BytesIO
+import logging
+
+try:
+    import PIL
+except ImportError:
+    # Pillow / PIL is optional
+    PIL = None
+else:
+    from PIL import Image
+
+from flask import current_app
+
+from ..constants import HASH, TYPE
+from .jobs import PRIORITY_LOW, background
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZE = 192, 108
+
+# content type -> thumbnail type
+THUMBNAIL_TYPES = {
+    'image/jpeg': 'jpeg',
+    'image/png': 'png',
+    'image/gif': 'png',
+    'image/webp': 'webp',
+}
+
+
+def thumbnail_type(content_type):
+    """
+    Return the type of the thumbnail for items of <content_type> (None if we can not make one).
+    """
+    if PIL is None:
+        return None
+    return THUMBNAIL_TYPES.get(content_type)
+
+
+def render_thumbnail(path, thumbnail_type, size=THUMBNAIL_SIZE, max_pixels=None):
+    """
+    Compute the thumbnail of the image in file <path> (or in <path> bytes).
+
+    This runs in a worker process (see WorkerPool).
+
+    :param max_pixels: refuse to decode images with more pixels than this
+    """
+    if isinstance(path, bytes):
+        path = BytesIO(path)
+    with Image.open(path) as img:
+        width, height = img.size
+        if max_pixels and width * height > max_pixels:
+            raise ValueError('Image too big for a thumbnail: {}x{}'.format(width, height))
+        # For JPEG, decode at a reduced scale, so the full size bitmap is never
+        # made (no-op for other formats).
+        img.draft(img.mode, size)
+        img.thumbnail(size)
+        with BytesIO() as thumbnail_bio:
+            img.save(thumbnail_bio, thumbnail_type)
+            return thumbnail_bio.getvalue()
+
+
+def permanent_failure(exc):
+    """
+    Return whether making a thumbnail failed with <exc> because of the image
+    itself (e.g. it is too big or can not be decoded), so it would fail again.
+    """
+    if isinstance(exc, TimeoutError):
+        # an OSError, but not a decoding error
+        return False
+    return isinstance(exc, (OSError, ValueError, SyntaxError, Image.DecompressionBombError))
+
+
+def get_thumbnail(storage, name, item):
+    """
+    Return the thumbnail of the open image item <name>, or None if we can not make one.
+
+    Thumbnails are made in the app's worker pool and cached in a sidecar
+    file, keyed by the item hash (so we only cache after the hash is known).
+    If making the thumbnail fails for a reason that does not go away (see
+    permanent_failure), we cache that, too, so we do not try again.
+    """
+    ttype = thumbnail_type(item.meta[TYPE])
+    if ttype is None:
+        return None
+    key = '{}-{}x{}'.format(item.meta[HASH], *THUMBNAIL_SIZE) if item.meta[HASH] else None
+    if key is not None:
+        thumbnail_data = storage.read_sidecar(name, 'thumb', key)
+        if thumbnail_data is not None:
+            # empty if it failed before
+            return thumbnail_data or None
+    config = current_app.config
+    path = item.data.path
+    if path is None:
+        # stored compressed, so we must send the data to the worker
+        path = item.data.read(item.data.size, 0)
+    try:
+        thumbnail_data = current_app.worker_pool.run(
+            config.get('THUMBNAIL_TIMEOUT', 10), render_thumbnail,
+            path, ttype, THUMBNAIL_SIZE, config.get('THUMBNAIL_MAX_PIXELS'))
+    except Exception as e:
+        logger.warning("Could not make thumbnail of %s: %s", name, repr(e))
+        if not permanent_failure(e):
+            # e.g. a timeout or the worker process died, might work next time
+            return None
+        thumbnail_data = b''
+    if key is not None:
+        try:
+            storage.write_sidecar(name, 'thumb', key, thumbnail_data)
+        except OSError as e:
+            logger.warning("Could not cache thumbnail of %s: %s", name, e)
+    return thumbnail_data or None
+
+
+@background(priority=PRIORITY_LOW)
+def background_make_thumbnail(name):
+    storage = current_app.storage
+    with storage.open(name) as item:
+        get_thumbnail(storage, name, item)
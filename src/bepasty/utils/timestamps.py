@@ -0,0 +1,105 @@
+"""
+Write-behind of download timestamps.
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+from flask import current_app
+
+from ..constants import TIMESTAMP_DOWNLOAD
+from .jobs import PRIORITY_LOW, background
+from .process import ProcessThread
+
+logger = logging.getLogger(__name__)
+
+
+def write_download_timestamps(storage, timestamps):
+    """
+    Write the download timestamps in dict <timestamps> (name -> timestamp) into the item metadata.
+    """
+    for name, timestamp in timestamps.items():
+        try:
+            # the lock keeps us from overwriting concurrent changes of upload ranges
+            with storage.openlocked(name) as item:
+                if timestamp > item.meta.get(TIMESTAMP_DOWNLOAD, 0):
+                    item.meta[TIMESTAMP_DOWNLOAD] = timestamp
+        except FileNotFoundError:
+            # item was deleted meanwhile
+            pass
+        except OSError as e:
+            logger.error("Could not write download timestamp of %s: %s", name, e)
+
+
+@background(priority=PRIORITY_LOW)
+def background_write_download_timestamps(timestamps):
+    write_download_timestamps(current_app.storage, timestamps)
+
+
+class DownloadTimestamps:
+    """
+    Download timestamps of items, collected in memory and written to their
+    metadata in batches (see DOWNLOAD_TIMESTAMP_INTERVAL).
+
+    So serving an item does not need to write its metadata. The timestamps
+    not written yet are lost if the process crashes.
+
+    Besides with the next download after the interval, they are written by a
+    thread every interval (see start), so they do not stay pending when there
+    are no more downloads.
+    """
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config.get('DOWNLOAD_TIMESTAMP_INTERVAL', 60)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._written = time.time()
+        self._thread = ProcessThread(self._run, 'bepasty-download-timestamps')
+        atexit.register(self.flush)
+
+    def start(self):
+        """
+        Start the thread writing the pending timestamps, unless it is already
+        running in this process (see ProcessThread).
+        """
+        if self.interval:
+            self._thread.start()
+
+    def stop(self):
+        self._thread.stop()
+
+    def _run(self, stop):
+        while not stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Writing download timestamps failed")
+
+    def record(self, name):
+        """
+        Record that item <name> was downloaded now.
+
+        This may be called after the request context is gone (e.g. when the
+        WSGI server closes the file it sent).
+        """
+        now = int(time.time())
+        with self._lock:
+            self._pending[name] = now
+            if now - self._written < self.interval:
+                return
+            pending, self._pending = self._pending, {}
+            self._written = now
+        with self.app.app_context():
+            background_write_download_timestamps(pending)
+
+    def flush(self):
+        """
+        Write all pending timestamps now.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._written = time.time()
+        if pending:
+            write_download_timestamps(self.app.storage, pending)
@@ -1,9 +1,8 @@
+import os
 import re
 import time
 import mimetypes
-from pygments.lexers import get_lexer_for_filename
-from pygments.util import ClassNotFound as NoPygmentsLexer
-from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.exceptions import BadRequest, Conflict, RequestEntityTooLarge
 
 from flask import current_app
 
@@ -21,6 +20,7 @@ from ..constants import (
     FOREVER,
     HASH,
     LOCKED,
+    RANGES,
     SIZE,
     TIMESTAMP_DOWNLOAD,
     TIMESTAMP_MAX_LIFE,
@@ -30,8 +30,12 @@ from ..constants import (
     internal_meta,
 )
 from .name import ItemName
-from .decorators import threaded
-from .hashing import compute_hash, hash_new
+from .jobs import background
+from .compression import background_compress_data, background_precompress
+from .hashing import compute_hash, hash_new, hash_states
+from .lexers import lexer_registry
+from .lines import background_index_lines
+from .thumbnail import background_make_thumbnail
 
 # We limit to 250 characters as we do not want to accept arbitrarily long
 # filenames. Other than that, there is no specific reason we could not
@@ -91,13 +95,7 @@ class Upload:
             ct, encoding = mimetypes.guess_type(filename)
 
             if not ct:
-                try:
-                    lexer = get_lexer_for_filename(filename)
-                except NoPygmentsLexer:
-                    pass
-                else:
-                    if len(lexer.mimetypes) > 0:
-                        ct = lexer.mimetypes[0]
+                ct = lexer_registry.contenttype_for_filename(filename)
         if not ct:
             return ct_hint, True
         return cls._type_re.sub('', ct)[:50], False
@@ -129,14 +127,56 @@ class Upload:
         item.meta[COMPLETE] = True
         item.meta[HASH] = file_hash
 
+    @classmethod
+    def check_range(cls, item, content_range):
+        """
+        Check whether a chunk with <content_range> may still be written into <item>.
+
+        The total size in <content_range> must be the one announced when the
+        upload started (the SIZE of the incomplete item).
+        """
+        if item.meta[COMPLETE]:
+            raise Conflict(description='Upload already complete')
+        if content_range.complete != item.meta[SIZE]:
+            raise Conflict(description='Content-Range inconsistent with previous chunks')
+
+    @classmethod
+    def receive_range(cls, storage, name, begin, end, total):
+        """
+        Record that data[begin:end] of item <name> (with <total> size) was written.
+
+        Chunks may be uploaded in any order and in parallel, so we keep the
+        ranges received so far in the metadata (updated under a lock) and
+        complete the item when they cover all the data.
+
+        :return: True if this completed the item
+        """
+        with storage.openlocked(name) as item:
+            if item.meta[COMPLETE]:
+                return False
+            ranges = merge_range(item.meta.get(RANGES, []), begin, end)
+            if ranges != [[0, total]]:
+                item.meta[RANGES] = ranges
+                return False
+            item.meta.pop(RANGES, None)
+            size = item.meta[SIZE] = item.data.size
+            # the hash is known if all chunks were hashed in order (see HashStates)
+            file_hash = hash_states.resume(name, size).hexdigest()
+            cls.meta_complete(item, file_hash)
+        item_completed(name, file_hash)
+        return True
+
     @staticmethod
-    def data(item, f, size_input, offset=0):
+    def data(item, f, size_input, offset=0, hasher=None):
         """
         Copy data from a temporary file into storage.
+
+        :param hasher: hash object to continue hashing with (default: a new one)
         """
         read_length = 16 * 1024
         size_written = 0
-        hasher = hash_new()
+        if hasher is None:
+            hasher = hash_new()
 
         while True:
             read_length = min(read_length, size_input)
@@ -169,9 +209,178 @@ def create_item(f, filename, size, content_type, content_type_hint,
         Upload.meta_new(item, size, filename, content_type, content_type_hint,
                         name, maxlife_stamp=maxlife_stamp)
         Upload.meta_complete(item, file_hash)
+    item_completed(name, file_hash)
     return name
 
 
+def item_completed(name, file_hash):
+    """
+    Start the background work for item <name>, which just got complete.
+    """
+    if not file_hash:
+        # this calls us again when done
+        background_compute_hash(name)
+        return
+    if current_app.config.get('THUMBNAIL_EAGER'):
+        background_make_thumbnail(name)
+    background_index_lines(name)
+    background_precompress(name)
+    # queued last, so the jobs above usually read the data before it gets compressed
+    background_compress_data(name)
+
+
+def merge_range(ranges, begin, end):
+    """
+    Add range [begin, end) to the sorted list of disjoint [begin, end) ranges <ranges>.
+
+    :return: new list, with overlapping or adjacent ranges merged
+    """
+    result = []
+    for r_begin, r_end in ranges:
+        if r_end < begin or end < r_begin:
+            result.append([r_begin, r_end])
+        else:
+            begin, end = min(begin, r_begin), max(end, r_end)
+    result.append([begin, end])
+    result.sort()
+    return result
+
+
+class ItemWriter:
+    """
+    Writable file-like object, writing into the data of a storage item.
+
+    File uploads in multipart forms get written into storage items through
+    this while the request is parsed (see bepasty.app.Request), so the data
+    does not need to be spooled to a temporary file and copied into storage
+    afterwards. While writing, we compute the hash and check the size limit.
+
+    When closed, a new item is removed again unless it was claimed by the view.
+    """
+    def __init__(self, storage, name, item, offset=0, new=False, hasher=None, max_size=None):
+        """
+        :param max_size: the most bytes we may write (e.g. the size of the
+                         chunk given in Content-Range)
+        """
+        self.storage = storage
+        self.name = name
+        self.item = item
+        self.offset = offset
+        self.new = new
+        self.max_size = max_size
+        self.size = 0
+        self.claimed = False
+        self.closed = False
+        self._hasher = hash_new() if hasher is None else hasher
+        self._max_size = current_app.config['MAX_ALLOWED_FILE_SIZE']
+        self._pos = 0
+
+    @classmethod
+    def create(cls, storage):
+        """
+        Create a new item to write into.
+        """
+        name = ItemName.create(storage)
+        return cls(storage, name, storage.create(name, 0), new=True)
+
+    @classmethod
+    def open(cls, storage, name, content_range=None):
+        """
+        Open the existing, incomplete item <name> to write into the chunk
+        given by <content_range> (or all data, if None).
+
+        We check that the chunk may be written (see Upload.check_range) before
+        any data is written.
+
+        If we have the hash state of the data before the chunk, we continue
+        hashing, so the hash of the whole data is known after the last chunk.
+        """
+        item = storage.openwrite(name)
+        try:
+            if content_range is None:
+                if item.meta[COMPLETE]:
+                    raise Conflict(description='Upload already complete')
+                offset, max_size = 0, None
+            else:
+                Upload.check_range(item, content_range)
+                offset, max_size = content_range.begin, content_range.size
+        except BaseException:
+            item.close()
+            raise
+        return cls(storage, name, item, offset=offset,
+                   hasher=hash_states.resume(name, offset), max_size=max_size)
+
+    def write(self, buf):
+        if self.offset + self.size + len(buf) > self._max_size:
+            raise RequestEntityTooLarge()
+        if self.max_size is not None and self.size + len(buf) > self.max_size:
+            raise BadRequest(description='Content-Range inconsistent with uploaded data')
+        self.item.data.write(buf, self.offset + self.size)
+        self._hasher.update(buf)
+        self.size += len(buf)
+        return len(buf)
+
+    def hexdigest(self):
+        """
+        Return the hash of the data written so far (empty if unknown).
+        """
+        return self._hasher.hexdigest()
+
+    def suspend_hash(self):
+        """
+        Keep the hash state, so the next chunk written after this one can continue it.
+        """
+        hash_states.suspend(self.name, self.offset + self.size, self._hasher)
+
+    # werkzeug wants a readable and seekable file, offer the written data:
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self.size
+        self._pos = max(0, pos)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        remaining = max(0, self.size - self._pos)
+        size = remaining if size < 0 else min(size, remaining)
+        buf = self.item.data.read(size, self.offset + self._pos)
+        self._pos += len(buf)
+        return buf
+
+    def claim(self):
+        """
+        Take over the item (it will not get removed when closing) and return it.
+        """
+        self.claimed = True
+        return self.item
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.item.close()
+        if self.new and not self.claimed:
+            self.storage.remove(self.name)
+
+
+def create_item_from_writer(writer, filename, content_type, content_type_hint,
+                            maxlife_stamp=FOREVER):
+    """
+    Complete the new item an ItemWriter has written the data into and return the item name.
+    """
+    with writer.claim() as item:
+        Upload.meta_new(item, writer.size, filename, content_type, content_type_hint,
+                        writer.name, maxlife_stamp=maxlife_stamp)
+        Upload.meta_complete(item, writer.hexdigest())
+    item_completed(writer.name, writer.hexdigest())
+    return writer.name
+
+
 def filter_internal(meta):
     """
     Filter internal metadata out.
@@ -179,9 +388,13 @@ def filter_internal(meta):
     return {k: v for k, v in meta.items() if k not in internal_meta}
 
 
-@threaded
-def background_compute_hash(storage, name):
-    with storage.openwrite(name) as item:
-        size = item.meta[SIZE]
-        file_hash = compute_hash(item.data, size)
+@background()
+def background_compute_hash(name):
+    storage = current_app.storage
+    with storage.open(name) as item:
+        file_hash = compute_hash(item.data, item.meta[SIZE])
+    # other metadata might have changed meanwhile (e.g. download timestamps),
+    # so we only set the hash, under the lock
+    with storage.openlocked(name) as item:
         item.meta[HASH] = file_hash
+    item_completed(name, file_hash)
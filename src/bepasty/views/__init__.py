@@ -3,7 +3,7 @@ from flask import Blueprint
 
 from .delete import DeleteView
 from .display import DisplayView, CarouselView
-from .download import DownloadView, InlineView, ThumbnailView
+from .download import DownloadView, InlineView, LinesView, ThumbnailView
 from .modify import ModifyView
 from .qr import QRView
 from .filelist import FileListView
@@ -28,6 +28,7 @@ blueprint.add_url_rule('/<itemname:name>/+delete', view_func=DeleteView.as_view(
 blueprint.add_url_rule('/<itemname:name>/+download', view_func=DownloadView.as_view('download'))
 blueprint.add_url_rule('/<itemname:name>/+inline', view_func=InlineView.as_view('inline'))
 blueprint.add_url_rule('/<itemname:name>/+thumbnail', view_func=ThumbnailView.as_view('thumbnail'))
+blueprint.add_url_rule('/<itemname:name>/+lines', view_func=LinesView.as_view('lines'))
 blueprint.add_url_rule('/<itemname:name>/+modify', view_func=ModifyView.as_view('modify'))
 blueprint.add_url_rule('/<itemname:name>/+qr', view_func=QRView.as_view('qr'))
 blueprint.add_url_rule('/<itemname:name>/+lock', view_func=LockView.as_view('lock'))
@@ -29,6 +29,7 @@ class DeleteView(MethodView):
                     raise Forbidden()
 
             current_app.storage.remove(name)
+            current_app.highlight_cache.invalidate(name)
 
         except OSError as e:
             if e.errno == errno.ENOENT:
@@ -1,42 +1,35 @@
 import errno
-import time
 
-from flask import current_app, render_template, url_for, request
+from flask import Response, current_app, render_template, request, stream_template, url_for
 from flask.views import MethodView
 from markupsafe import Markup
 from werkzeug.exceptions import NotFound, Forbidden
-from pygments import highlight
-from pygments.lexers import get_lexer_for_mimetype
-from pygments.util import ClassNotFound as NoPygmentsLexer
 
-from ..constants import COMPLETE, FILENAME, LOCKED, SIZE, TIMESTAMP_DOWNLOAD, TYPE
+from ..constants import COMPLETE, FILENAME, LOCKED, SIZE, TYPE
 from ..utils.date_funcs import delete_if_lifetime_over
-from ..utils.formatters import CustomHtmlFormatter
+from ..utils.highlight import FORMATTER_OPTIONS, get_highlighted, highlight_data, pygments_type
+from ..utils.lexers import lexer_registry
+from ..utils.lines import get_line_index
 from ..utils.permissions import ADMIN, READ, may
 
-from .index import contenttypes_list
 from .filelist import file_infos
 
 
-def rendering_allowed(item_type, item_size, use_pygments, complete):
+def rendering_allowed(item_type, item_size, use_pygments, complete, pygments_type=None):
     """
     Check whether rendering is allowed. It checks for:
 
     * whether the item is completely uploaded
     * whether the size is within the configured limits for the content type
+      (for syntax highlighting, see also HIGHLIGHT_TIME_BUDGET)
     """
     if not complete:
         return False
+    limits = current_app.render_limits
     if use_pygments:
         # If we use Pygments, special restrictions apply
-        item_type = 'HIGHLIGHT_TYPES'
-    # Create a tuple list [(content_type_prefix, max_size), ...] with long prefixes first
-    ct_size = sorted(current_app.config['MAX_RENDER_SIZE'].items(), key=lambda e: len(e[0]), reverse=True)
-    for ct, size in ct_size:
-        if item_type.startswith(ct):
-            return item_size <= size
-    # There should be one entry with ct == '', so we should never get here:
-    return False
+        return limits.allowed(item_type, item_size, highlight_type=pygments_type or item_type)
+    return limits.allowed(item_type, item_size)
 
 
 class DisplayView(MethodView):
@@ -44,7 +37,7 @@ class DisplayView(MethodView):
         if not may(READ):
             raise Forbidden()
         try:
-            item = current_app.storage.openwrite(name)
+            item = current_app.storage.open(name)
         except OSError as e:
             if e.errno == errno.ENOENT:
                 raise NotFound()
@@ -65,26 +58,17 @@ class DisplayView(MethodView):
             def read_data(item):
                 # Reading the item for rendering is registered like a download
                 data = item.data.read(item.data.size, 0)
-                item.meta[TIMESTAMP_DOWNLOAD] = int(time.time())
+                current_app.download_timestamps.record(name)
                 return data
 
             size = item.meta[SIZE]
             ct = item.meta[TYPE]
-            try:
-                get_lexer_for_mimetype(ct)
-                use_pygments = True
-                ct_pygments = ct
-            except NoPygmentsLexer:
-                if ct.startswith('text/'):
-                    # It seems we found a text type not supported by Pygments
-                    # Use text/plain so we get a display with line numbers
-                    use_pygments = True
-                    ct_pygments = 'text/plain'
-                else:
-                    use_pygments = False
+            ct_pygments = pygments_type(ct)
+            use_pygments = ct_pygments is not None
 
             is_list_item = False
-            if rendering_allowed(ct, size, use_pygments, complete):
+            lines = None
+            if rendering_allowed(ct, size, use_pygments, complete, ct_pygments):
                 if ct.startswith('text/x-bepasty-'):
                     # Special Bepasty items — must be first; don't feed to Pygments
                     if ct == 'text/x-bepasty-list':
@@ -127,29 +111,58 @@ class DisplayView(MethodView):
                                               (src, item.meta[FILENAME],
                                                current_app.config.get('ASCIINEMA_THEME', 'asciinema')))
                 elif use_pygments:
-                    text = read_data(item)
-                    # TODO: We don't have the encoding in metadata
-                    try:
-                        text = text.decode('utf-8')
-                    except UnicodeDecodeError:
-                        # Well, it is not UTF-8 or ASCII, so we can only guess...
-                        text = text.decode('iso-8859-1')
-                    lexer = get_lexer_for_mimetype(ct_pygments)
-                    formatter = CustomHtmlFormatter(linenos='table', lineanchors="L",
-                                                    lineparagraphs="L", anchorlinenos=True)
-                    rendered_content = Markup(highlight(text, lexer, formatter))
+                    rendered_content = get_highlighted(name, item, ct_pygments,
+                                                       current_app.config.get('HIGHLIGHT_STREAM_SIZE'))
+                    if isinstance(rendered_content, str):
+                        rendered_content = Markup(rendered_content)
+                    current_app.download_timestamps.record(name)
                 else:
                     rendered_content = "Can't render this content type."
+            elif complete and use_pygments and not ct.startswith('text/x-bepasty-'):
+                # too big to render all of it, render a page of lines
+                index = get_line_index(current_app.storage, name, item, build=False)
+                lines = None if index is None else self.lines_page(name, item, index, ct, ct_pygments)
+                if index is None:
+                    rendered_content = "This item is being indexed, to show it in pages of lines. Try again later."
+                elif lines is not None:
+                    rendered_content = Markup(lines.pop('html'))
+                else:
+                    rendered_content = "Rendering not allowed (lines too long?). Try downloading."
             else:
                 if not complete:
                     rendered_content = "Rendering not allowed (not complete). Is it still being uploaded?"
                 else:
                     rendered_content = "Rendering not allowed (too big?). Try downloading."
 
-            return render_template('display.html', name=name, item=item,
-                                   rendered_content=rendered_content,
-                                   contenttypes=contenttypes_list(),
-                                   is_list_item=is_list_item)
+            context = dict(name=name, item=item,
+                           rendered_content=rendered_content,
+                           contenttypes=lexer_registry.contenttypes_json,
+                           is_list_item=is_list_item,
+                           lines=lines)
+            if not isinstance(rendered_content, str):
+                # send the page while the content is rendered, see get_highlighted
+                return Response(stream_template('display.html', **context))
+            return render_template('display.html', **context)
+
+    def lines_page(self, name, item, index, ct, ct_pygments):
+        """
+        Highlight the DISPLAY_LINES lines of the open text item <name> (with
+        LineIndex <index>) from line number request.args['start'] (default: 1) on.
+
+        :return: dict with the html, the start, end and count of lines and the
+                 number of lines per page (None if the lines are too big to render)
+        """
+        start = max(1, request.args.get('start', 1, type=int))
+        start = min(start, max(1, index.count))
+        page = current_app.config.get('DISPLAY_LINES', 1000)
+        end = min(index.count, start + page - 1)
+        begin, limit = index.range(item.data, start - 1, end)
+        if not rendering_allowed(ct, limit - begin, True, True, ct_pygments):
+            return None
+        html = highlight_data(name, item.data.read(limit - begin, begin), ct_pygments,
+                              dict(FORMATTER_OPTIONS, linenostart=start))
+        current_app.download_timestamps.record(name)
+        return dict(html=html, start=start, end=end, count=index.count, page=page)
 
 
 class CarouselView(DisplayView):
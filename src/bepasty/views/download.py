@@ -1,40 +1,252 @@
+from datetime import datetime, timezone
 import errno
-from io import BytesIO
 import os
+import secrets
 import time
 
-try:
-    import PIL
-except ImportError:
-    # Pillow / PIL is optional
-    PIL = None
-else:
-    from PIL import Image
-
-from flask import Response, current_app, render_template, stream_with_context
+from flask import Response, current_app, render_template, request, stream_with_context
 from flask.views import MethodView
-from werkzeug.exceptions import NotFound, Forbidden
+from werkzeug.exceptions import (
+    BadRequest,
+    NotFound,
+    Forbidden,
+    RequestEntityTooLarge,
+    RequestedRangeNotSatisfiable,
+    ServiceUnavailable,
+)
+from werkzeug.http import is_resource_modified
 
-from ..constants import COMPLETE, FILENAME, LOCKED, SIZE, TIMESTAMP_DOWNLOAD, TYPE
+from ..constants import (
+    COMPLETE, FILENAME, HASH, LINE_COUNT, LOCKED, TIMESTAMP_MAX_LIFE, TIMESTAMP_UPLOAD, TYPE,
+)
+from ..utils.compression import open_variant, precompressible, select_encoding
 from ..utils.date_funcs import delete_if_lifetime_over
+from ..utils.http import DownloadRange
+from ..utils.highlight import FORMATTER_OPTIONS, highlight_data, pygments_type
+from ..utils.lines import get_line_index
 from ..utils.permissions import ADMIN, READ, may
+from ..utils.thumbnail import THUMBNAIL_TYPES, get_thumbnail
+
+
+class ItemFile:
+    """
+    File-like object given to wsgi.file_wrapper, closing the item when the server is done.
+    """
+    def __init__(self, item, name, offset):
+        self.item = item
+        self.name = name
+        self._offset = offset
+        self._file = None
+        # the server may close us outside of the app context
+        self._download_timestamps = current_app.download_timestamps
+
+    def _get_file(self):
+        if self._file is None:
+            # position the file only now, other code might have moved it meanwhile
+            self._file = self.item.data.file_at(self._offset)
+        return self._file
+
+    def read(self, size=-1):
+        return self._get_file().read(size)
+
+    def fileno(self):
+        # the server uses this (and the current file position) for sendfile
+        return self._get_file().fileno()
+
+    def tell(self):
+        return self._get_file().tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self._get_file().seek(offset, whence)
+
+    def close(self):
+        if self._file is not None:
+            self._download_timestamps.record(self.name)
+        self.item.close()
 
 
 class DownloadView(MethodView):
     content_disposition = 'attachment'  # to trigger download
+    # the response only depends on the item data, which does not change once
+    # complete, so we can send cache validators and answer conditional requests
+    conditional = True
+    etag_prefix = ''
+    # whether we send precompressed variants of the data, see utils.compression
+    precompressed = True
+    # content encoding of the response, chosen by get()
+    encoding = None
 
     def err_incomplete(self, item, error):
         return render_template('error.html', heading=item.meta[FILENAME], body=error), 409
 
-    def stream(self, item, start, limit):
+    def read(self, item, start, limit):
+        # Read content from storage, in pieces
+        offset = max(0, start)
+        while offset < limit:
+            buf = item.data.read(min(limit - offset, 16 * 1024), offset)
+            offset += len(buf)
+            yield buf
+
+    def stream(self, item, name, start, limit):
         with item as _item:
-            # Stream content from storage
-            offset = max(0, start)
-            while offset < limit:
-                buf = _item.data.read(min(limit - offset, 16 * 1024), offset)
-                offset += len(buf)
+            yield from self.read(_item, start, limit)
+            current_app.download_timestamps.record(name)
+
+    def stream_variant(self, item, name, f):
+        with item, f:
+            while True:
+                buf = f.read(16 * 1024)
+                if not buf:
+                    break
                 yield buf
-            item.meta[TIMESTAMP_DOWNLOAD] = int(time.time())
+            current_app.download_timestamps.record(name)
+
+    def stream_multipart(self, item, name, parts, end):
+        with item as _item:
+            for header, download_range in parts:
+                yield header
+                yield from self.read(_item, download_range.begin, download_range.end + 1)
+            yield end
+            current_app.download_timestamps.record(name)
+
+    def stream_response(self, item, name, start, limit):
+        """
+        Create a response with the item data from <start> up to <limit> as body.
+
+        If the WSGI server offers wsgi.file_wrapper, we hand the data file to it,
+        so it can be transferred without copying it through Python. As the
+        server transfers until the end of the file, we only do this if we serve
+        the data up to the end (and the data is not stored compressed).
+        """
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        if file_wrapper is None or limit != item.data.size or item.data.path is None:
+            return Response(stream_with_context(self.stream(item, name, start, limit)))
+        return Response(file_wrapper(ItemFile(item, name, max(0, start)), 16 * 1024), direct_passthrough=True)
+
+    def data_response(self, item, name, content_type):
+        """
+        Create a response with the item data (of <content_type>), or with the
+        ranges of it requested in the Range header (see DownloadRange): one
+        range as 206 Partial Content, several as multipart/byteranges.
+
+        If get() chose a content encoding, send the precompressed variant.
+        """
+        if self.encoding is not None:
+            f = open_variant(current_app.storage, name, item, self.encoding)
+            if f is not None:
+                ret = Response(stream_with_context(self.stream_variant(item, name, f)))
+                ret.headers['Content-Length'] = os.fstat(f.fileno()).st_size - f.tell()
+                ret.headers['Content-Type'] = content_type
+                ret.headers['Content-Encoding'] = self.encoding
+                ret.headers['Accept-Ranges'] = 'bytes'
+                return ret
+            # gone meanwhile
+            self.encoding = None
+        size = item.data.size
+        try:
+            ranges = DownloadRange.from_request(size, self.etag(item), self.last_modified(item))
+        except RequestedRangeNotSatisfiable:
+            item.close()
+            raise
+        if not ranges:
+            ret = self.stream_response(item, name, 0, size)
+            ret.headers['Content-Length'] = size
+            ret.headers['Content-Type'] = content_type
+        elif len(ranges) == 1:
+            download_range = ranges[0]
+            ret = self.stream_response(item, name, download_range.begin, download_range.end + 1)
+            ret.status_code = 206
+            ret.headers['Content-Length'] = download_range.size
+            ret.headers['Content-Range'] = download_range.content_range(size)
+            ret.headers['Content-Type'] = content_type
+        else:
+            boundary = secrets.token_hex(16)
+            parts = [('\r\n--{}\r\nContent-Type: {}\r\nContent-Range: {}\r\n\r\n'.format(
+                boundary, content_type, download_range.content_range(size)).encode(), download_range)
+                for download_range in ranges]
+            end = '\r\n--{}--\r\n'.format(boundary).encode()
+            ret = Response(stream_with_context(self.stream_multipart(item, name, parts, end)))
+            ret.status_code = 206
+            ret.headers['Content-Length'] = sum(len(header) + r.size for header, r in parts) + len(end)
+            ret.headers['Content-Type'] = 'multipart/byteranges; boundary=' + boundary
+        ret.headers['Accept-Ranges'] = 'bytes'
+        return ret
+
+    def offload_response(self, item, name):
+        """
+        Create a response that lets the front-end web server send the data file
+        (see DOWNLOAD_OFFLOAD), or return None if offloading is not configured
+        (or the data is stored compressed, so there is no file to send).
+
+        The front-end server also takes care of Range and conditional requests then.
+        """
+        offload = current_app.config.get('DOWNLOAD_OFFLOAD')
+        path = item.data.path
+        if not offload or path is None:
+            return None
+        if offload == 'x-accel-redirect':
+            path = os.path.relpath(path, current_app.config['STORAGE_FILESYSTEM_DIRECTORY'])
+            header = 'X-Accel-Redirect'
+            value = current_app.config['DOWNLOAD_OFFLOAD_PREFIX'].rstrip('/') + '/' + path
+        elif offload == 'x-sendfile':
+            header = 'X-Sendfile'
+            value = os.path.abspath(path)
+        else:
+            raise ValueError('Unsupported DOWNLOAD_OFFLOAD: %r' % offload)
+        # we do not know when (or whether) the transfer completes, so register it now
+        current_app.download_timestamps.record(name)
+        item.close()
+        ret = Response()
+        ret.headers[header] = value
+        return ret
+
+    def etag(self, item):
+        if not item.meta[HASH]:
+            return None
+        etag = self.etag_prefix + item.meta[HASH]
+        if self.encoding is not None:
+            # another representation
+            etag += '-' + self.encoding
+        return etag
+
+    def last_modified(self, item):
+        return datetime.fromtimestamp(item.meta[TIMESTAMP_UPLOAD], timezone.utc)
+
+    def cache_headers(self, ret, item):
+        """
+        Add ETag, Last-Modified and Cache-Control headers for <item> to response <ret>.
+
+        Items may be cached until they expire (at most DOWNLOAD_CACHE_MAX_AGE
+        seconds), by shared caches only if everybody may read them.
+        """
+        etag = self.etag(item)
+        if etag is not None:
+            ret.set_etag(etag)
+        ret.last_modified = self.last_modified(item)
+        max_age = current_app.config.get('DOWNLOAD_CACHE_MAX_AGE', 24 * 3600)
+        maxlife = item.meta[TIMESTAMP_MAX_LIFE]
+        if maxlife > 0:
+            max_age = max(0, min(max_age, maxlife - int(time.time())))
+        public = not item.meta[LOCKED] and READ in current_app.config['DEFAULT_PERMISSIONS'].split(',')
+        if public:
+            ret.cache_control.public = True
+        else:
+            ret.cache_control.private = True
+        ret.cache_control.max_age = max_age
+        if self.precompressed and precompressible(current_app.config, item):
+            ret.vary.add('Accept-Encoding')
+
+    def not_modified_response(self, item, name):
+        """
+        Return a 304 response if the request is conditional and the client has
+        the current data of <item>, otherwise None.
+        """
+        if is_resource_modified(request.environ, etag=self.etag(item), last_modified=self.last_modified(item)):
+            return None
+        current_app.download_timestamps.record(name)
+        ret = Response(status=304)
+        self.cache_headers(ret, item)
+        return ret
 
     def response(self, item, name):
         ct = item.meta[TYPE]
@@ -44,11 +256,13 @@ class DownloadView(MethodView):
             if ct.startswith("text/"):
                 ct = 'text/plain'  # Only send simple plain text
 
-        ret = Response(stream_with_context(self.stream(item, 0, item.data.size)))
+        ret = self.offload_response(item, name)
+        if ret is None:
+            ret = self.data_response(item, name, ct)
+        else:
+            ret.headers['Content-Type'] = ct
         ret.headers['Content-Disposition'] = '{}; filename="{}"'.format(
             dispo, item.meta[FILENAME])
-        ret.headers['Content-Length'] = item.meta[SIZE]
-        ret.headers['Content-Type'] = ct
         ret.headers['X-Content-Type-Options'] = 'nosniff'  # Yes, we really mean it
         return ret
 
@@ -56,7 +270,7 @@ class DownloadView(MethodView):
         if not may(READ):
             raise Forbidden()
         try:
-            item = current_app.storage.openwrite(name)
+            item = current_app.storage.open(name)
         except OSError as e:
             if e.errno == errno.ENOENT:
                 raise NotFound()
@@ -72,12 +286,26 @@ class DownloadView(MethodView):
 
             if delete_if_lifetime_over(item, name):
                 raise NotFound()
+
+            if (self.precompressed and 'Range' not in request.headers and
+                    not current_app.config.get('DOWNLOAD_OFFLOAD')):
+                self.encoding = select_encoding(current_app.storage, name, item, request.accept_encodings)
+
+            if self.conditional:
+                ret = self.not_modified_response(item, name)
+                if ret is not None:
+                    return ret
             need_close = False
         finally:
             if need_close:
                 item.close()
 
-        return self.response(item, name)
+        ret = self.response(item, name)
+        # responses with no-cache are not the item data (e.g. a placeholder thumbnail)
+        if self.conditional and ret.status_code in (200, 206) and not ret.cache_control.no_cache:
+            # the item may be closed now, but we still have the metadata
+            self.cache_headers(ret, item)
+        return ret
 
 
 class InlineView(DownloadView):
@@ -85,7 +313,8 @@ class InlineView(DownloadView):
 
 
 class ThumbnailView(InlineView):
-    thumbnail_size = 192, 108
+    etag_prefix = 'thumb-'
+    precompressed = False
     thumbnail_data = """\
         <?xml version="1.0" encoding="UTF-8" standalone="no"?>
         <svg width="108" height="108" viewBox="0 0 108 108" xmlns="http://www.w3.org/2000/svg">
@@ -98,34 +327,22 @@ class ThumbnailView(InlineView):
         return b'', 409  # conflict
 
     def response(self, item, name):
-        sz = item.meta[SIZE]
-        fn = item.meta[FILENAME]
-        ct = item.meta[TYPE]
-        unsupported = PIL is None or ct not in {'image/jpeg', 'image/png', 'image/gif', 'image/webp'}
-        if unsupported:
+        with item:
+            fn = item.meta[FILENAME]
+            ct = item.meta[TYPE]
+            thumbnail_data = get_thumbnail(current_app.storage, name, item)
+        if thumbnail_data is None:
             # Return a placeholder thumbnail for unsupported item types
             ret = Response(self.thumbnail_data)
             ret.headers['Content-Length'] = len(self.thumbnail_data)
             ret.headers['Content-Type'] = 'image/svg+xml'
             ret.headers['X-Content-Type-Options'] = 'nosniff'  # Yes, we really mean it
+            # the thumbnail might work next time (e.g. after a timeout), so
+            # it must not be cached in place of it
+            ret.cache_control.no_cache = True
             return ret
 
-        if ct in ('image/jpeg', ):
-            thumbnail_type = 'jpeg'
-        elif ct in ('image/png', 'image/gif'):
-            thumbnail_type = 'png'
-        elif ct in ('image/webp', ):
-            thumbnail_type = 'webp'
-        else:
-            raise ValueError('Unrecognized image content type')
-
-        # Compute thumbnail data "on the fly"
-        with BytesIO(item.data.read(sz, 0)) as img_bio, BytesIO() as thumbnail_bio:
-            with Image.open(img_bio) as img:
-                img.thumbnail(self.thumbnail_size)
-                img.save(thumbnail_bio, thumbnail_type)
-            thumbnail_data = thumbnail_bio.getvalue()
-
+        thumbnail_type = THUMBNAIL_TYPES[ct]
         name, ext = os.path.splitext(fn)
         thumbnail_fn = '{}-thumb.{}'.format(name, thumbnail_type)
 
@@ -136,3 +353,47 @@ class ThumbnailView(InlineView):
         ret.headers['Content-Type'] = 'image/%s' % thumbnail_type
         ret.headers['X-Content-Type-Options'] = 'nosniff'  # yes, we really mean it
         return ret
+
+
+class LinesView(InlineView):
+    """
+    Lines request.args['start'] up to request.args['end'] (1-based, inclusive)
+    of a text item, as plain text or, with request.args['format'] == 'html',
+    syntax highlighted HTML. Only the requested lines are read from storage.
+    """
+    conditional = False
+    precompressed = False
+
+    def response(self, item, name):
+        ct = item.meta[TYPE]
+        ct_pygments = pygments_type(ct)
+        start = request.args.get('start', 1, type=int)
+        end = request.args.get('end', start + current_app.config.get('DISPLAY_LINES', 1000) - 1, type=int)
+        need_close = True
+        try:
+            if ct_pygments is None or start < 1 or end < start - 1:
+                raise BadRequest(description='Not a text item or invalid line range')
+            index = get_line_index(current_app.storage, name, item, build=False)
+            if index is None:
+                raise ServiceUnavailable(description='Item is being indexed. Try again later.', retry_after=60)
+            begin, limit = index.range(item.data, start - 1, end)
+            if request.args.get('format') != 'html':
+                # the response streams the data and closes the item
+                ret = self.stream_response(item, name, begin, limit)
+                need_close = False
+                ret.headers['Content-Length'] = limit - begin
+                ret.headers['Content-Type'] = 'text/plain'
+            else:
+                if not current_app.render_limits.allowed(ct, limit - begin, highlight_type=ct_pygments):
+                    raise RequestEntityTooLarge(description='Lines too big to render')
+                html = highlight_data(name, item.data.read(limit - begin, begin), ct_pygments,
+                                      dict(FORMATTER_OPTIONS, linenostart=start))
+                current_app.download_timestamps.record(name)
+                ret = Response(html)
+                ret.headers['Content-Type'] = 'text/html; charset=utf-8'
+        finally:
+            if need_close:
+                item.close()
+        ret.headers[LINE_COUNT] = index.count
+        ret.headers['X-Content-Type-Options'] = 'nosniff'  # yes, we really mean it
+        return ret
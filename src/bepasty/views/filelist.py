@@ -6,7 +6,7 @@ from flask.views import MethodView
 from werkzeug.exceptions import Forbidden
 
 from ..constants import ID, TIMESTAMP_UPLOAD
-from ..utils.date_funcs import delete_if_lifetime_over
+from ..utils.date_funcs import delete_if_lifetime_over, delete_if_meta_lifetime_over, lifetime_over
 from ..utils.permissions import LIST, may
 
 
@@ -16,11 +16,27 @@ def file_infos(names=None):
 
     Note: we put the storage name into the metadata as ID.
 
-    :param names: None means "all items"; otherwise, provide a list of storage item names
+    :param names: None means "all items" (most recent uploads first); otherwise,
+                  provide a list of storage item names
     """
     storage = current_app.storage
-    if names is None:
-        names = list(storage)
+    if names is not None:
+        yield from _open_infos(names)
+    elif storage.index is not None:
+        # answer from the metadata index (in order), without opening every item.
+        # If the housekeeper runs, we leave deleting expired items to it.
+        housekeeping = current_app.housekeeper is not None
+        for name, meta in storage.index.items():
+            if lifetime_over(meta) if housekeeping else delete_if_meta_lifetime_over(meta, name):
+                continue
+            meta[ID] = name
+            yield meta
+    else:
+        yield from sorted(_open_infos(list(storage)), key=lambda f: f[TIMESTAMP_UPLOAD], reverse=True)
+
+
+def _open_infos(names):
+    storage = current_app.storage
     for name in names:
         try:
             with storage.open(name) as item:
@@ -45,5 +61,4 @@ class FileListView(MethodView):
     def get(self):
         if not may(LIST):
             raise Forbidden()
-        files = sorted(file_infos(), key=lambda f: f[TIMESTAMP_UPLOAD], reverse=True)
-        return render_template('filelist.html', files=files)
+        return render_template('filelist.html', files=list(file_infos()))
@@ -30,7 +30,7 @@ class ModifyView(MethodView):
             raise Forbidden()
 
         try:
-            with current_app.storage.openwrite(name) as item:
+            with current_app.storage.openlocked(name) as item:
                 if not item.meta[COMPLETE] and not may(ADMIN):
                     error = 'Upload incomplete. Try again later.'
                     return self.error(item, error)
@@ -50,6 +50,7 @@ class ModifyView(MethodView):
                     item.meta[TYPE], _ = Upload.filter_type(
                         params[TYPE], item.meta[TYPE]
                     )
+                    current_app.highlight_cache.invalidate(name)
 
                 return self.response(name)
 
@@ -29,7 +29,7 @@ class SetKeyValueView(MethodView):
         if self.REQUIRED_PERMISSION is not None and not may(self.REQUIRED_PERMISSION):
             raise Forbidden()
         try:
-            with current_app.storage.openwrite(name) as item:
+            with current_app.storage.openlocked(name) as item:
                 if item.meta[self.KEY] == self.NEXT_VALUE:
                     error = f'{self.KEY} already is {self.NEXT_VALUE!r}.'
                 elif not item.meta[COMPLETE]:
@@ -1,27 +1,48 @@
-import os
 import errno
 from io import BytesIO
+import shutil
 import time
 import urllib
 
 from flask import abort, current_app, jsonify, request, url_for
 from flask.views import MethodView
-from werkzeug.exceptions import NotFound, Forbidden
+from werkzeug.exceptions import BadRequest, NotFound, Forbidden
 
 from ..constants import COMPLETE, FILENAME, SIZE
 from ..utils.date_funcs import get_maxlife
+from ..utils.hashing import hash_states
 from ..utils.http import ContentRange, redirect_next
 from ..utils.name import ItemName
 from ..utils.permissions import CREATE, may
-from ..utils.upload import Upload, create_item, background_compute_hash
+from ..utils.upload import ItemWriter, Upload, create_item, create_item_from_writer, item_completed
+
+
+def get_item_writer(f, writer_factory):
+    """
+    Get the ItemWriter the uploaded file <f> was written into while parsing the request.
+
+    If it was spooled to a temporary file instead (see bepasty.app.Request),
+    copy it into a writer made by <writer_factory> now.
+    """
+    if isinstance(f.stream, ItemWriter):
+        return f.stream
+    writer = writer_factory()
+    request.item_writers.append(writer)  # so it gets closed with the request
+    shutil.copyfileobj(f.stream, writer, 16 * 1024)
+    return writer
 
 
 class UploadView(MethodView):
+    @staticmethod
+    def item_writer():
+        return ItemWriter.create(current_app.storage)
+
     def post(self):
         if not may(CREATE):
             raise Forbidden()
         f = request.files.get('file')
         t = request.form.get('text')
+        writer = None
         # Note: "and f.filename" is needed due to a missing __bool__ method in
         # werkzeug.datastructures.FileStorage, to work around it crashing
         # on Python 3.x.
@@ -37,10 +58,7 @@ class UploadView(MethodView):
             content_type_hint = 'application/octet-stream'
             filename = f.filename
 
-            # Get size of temporary file
-            f.seek(0, os.SEEK_END)
-            size = f.tell()
-            f.seek(0)
+            writer = get_item_writer(f, self.item_writer)
         elif t is not None:
             # t is already Unicode, but we want UTF-8 for storage
             t = t.encode('utf-8')
@@ -54,7 +72,11 @@ class UploadView(MethodView):
         # Set the maximum lifetime
         maxtime = get_maxlife(request.form, underscore=False)
         maxlife_timestamp = int(time.time()) + maxtime if maxtime > 0 else maxtime
-        name = create_item(f, filename, size, content_type, content_type_hint, maxlife_stamp=maxlife_timestamp)
+        if writer is not None:
+            name = create_item_from_writer(writer, filename, content_type, content_type_hint,
+                                           maxlife_stamp=maxlife_timestamp)
+        else:
+            name = create_item(f, filename, size, content_type, content_type_hint, maxlife_stamp=maxlife_timestamp)
         kw = {}
         kw['_anchor'] = urllib.parse.quote(filename)
         if content_type == 'text/x-bepasty-redirect':
@@ -90,6 +112,13 @@ class UploadNewView(MethodView):
 
 
 class UploadContinueView(MethodView):
+    @staticmethod
+    def item_writer(name):
+        try:
+            return ItemWriter.open(current_app.storage, name, ContentRange.from_request())
+        except FileNotFoundError:
+            raise NotFound()
+
     def post(self, name):
         if not may(CREATE):
             raise Forbidden()
@@ -101,26 +130,17 @@ class UploadContinueView(MethodView):
         # Check Content-Range
         content_range = ContentRange.from_request()
 
-        with current_app.storage.openwrite(name) as item:
+        writer = get_item_writer(f, lambda: self.item_writer(name))
+        with writer.claim() as item:
             if content_range:
-                # Note: we ignore the hash as it is only for one chunk, not for the whole upload.
-                # Also, we cannot continue computing the hash as we can't save the internal
-                # state of the hash object.
-                size_written, _ = Upload.data(item, f, content_range.size, content_range.begin)
-                file_hash = ''
-                is_complete = content_range.is_complete
-
+                # Chunks may come in any order and in parallel, only touch
+                # the metadata through Upload.receive_range. The item_writer
+                # checked the chunk may be written, we check it is complete.
+                if writer.size != content_range.size:
+                    raise BadRequest(description='Content-Range inconsistent with uploaded data')
+                writer.suspend_hash()
             else:
-                # Get the size of the temporary file
-                f.seek(0, os.SEEK_END)
-                size = f.tell()
-                f.seek(0)
-
-                size_written, file_hash = Upload.data(item, f, size)
-                is_complete = True
-
-            if is_complete:
-                Upload.meta_complete(item, file_hash)
+                Upload.meta_complete(item, writer.hexdigest())
 
             result = jsonify({'files': [{
                 'name': name,
@@ -129,8 +149,11 @@ class UploadContinueView(MethodView):
                 'url': "{}#{}".format(url_for('bepasty.display', name=name), item.meta[FILENAME]),  # Anchor to filename
             }]})
 
-        if is_complete and not file_hash:
-            background_compute_hash(current_app.storage, name)
+        if content_range:
+            Upload.receive_range(current_app.storage, name, content_range.begin, content_range.end + 1,
+                                 content_range.complete)
+        else:
+            item_completed(name, writer.hexdigest())
 
         return result
 
@@ -154,6 +177,7 @@ class UploadAbortView(MethodView):
         if error:
             return error, 409
 
+        hash_states.discard(name)
         try:
             item = current_app.storage.remove(name)
         except OSError as e: